@@ -3,6 +3,7 @@ Initialize flask components.
 '''
 from flask_lambda import FlaskLambda
 import logging
+import time
 
 _logger = logging.getLogger(__name__)
 
@@ -20,14 +21,96 @@ def _initialize_errorhandlers(application):
     from app.errors import errors
     application.register_blueprint(errors)
 
+def _initialize_ingest(application):
+    '''
+    Start background ingest workers when webhooks are spooled.
+    '''
+    from app import ingest
+    if ingest.is_async():
+        ingest.start_workers()
+
+def _initialize_enrichment(application):
+    '''
+    Fetch alert details in the background when enrichment is deferred or
+    alerts may be archived without them.
+
+    Lambda freezes background threads between invocations, so there alerts
+    archived without their details are left to reads and the reconcile
+    script.
+    '''
+    import config
+    import os
+    from app import enrichment
+    on_lambda = bool(os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+    if config.TS_ENRICHMENT == 'deferred' or (config.TS_WEBHOOK_ONLY_FALLBACK and not on_lambda):
+        enrichment.start_workers()
+
+def _initialize_wal(application):
+    '''
+    Replay S3 writes logged while S3 was failing.
+    '''
+    from app import wal
+    if wal.is_enabled():
+        wal.start_flusher()
+
+def _initialize_health(application):
+    '''
+    Check dependency health in the background for /status if configured.
+    '''
+    import config
+    from app import health
+    if config.TS_STATUS_INTERVAL:
+        health.start_prober()
+
+def _initialize_metrics(application):
+    '''
+    Share metrics with other worker processes if configured.
+    '''
+    from app import metrics
+    metrics.start()
+
+def _initialize_tracing(application):
+    '''
+    Trace requests on demand and set up the profiler.
+    '''
+    from app import profiler, tracing
+    tracing.init_app(application)
+    profiler.init()
+
+def _initialize_clients(application):
+    '''
+    Create every tenant's clients now if configured, not on first use.
+    '''
+    import config
+    if not config.TS_PRELOAD_CLIENTS:
+        return
+
+    from app import tenants
+    import app.models.s3 as s3_model
+    import app.models.threatstack as threatstack_model
+    for tenant in tenants.get_all():
+        with tenants.using(tenant):
+            s3_model.initialize()
+            threatstack_model.initialize()
+
 def create_app():
     '''
     Create an app by initializing components.
     '''
+    started = time.time()
     application = FlaskLambda(__name__)
 
     _initialize_errorhandlers(application)
     _initialize_blueprints(application)
+    _initialize_ingest(application)
+    _initialize_wal(application)
+    _initialize_enrichment(application)
+    _initialize_health(application)
+    _initialize_metrics(application)
+    _initialize_tracing(application)
+    _initialize_clients(application)
+
+    _logger.info('Initialized app in {:.3f}s'.format(time.time() - started))
 
     # Do it!
     return application
@@ -0,0 +1,132 @@
+'''
+Archive historical alerts from the Threat Stack API.
+
+Pages through alerts created in a date range and archives any that aren't
+already in S3 using the same key layout as the webhook endpoint.  Progress
+is checkpointed to a local file after each page so an interrupted backfill
+can resume.
+'''
+from app import concurrency, ingest, tenants
+from app.errors import AppBaseError, log_exception
+import app.models.s3 as s3_model
+import app.models.threatstack as threatstack_model
+import json
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+# Fields of an alert that Threat Stack sends in a webhook.  We store the same
+# for backfilled alerts.
+WEBHOOK_FIELDS = (
+    'id',
+    'title',
+    'created_at',
+    'severity',
+    'organization_id',
+    'server_or_region',
+    'source'
+)
+
+class BackfillError(AppBaseError):
+    '''
+    Backfill failed.
+    '''
+
+def _get_webhook_data(alert):
+    '''
+    Return the webhook form of an alert from the alerts API.
+    '''
+    return dict((f, alert.get(f)) for f in WEBHOOK_FIELDS if f in alert)
+
+def _read_checkpoint(path, start, end):
+    '''
+    Return the saved checkpoint for this date range, or a new one.
+    '''
+    checkpoint = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'page': 0,
+        'archived': 0,
+        'skipped': 0,
+        'failed': []
+    }
+
+    if path and os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get('start') == checkpoint['start'] and saved.get('end') == checkpoint['end']:
+            _logger.info('Resuming backfill from page {}'.format(saved.get('page')))
+            checkpoint = saved
+        else:
+            raise BackfillError('Checkpoint {} is for a different date range'.format(path))
+
+    return checkpoint
+
+def _write_checkpoint(path, checkpoint):
+    '''
+    Atomically save a checkpoint.
+    '''
+    if not path:
+        return
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(tmp_path, path)
+
+def _backfill_alert(alert):
+    '''
+    Archive an alert unless it's already archived.
+
+    Returns 'archived', 'skipped' or 'failed'.
+    '''
+    alert_id = alert.get('id')
+    try:
+        with tenants.using(tenants.get_tenant(alert.get('organization_id'))):
+            if s3_model.alert_exists(alert_id):
+                return 'skipped'
+
+        # Details are fetched now, or the alert fails and is recorded for a
+        # rerun, as nothing in this process enriches alerts later.
+        ingest.archive_alert(_get_webhook_data(alert), inline=True)
+    except Exception as e:
+        log_exception(e)
+        return 'failed'
+
+    return 'archived'
+
+def backfill(start, end, checkpoint_path=None, workers=10, page_size=100, organization_id=None):
+    '''
+    Archive alerts created between start and end.
+
+    Alerts are listed with the API key of organization_id's tenant.
+    Returns the checkpoint recording pages done, counts of alerts archived
+    and skipped, and IDs of alerts that failed.
+    '''
+    checkpoint = _read_checkpoint(checkpoint_path, start, end)
+    tenant = tenants.get_tenant(organization_id)
+
+    while True:
+        page = checkpoint['page']
+        with tenants.using(tenant):
+            alerts = threatstack_model.get_alerts(start, end, page, page_size)
+        if not alerts:
+            break
+
+        results = concurrency.map(_backfill_alert, alerts, workers)
+        for alert, result in zip(alerts, results):
+            if result == 'failed':
+                checkpoint['failed'].append(alert.get('id'))
+            else:
+                checkpoint[result] += 1
+
+        checkpoint['page'] = page + 1
+        _write_checkpoint(checkpoint_path, checkpoint)
+        _logger.info('Backfilled page {}: {} archived, {} skipped, {} failed so far'.format(
+            page, checkpoint['archived'], checkpoint['skipped'], len(checkpoint['failed'])))
+
+        if len(alerts) < page_size:
+            break
+
+    return checkpoint
@@ -0,0 +1,94 @@
+'''
+In-process caches.
+'''
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+class LRUCache(object):
+    '''
+    Thread safe LRU cache bounded by entry count and total size.
+
+    Entries expire ttl seconds after they are set.  Callers supply each
+    value's size since only they know what it costs to keep.  Cached values
+    are shared so callers must not modify them.
+    '''
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        '''
+        Return a cached value, or None if missing or expired.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expires = entry
+            if expires < time.time():
+                self._size -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # Re-insert as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+
+        return value
+
+    def set(self, key, value, size):
+        '''
+        Cache a value of the given size.
+        '''
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+
+            self._entries[key] = (value, size, time.time() + self.ttl)
+            self._size += size
+
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        '''
+        Remove all entries.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        '''
+        Return cache size and hit, miss and eviction counts.
+        '''
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
@@ -0,0 +1,86 @@
+'''
+Shared AWS clients.
+
+Creating a boto3 client is expensive and each one keeps its own connection
+pool, so clients are created once per process and reused across requests
+and warm Lambda invocations.  boto3 clients are thread safe once created.
+
+boto3 is the slowest import we have so it is only imported when the first
+client is created, keeping it off paths that never talk to AWS.
+'''
+from app import guards, tracing
+import config
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+TS_AWS_MAX_POOL_CONNECTIONS = config.TS_AWS_MAX_POOL_CONNECTIONS
+TS_AWS_MAX_ATTEMPTS = config.TS_AWS_MAX_ATTEMPTS
+TS_AWS_S3_ENDPOINT_URL = config.TS_AWS_S3_ENDPOINT_URL
+TS_S3_MAX_IN_FLIGHT = config.TS_S3_MAX_IN_FLIGHT
+TS_S3_LATENCY_TARGET = config.TS_S3_LATENCY_TARGET
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _get_client_config(max_pool_connections):
+    '''
+    Return botocore configuration shared by our clients.
+    '''
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=max_pool_connections,
+        retries={
+            'max_attempts': TS_AWS_MAX_ATTEMPTS,
+            'mode': 'standard'
+        },
+        tcp_keepalive=True
+    )
+
+def _get_client_kwargs(service_name, max_pool_connections):
+    '''
+    Return arguments for creating a client for an AWS service.
+    '''
+    from botocore.config import Config
+    client_config = _get_client_config(max_pool_connections)
+    kwargs = {'config': client_config}
+
+    # S3 compatible stand-ins are addressed by path, not bucket hostname.
+    if service_name == 's3' and TS_AWS_S3_ENDPOINT_URL:
+        kwargs['endpoint_url'] = TS_AWS_S3_ENDPOINT_URL
+        kwargs['config'] = client_config.merge(Config(s3={'addressing_style': 'path'}))
+
+    return kwargs
+
+def get_client(service_name, pool=None, max_pool_connections=None):
+    '''
+    Return the shared client for an AWS service, creating it if needed.
+
+    Each named pool gets its own client and connections so one pool's
+    traffic can't exhaust another's.
+    '''
+    key = (service_name, pool)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3.session
+                _logger.debug('Creating {} client for pool {}'.format(service_name, pool))
+                # The default session is not safe to share between threads
+                # so give each client its own.
+                session = boto3.session.Session()
+                client_kwargs = _get_client_kwargs(service_name,
+                                                   max_pool_connections or TS_AWS_MAX_POOL_CONNECTIONS)
+                client = session.client(service_name, **client_kwargs)
+                tracing.instrument_client(client)
+                # Pools are per tenant, and so are their guards.
+                if service_name == 's3':
+                    guards.instrument_client(client, guards.get_guard('s3',
+                                                                      pool,
+                                                                      TS_S3_MAX_IN_FLIGHT,
+                                                                      TS_S3_LATENCY_TARGET))
+                _clients[key] = client
+
+    return client
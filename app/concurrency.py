@@ -0,0 +1,120 @@
+'''
+Bounded concurrency helpers.
+
+Uses plain threads so this works the same on Lambda and under gunicorn's
+gevent worker, where threading is monkey patched into greenlets.
+'''
+from app import tenants, tracing
+import itertools
+import logging
+import six
+from six.moves import queue
+import sys
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+def imap(func, iterable, concurrency):
+    '''
+    Yield func(item) for each item in iterable, in order.
+
+    At most concurrency calls run at once and at most twice that many results
+    are held waiting for the consumer.  The first exception raised by func is
+    re-raised to the consumer.  func runs as the caller's tenant and records
+    spans in the caller's trace.
+    '''
+    if concurrency <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    func = tracing.bind(tenants.bind(func))
+    items = iter(iterable)
+    tasks = queue.Queue()
+    results = queue.Queue()
+    workers = []
+
+    def _worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                results.put((index, True, func(item)))
+            except Exception:
+                results.put((index, False, sys.exc_info()))
+
+    submitted = 0
+    for item in itertools.islice(items, concurrency * 2):
+        tasks.put((submitted, item))
+        submitted += 1
+
+    for _ in range(min(concurrency, submitted)):
+        worker = threading.Thread(target=_worker)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    finished = {}
+    next_index = 0
+    try:
+        while next_index < submitted:
+            while next_index not in finished:
+                index, ok, value = results.get()
+                finished[index] = (ok, value)
+
+            ok, value = finished.pop(next_index)
+            next_index += 1
+            if not ok:
+                six.reraise(*value)
+
+            for item in itertools.islice(items, 1):
+                tasks.put((submitted, item))
+                submitted += 1
+
+            yield value
+    finally:
+        # Drop work nobody will consume and let the workers exit.
+        while True:
+            try:
+                tasks.get_nowait()
+            except queue.Empty:
+                break
+        for _ in workers:
+            tasks.put(None)
+
+def map(func, iterable, concurrency):
+    '''
+    Return [func(item) for item in iterable] using up to concurrency threads.
+    '''
+    return list(imap(func, iterable, concurrency))
+
+class RateLimiter(object):
+    '''
+    Token bucket limiting calls to rate per second.
+
+    Up to burst calls may go through at once after a quiet period.
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Wait until a call is allowed.
+        '''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Going negative reserves a future token for this caller.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
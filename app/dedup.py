@@ -0,0 +1,178 @@
+'''
+Skip archiving alerts that are already archived.
+
+SNS delivers at least once and Threat Stack resends webhooks, so the same
+alert often arrives more than once.  An alert is a duplicate when both its
+ID and the hash of its webhook data match one already archived; a resent
+alert whose webhook data changed is archived again.
+
+Archived alerts are remembered in a bounded in-process set.  With the s3
+backend, alerts this process hasn't seen are checked against the bucket,
+which is shared by every process: the stored webhook object's ETag is the
+MD5 of the webhook data we wrote.
+'''
+from app import serializer
+from app.cache import LRUCache
+from app.errors import log_exception
+import app.models.s3 as s3_model
+import config
+import hashlib
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+TS_DEDUP = config.TS_DEDUP
+TS_DEDUP_BACKEND = config.TS_DEDUP_BACKEND
+TS_DEDUP_MAX_ENTRIES = config.TS_DEDUP_MAX_ENTRIES
+TS_DEDUP_TTL = config.TS_DEDUP_TTL
+
+# Work an archive does that a duplicate avoids: one Threat Stack fetch, and
+# PUTs of the webhook and the alert details.
+FETCHES_PER_ALERT = 1
+PUTS_PER_ALERT = 2
+
+def _get_key(alert):
+    '''
+    Return the key an alert is remembered by.
+    '''
+    return (alert.get('organization_id'), alert.get('id'))
+
+class MemoryBackend(object):
+    '''
+    Bounded set of archived alerts in this process.
+
+    Alerts are keyed by organization and ID.
+    '''
+    def __init__(self, max_entries, ttl):
+        # Entries are tiny so bound by count only.
+        self._seen = LRUCache(max_entries, max_entries, ttl)
+
+    def is_archived(self, alert, digest):
+        '''
+        Return whether this alert was archived with this digest.
+        '''
+        return self._seen.get(_get_key(alert)) == digest
+
+    def add(self, alert, digest):
+        '''
+        Record an archived alert.
+        '''
+        self._seen.set(_get_key(alert), digest, 1)
+
+class S3Backend(MemoryBackend):
+    '''
+    Archived alerts recorded in the bucket itself.
+
+    Alerts seen by this process are answered from memory.  Others cost two
+    HEAD requests, which is still cheaper than a fetch and two PUTs.
+    '''
+    def is_archived(self, alert, digest):
+        if super(S3Backend, self).is_archived(alert, digest):
+            return True
+
+        # Multipart and SSE-KMS ETags aren't MD5s and never match, which
+        # just means the alert is archived again.
+        etag = s3_model.get_webhook_etag(alert)
+        if etag is None or etag.strip('"') != digest:
+            return False
+
+        if not s3_model.alert_exists(alert.get('id')):
+            return False
+
+        self.add(alert, digest)
+        return True
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    's3': S3Backend
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'checked': 0,
+    'duplicates': 0,
+    'fetches_avoided': 0,
+    'puts_avoided': 0,
+    'errors': 0
+}
+
+def _get_backend():
+    '''
+    Return the dedup backend, creating it if needed.
+    '''
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = BACKENDS[TS_DEDUP_BACKEND](TS_DEDUP_MAX_ENTRIES, TS_DEDUP_TTL)
+
+    return _backend
+
+def _count(**counts):
+    '''
+    Add to the dedup counters.
+    '''
+    with _stats_lock:
+        for name, count in counts.items():
+            _stats[name] += count
+
+def get_digest(alert):
+    '''
+    Return the hash of an alert's webhook data as it is stored.
+    '''
+    return hashlib.md5(serializer.dumps(alert)).hexdigest()
+
+def is_archived(alert, digest, local_only=False):
+    '''
+    Return whether an alert with this digest is already archived.
+
+    With local_only only this process's memory is consulted.  Lookup
+    failures count as not archived so the alert is archived again.
+    '''
+    if not TS_DEDUP:
+        return False
+
+    backend = _get_backend()
+    try:
+        if local_only:
+            archived = MemoryBackend.is_archived(backend, alert, digest)
+        else:
+            archived = backend.is_archived(alert, digest)
+    except Exception as e:
+        log_exception(e)
+        _count(checked=1, errors=1)
+        return False
+
+    if archived:
+        _logger.info('Skipping already archived alert {}'.format(alert.get('id')))
+        _count(checked=1,
+               duplicates=1,
+               fetches_avoided=FETCHES_PER_ALERT,
+               puts_avoided=PUTS_PER_ALERT)
+    else:
+        _count(checked=1)
+
+    return archived
+
+def add(alert, digest):
+    '''
+    Record that an alert was archived.
+    '''
+    if TS_DEDUP:
+        _get_backend().add(alert, digest)
+
+def get_stats():
+    '''
+    Return dedup counters, or None if dedup is disabled.
+    '''
+    if not TS_DEDUP:
+        return None
+
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['backend'] = TS_DEDUP_BACKEND
+
+    return stats
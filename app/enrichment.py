@@ -0,0 +1,314 @@
+'''
+Deferred alert enrichment.
+
+When TS_ENRICHMENT is 'deferred' ingest stores an alert's webhook data and
+returns, and its details are fetched from Threat Stack and stored later:
+
+ * in batches by a background worker, shortly after ingest,
+ * when the alert is first read and its details aren't stored yet,
+ * by a reconciler that periodically looks for recent webhooks without
+   alert details, which catches anything the other two missed.
+
+Alerts archived with only their webhook data because Threat Stack was
+unavailable, see TS_WEBHOOK_ONLY_FALLBACK, are queued for the batch worker
+in either mode and retried until Threat Stack is back.  The queue is lost
+if the process exits, so with the fallback on the reconciler runs in either
+mode too.
+'''
+from app import concurrency, metrics, tenants, wal
+from app.errors import log_exception
+import app.models.s3 as s3_model
+import app.models.threatstack as threatstack_model
+import config
+import datetime
+import heapq
+import itertools
+from iso8601 import UTC
+import logging
+import os
+import six
+from six.moves import queue
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_logger = logging.getLogger(__name__)
+
+ENRICHMENTS = metrics.Counter(
+    'threatstack_to_s3_enrichments_total',
+    'Alerts whose details were fetched after ingest.',
+    ['source', 'result']
+)
+
+TS_ENRICHMENT = config.TS_ENRICHMENT
+TS_ENRICHMENT_BATCH_SIZE = config.TS_ENRICHMENT_BATCH_SIZE
+TS_ENRICHMENT_BATCH_WAIT = config.TS_ENRICHMENT_BATCH_WAIT
+TS_ENRICHMENT_CONCURRENCY = config.TS_ENRICHMENT_CONCURRENCY
+TS_ENRICHMENT_QUEUE_SIZE = config.TS_ENRICHMENT_QUEUE_SIZE
+TS_ENRICHMENT_RECONCILE_INTERVAL = config.TS_ENRICHMENT_RECONCILE_INTERVAL
+TS_ENRICHMENT_RECONCILE_WINDOW = config.TS_ENRICHMENT_RECONCILE_WINDOW
+TS_ENRICHMENT_LOCK_FILE = config.TS_ENRICHMENT_LOCK_FILE
+TS_WEBHOOK_ONLY_FALLBACK = config.TS_WEBHOOK_ONLY_FALLBACK
+
+# Seconds before an alert is old enough for the reconciler.  Younger ones
+# are most likely still queued for a batch.
+RECONCILE_DELAY = 60
+
+# Batch attempts at a queued alert, and seconds before the first retry,
+# doubling each time.  Alerts that run out are left to reads and the
+# reconciler.
+ENRICH_ATTEMPTS = 5
+RETRY_DELAY = config.TS_BREAKER_RESET
+
+_queue = queue.Queue(TS_ENRICHMENT_QUEUE_SIZE)
+_retries = []
+_retry_order = itertools.count()
+_retries_lock = threading.Lock()
+_workers = []
+_reconciler_lock = None
+_last_reconcile = None
+
+def is_deferred():
+    '''
+    Return whether ingest leaves fetching alert details to this module.
+
+    Only processes running the workers defer, so scripts like backfill
+    still fetch details as they go.
+    '''
+    return TS_ENRICHMENT == 'deferred' and is_running()
+
+def is_running():
+    '''
+    Return whether the batch worker is running to take queued alerts.
+    '''
+    return bool(_workers)
+
+def enrich(alert_id, source='read'):
+    '''
+    Fetch an alert's details from Threat Stack and archive them.
+
+    Returns the details.
+    '''
+    try:
+        alert_full = threatstack_model.get_alert_by_id(alert_id)
+        wal.write('alert', alert_full)
+    except Exception:
+        ENRICHMENTS.inc(source=source, result='failed')
+        raise
+
+    ENRICHMENTS.inc(source=source, result='stored')
+
+    return alert_full
+
+def enqueue(alert):
+    '''
+    Queue an alert to be enriched in the next batch as the current tenant.
+
+    Alerts that don't fit in the queue are left for the reconciler.
+    '''
+    try:
+        _queue.put_nowait((tenants.get_current(), alert.get('id'), 1))
+    except queue.Full:
+        _logger.warning('Enrichment queue is full, leaving alert {} to the reconciler'.format(alert.get('id')))
+        ENRICHMENTS.inc(source='batch', result='dropped')
+
+def _retry_later(item):
+    '''
+    Retry a queued alert once its delay has passed.
+    '''
+    tenant, alert_id, attempt = item
+    delay = RETRY_DELAY * 2 ** (attempt - 1)
+    with _retries_lock:
+        heapq.heappush(_retries, (time.time() + delay, next(_retry_order), (tenant, alert_id, attempt + 1)))
+
+def _get_due_retries():
+    '''
+    Return queued alerts whose retry delay has passed.
+    '''
+    due = []
+    with _retries_lock:
+        while _retries and _retries[0][0] <= time.time() and len(due) < TS_ENRICHMENT_BATCH_SIZE:
+            due.append(heapq.heappop(_retries)[2])
+
+    return due
+
+def _enrich_queued(item):
+    tenant, alert_id, attempt = item
+    with tenants.using(tenant):
+        try:
+            enrich(alert_id, 'batch')
+        except Exception as e:
+            log_exception(e)
+            # Otherwise the reconciler or a read will try again.
+            if attempt < ENRICH_ATTEMPTS:
+                _retry_later(item)
+
+def _run_batches():
+    '''
+    Worker loop enriching queued alerts in batches.
+    '''
+    while True:
+        batch = _get_due_retries()
+        if not batch:
+            try:
+                batch = [_queue.get(timeout=TS_ENRICHMENT_BATCH_WAIT)]
+            except queue.Empty:
+                continue
+        deadline = time.time() + TS_ENRICHMENT_BATCH_WAIT
+        while len(batch) < TS_ENRICHMENT_BATCH_SIZE:
+            try:
+                batch.append(_queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+
+        concurrency.map(_enrich_queued, batch, TS_ENRICHMENT_CONCURRENCY)
+
+def get_alert_data_with_etag(alert_id, etags=None):
+    '''
+    Return an alert's stored JSON and its ETag as
+    s3_model.get_alert_data_with_etag() does.
+
+    An alert whose details aren't stored yet is enriched first, but only if
+    its webhook was archived: IDs that never came through a webhook get
+    S3's error rather than being fetched from Threat Stack.
+    '''
+    try:
+        return s3_model.get_alert_data_with_etag(alert_id, etags)
+    except s3_model.S3ClientError:
+        exc_info = sys.exc_info()
+        if s3_model.alert_exists(alert_id) or not s3_model.webhook_exists(alert_id):
+            six.reraise(*exc_info)
+
+    enrich(alert_id)
+
+    return s3_model.get_alert_data_with_etag(alert_id, etags)
+
+def get_missing_alert(alert_id):
+    '''
+    Return the details of an alert being read that aren't stored yet.
+
+    For s3_model.iter_alerts_by_id(on_missing=...).  Failures are raised
+    so a response can't leave the alert out and still be cached as
+    complete.
+    '''
+    return enrich(alert_id)
+
+def reconcile(start, end):
+    '''
+    Enrich alerts between start and end that have no stored details.
+
+    Runs as the current tenant.  Returns counts of alerts checked, missing
+    and enriched.
+    '''
+    alert_ids = s3_model.get_alert_ids_by_date(start, end)
+    exists = concurrency.map(s3_model.alert_exists, alert_ids, TS_ENRICHMENT_CONCURRENCY)
+    missing = [alert_id for alert_id, found in zip(alert_ids, exists) if not found]
+
+    def _enrich_missing(alert_id):
+        try:
+            enrich(alert_id, 'reconcile')
+        except Exception as e:
+            log_exception(e)
+            return False
+        return True
+
+    enriched = concurrency.map(_enrich_missing, missing, TS_ENRICHMENT_CONCURRENCY)
+
+    return {
+        'checked': len(alert_ids),
+        'missing': len(missing),
+        'enriched': sum(enriched)
+    }
+
+def _lock_reconciler():
+    '''
+    Return an open lock file if this process may reconcile, otherwise None.
+
+    The first process on the host to take the lock keeps it, and so does
+    all the reconciling, until it exits.
+    '''
+    if fcntl is None:
+        return open(os.devnull)
+
+    lock_dir = os.path.dirname(TS_ENRICHMENT_LOCK_FILE)
+    if lock_dir and not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir)
+    lock_file = open(TS_ENRICHMENT_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return None
+
+    return lock_file
+
+def _run_reconciler():
+    '''
+    Reconciler loop checking recent alerts of every tenant.
+    '''
+    global _reconciler_lock, _last_reconcile
+    while True:
+        time.sleep(TS_ENRICHMENT_RECONCILE_INTERVAL)
+        try:
+            if _reconciler_lock is None:
+                _reconciler_lock = _lock_reconciler()
+                if _reconciler_lock is None:
+                    continue
+
+            end = datetime.datetime.now(UTC) - datetime.timedelta(seconds=RECONCILE_DELAY)
+            start = end - datetime.timedelta(seconds=TS_ENRICHMENT_RECONCILE_WINDOW)
+            totals = {'checked': 0, 'missing': 0, 'enriched': 0}
+            for tenant in tenants.get_all():
+                with tenants.using(tenant):
+                    result = reconcile(start, end)
+                if result['missing']:
+                    _logger.info('Reconciled tenant {}: {}'.format(tenant.name, result))
+                for count in totals:
+                    totals[count] += result[count]
+            _last_reconcile = dict(totals, time=time.time())
+        except Exception as e:
+            log_exception(e)
+
+def start_workers():
+    '''
+    Start the batch worker and, if configured, the reconciler.
+
+    The reconciler only runs if alerts may be stored without their details,
+    with deferred enrichment or the webhook-only fallback.
+    '''
+    if _workers:
+        return
+
+    targets = [('enrichment-batch', _run_batches)]
+    may_miss_details = TS_ENRICHMENT == 'deferred' or TS_WEBHOOK_ONLY_FALLBACK
+    if may_miss_details and TS_ENRICHMENT_RECONCILE_INTERVAL:
+        targets.append(('enrichment-reconciler', _run_reconciler))
+
+    for name, target in targets:
+        worker = threading.Thread(target=target, name=name)
+        worker.daemon = True
+        worker.start()
+        _workers.append(worker)
+
+    if TS_ENRICHMENT == 'deferred':
+        _logger.info('Deferring alert enrichment')
+    else:
+        _logger.info('Enriching alerts archived without their details in the background')
+
+def get_stats():
+    '''
+    Return the enrichment queue depth, alerts waiting to be retried and the
+    last reconcile's results.
+    '''
+    stats = {'queued': _queue.qsize(), 'retrying': len(_retries)}
+    if _last_reconcile is not None:
+        stats['last_reconcile'] = dict(_last_reconcile,
+                                       seconds_ago=round(time.time() - _last_reconcile['time'], 3))
+        del stats['last_reconcile']['time']
+
+    return stats
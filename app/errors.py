@@ -1,16 +1,27 @@
 '''
 Application error handlers.
 '''
+from app import metrics
 from flask import Blueprint, jsonify
 import logging
 
 _logger = logging.getLogger(__name__)
 
+EXCEPTIONS = metrics.Counter(
+    'threatstack_to_s3_exceptions_total',
+    'Exceptions logged, by type.',
+    ['type']
+)
+
 class AppBaseError(Exception):
     '''
     Base exception class for this service.
+
+    Set details on an instance to include structured error data in the
+    response.
     '''
     status_code = 500
+    details = None
 
 errors = Blueprint('errors', __name__)
 
@@ -29,6 +40,8 @@ def handle_error(error):
             'message': message
         }
     }
+    if error.details is not None:
+        response['error']['details'] = error.details
 
     return jsonify(response), status_code
 
@@ -51,5 +64,6 @@ def log_exception(error):
     '''
     Log our exception.
     '''
+    EXCEPTIONS.inc(type=error.__class__.__name__)
     _logger.exception(error)
 
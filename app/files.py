@@ -0,0 +1,100 @@
+'''
+Helpers for durable local files.
+'''
+import errno
+import os
+import time
+
+def makedirs(path):
+    '''
+    Create a directory and its parents if missing.
+    '''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def fsync_dir(path):
+    '''
+    Flush a directory entry to disk where the platform allows it.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class ClaimQueue(object):
+    '''
+    Files waiting in one directory, claimed for processing by renaming them
+    into another.
+
+    A rename is atomic so each file is claimed by one worker, in whichever
+    process on the host gets to it first.  Claims not touched for
+    claim_timeout seconds are taken to be abandoned by a dead worker.
+    '''
+    def __init__(self, waiting_path, claimed_path, claim_timeout=300):
+        self.waiting_path = waiting_path
+        self.claimed_path = claimed_path
+        self.claim_timeout = claim_timeout
+
+    def claim(self, rename=None):
+        '''
+        Claim the oldest waiting file, by name.
+
+        rename(name), if given, returns the name to claim the file as.
+        Returns the claimed file's name, or None if none are waiting.
+        '''
+        for name in sorted(os.listdir(self.waiting_path)):
+            claimed_name = rename(name) if rename else name
+            claimed_path = os.path.join(self.claimed_path, claimed_name)
+            try:
+                os.rename(os.path.join(self.waiting_path, name), claimed_path)
+            except OSError as e:
+                # Someone else got it first.
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+
+            # Renames keep mtime which we use to find abandoned claims.
+            os.utime(claimed_path, None)
+            return claimed_name
+
+        return None
+
+    def touch(self, name):
+        '''
+        Keep a claimed file from being recovered as abandoned.
+        '''
+        os.utime(os.path.join(self.claimed_path, name), None)
+
+    def recover(self, other_paths=(), exclude=()):
+        '''
+        Return abandoned claims to the waiting directory.
+
+        Files in other_paths, eg. ones a dead process was still writing,
+        are moved too once they have gone claim_timeout seconds without a
+        change.  Names in exclude are left alone.  Returns the names moved.
+        '''
+        recovered = []
+        now = time.time()
+        for dir_path in (self.claimed_path,) + tuple(other_paths):
+            for name in os.listdir(dir_path):
+                if name in exclude:
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    if now - os.path.getmtime(path) > self.claim_timeout:
+                        os.rename(path, os.path.join(self.waiting_path, name))
+                        recovered.append(name)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        return recovered
@@ -0,0 +1,290 @@
+'''
+Adaptive concurrency limits and circuit breakers for our dependencies.
+
+Each dependency, Threat Stack and S3, has a guard per tenant in each
+process, so one tenant's failing bucket or API key doesn't shed calls for
+the others.  Its limiter caps the calls in flight, raising the cap by one per round of fast
+calls and cutting it when calls are slow or fail (AIMD).  Calls that can't
+get a slot within TS_LIMIT_WAIT seconds are shed.  Its circuit breaker
+opens after TS_BREAKER_FAILURES calls in a row fail, failing calls fast for
+TS_BREAKER_RESET seconds before letting one call through to test the
+dependency again.
+
+Shed and rejected calls raise DependencyUnavailableError.
+'''
+from app import metrics
+from app.errors import AppBaseError
+from contextlib import contextmanager
+import config
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+GUARD_REJECTIONS = metrics.Counter(
+    'threatstack_to_s3_guard_rejections_total',
+    'Dependency calls failed fast by a concurrency limit or open circuit.',
+    ['dependency', 'reason']
+)
+
+TS_LIMIT_WAIT = config.TS_LIMIT_WAIT
+TS_BREAKER_FAILURES = config.TS_BREAKER_FAILURES
+TS_BREAKER_RESET = config.TS_BREAKER_RESET
+
+# Limit multipliers for slow and failed calls.
+SLOW_DECREASE = 0.9
+FAILURE_DECREASE = 0.5
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# HTTP statuses meaning the dependency is failing or overloaded.
+FAILURE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class DependencyUnavailableError(AppBaseError):
+    '''
+    A dependency call was shed or its circuit is open.
+    '''
+    status_code = 503
+
+class AdaptiveLimiter(object):
+    '''
+    Concurrency limit adjusted to observed latency.
+
+    The limit grows by one for every limit calls faster than
+    latency_target, and shrinks when calls are slow or fail.  A max_limit
+    of 0 means no limit.
+    '''
+    def __init__(self, max_limit, latency_target, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout):
+        '''
+        Wait up to timeout seconds for a slot.  Returns whether we got one.
+        '''
+        with self._condition:
+            if self.max_limit:
+                deadline = time.time() + timeout
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            self.in_flight += 1
+
+        return True
+
+    def release(self, latency, ok):
+        '''
+        Free a slot and adjust the limit for a call's outcome.
+        '''
+        with self._condition:
+            self.in_flight -= 1
+            if self.max_limit:
+                if not ok:
+                    self.limit = max(self.min_limit, self.limit * FAILURE_DECREASE)
+                elif latency > self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * SLOW_DECREASE)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            'limit': int(self.limit) if self.max_limit else None,
+            'in_flight': self.in_flight
+        }
+
+class CircuitBreaker(object):
+    '''
+    Fail fast after failure_threshold failures in a row.
+
+    A failure_threshold of 0 never opens the circuit.
+    '''
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Return whether a call may go ahead.
+
+        Once reset_timeout has passed one call is let through to test the
+        dependency.  Others fail fast until it finishes.
+        '''
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                return True
+
+            return False
+
+    def record(self, ok):
+        '''
+        Record a call's outcome.
+        '''
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.state = CLOSED
+                return
+
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.failure_threshold and
+                                           self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    def stats(self):
+        stats = {'state': self.state, 'failures': self.failures}
+        if self.state != CLOSED:
+            stats['open_seconds'] = round(time.time() - self.opened_at, 3)
+
+        return stats
+
+class Guard(object):
+    '''
+    The limiter and circuit breaker for one tenant's calls to a dependency.
+    '''
+    def __init__(self, name, tenant_name, max_in_flight, latency_target):
+        self.name = name
+        self.tenant_name = tenant_name
+        self.limiter = AdaptiveLimiter(max_in_flight, latency_target)
+        self.breaker = CircuitBreaker(TS_BREAKER_FAILURES, TS_BREAKER_RESET)
+
+    def acquire(self):
+        '''
+        Start a call.  Returns its start time for release().
+
+        Raises DependencyUnavailableError if the call is shed.
+        '''
+        if not self.breaker.allow():
+            GUARD_REJECTIONS.inc(dependency=self.name, reason='circuit_open')
+            raise DependencyUnavailableError('{} circuit is open'.format(self))
+
+        if not self.limiter.acquire(TS_LIMIT_WAIT):
+            GUARD_REJECTIONS.inc(dependency=self.name, reason='limit')
+            # A half open probe that never ran mustn't hold the circuit.
+            if self.breaker.state == HALF_OPEN:
+                self.breaker.record(False)
+            raise DependencyUnavailableError('Too many {} calls in flight'.format(self))
+
+        return time.time()
+
+    def release(self, started, ok):
+        '''
+        Finish a call started at started.
+        '''
+        self.limiter.release(time.time() - started, ok)
+        state = self.breaker.state
+        self.breaker.record(ok)
+        if self.breaker.state != state:
+            _logger.warning('{} circuit is {}'.format(self, self.breaker.state))
+
+    @contextmanager
+    def call(self):
+        '''
+        Guard the calls in a with block.
+
+        Exceptions count as failures.  Call fail() on the result to count a
+        failure without raising.
+        '''
+        outcome = _Outcome()
+        started = self.acquire()
+        try:
+            yield outcome
+        except Exception:
+            outcome.ok = False
+            raise
+        finally:
+            self.release(started, outcome.ok)
+
+    def __str__(self):
+        if self.tenant_name is None:
+            return self.name
+        return '{} ({})'.format(self.name, self.tenant_name)
+
+    def stats(self):
+        '''
+        Return limiter and circuit breaker state.
+        '''
+        return {
+            'limiter': self.limiter.stats(),
+            'breaker': self.breaker.stats()
+        }
+
+class _Outcome(object):
+    def __init__(self):
+        self.ok = True
+
+    def fail(self):
+        self.ok = False
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+def get_guard(name, tenant_name, max_in_flight, latency_target):
+    '''
+    Return a tenant's guard for a dependency, creating it if needed.
+    '''
+    key = (name, tenant_name)
+    guard = _guards.get(key)
+    if guard is None:
+        with _guards_lock:
+            guard = _guards.get(key)
+            if guard is None:
+                guard = Guard(name, tenant_name, max_in_flight, latency_target)
+                _guards[key] = guard
+
+    return guard
+
+def get_stats(tenant_name=None):
+    '''
+    Return the state of a tenant's guards by dependency.
+    '''
+    return dict((name, guard.stats()) for (name, guard_tenant_name), guard in list(_guards.items())
+                if guard_tenant_name == tenant_name)
+
+def _before_aws_call(guard, context, **kwargs):
+    try:
+        context['guard_started'] = guard.acquire()
+    except DependencyUnavailableError as e:
+        # The call never happens so end its trace span here.
+        trace_span = context.get('trace_span')
+        if trace_span is not None:
+            trace_span.finish(e)
+        raise
+
+def _after_aws_call(guard, http_response, context, **kwargs):
+    started = context.pop('guard_started', None)
+    if started is not None:
+        guard.release(started, http_response.status_code not in FAILURE_STATUS_CODES)
+
+def _after_aws_call_error(guard, context, **kwargs):
+    started = context.pop('guard_started', None)
+    if started is not None:
+        guard.release(started, False)
+
+def instrument_client(client, guard):
+    '''
+    Guard every call made with a boto3 client.
+    '''
+    events = client.meta.events
+    # before-call runs right before the request is sent, so a call that
+    # fails earlier, eg. on invalid parameters, never takes a slot.
+    events.register('before-call', lambda **kwargs: _before_aws_call(guard, **kwargs))
+    events.register('after-call', lambda **kwargs: _after_aws_call(guard, **kwargs))
+    events.register('after-call-error', lambda **kwargs: _after_aws_call_error(guard, **kwargs))
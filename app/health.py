@@ -0,0 +1,139 @@
+'''
+Cached dependency health for /status.
+
+Checking S3 and Threat Stack on every /status request turns load balancer
+health checks into real API traffic that counts against Threat Stack's rate
+limits.  Instead a background prober checks every tenant's dependencies
+every TS_STATUS_INTERVAL seconds, give or take STATUS_JITTER so instances
+don't probe in step, and /status serves the last result with its age.
+
+A result older than TS_STATUS_MAX_AGE, eg. when the prober is off as it is
+on Lambda, is refreshed by the request that finds it.  Only one request
+per tenant probes at a time; the others wait for its result.
+'''
+from app import guards, metrics, tenants
+from app.errors import log_exception
+import app.models.s3 as s3_model
+import app.models.threatstack as threatstack_model
+import config
+import logging
+import random
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+STATUS_PROBES = metrics.Counter(
+    'threatstack_to_s3_status_probes_total',
+    'Dependency health checks made for /status.',
+    ['dependency', 'result']
+)
+
+TS_STATUS_INTERVAL = config.TS_STATUS_INTERVAL
+TS_STATUS_MAX_AGE = config.TS_STATUS_MAX_AGE
+
+# Fraction of TS_STATUS_INTERVAL probes are spread over either side.
+STATUS_JITTER = 0.2
+
+PROBES = (
+    ('s3', s3_model.is_available),
+    ('threatstack', threatstack_model.is_available)
+)
+
+_results = {}
+_locks = {}
+_locks_lock = threading.Lock()
+_prober = None
+
+def _get_lock(tenant):
+    '''
+    Return the lock serializing probes of a tenant.
+    '''
+    lock = _locks.get(tenant.name)
+    if lock is None:
+        with _locks_lock:
+            lock = _locks.setdefault(tenant.name, threading.Lock())
+
+    return lock
+
+def _probe_dependency(name, is_available):
+    '''
+    Return the health of one dependency of the current tenant.
+    '''
+    # /status is public so only the type of error is reported.  The error
+    # itself, which may name endpoints, is logged.
+    try:
+        result = {'success': bool(is_available())}
+    except guards.DependencyUnavailableError as e:
+        # An open circuit is reported rather than logged.
+        result = {'success': False, 'error': e.__class__.__name__}
+    except Exception as e:
+        log_exception(e)
+        result = {'success': False, 'error': e.__class__.__name__}
+
+    STATUS_PROBES.inc(dependency=name, result='success' if result['success'] else 'failure')
+
+    return result
+
+def probe(tenant):
+    '''
+    Check a tenant's dependencies now and cache the result.
+    '''
+    with tenants.using(tenant):
+        result = dict((name, _probe_dependency(name, is_available)) for name, is_available in PROBES)
+    result['checked_at'] = time.time()
+    _results[tenant.name] = result
+
+    return result
+
+def get_status(tenant=None):
+    '''
+    Return the cached health of a tenant's dependencies, default the
+    current tenant.
+
+    Each dependency has success and, if its check failed, the type of
+    error.  age is the seconds since the dependencies were checked.
+    '''
+    tenant = tenant or tenants.get_current()
+    result = _results.get(tenant.name)
+    if result is None or time.time() - result['checked_at'] > TS_STATUS_MAX_AGE:
+        with _get_lock(tenant):
+            # Another request may have probed while we waited.
+            result = _results.get(tenant.name)
+            if result is None or time.time() - result['checked_at'] > TS_STATUS_MAX_AGE:
+                result = probe(tenant)
+
+    status = dict((name, dict(result[name])) for name, _ in PROBES)
+    status['age'] = round(time.time() - result['checked_at'], 3)
+
+    return status
+
+def _get_delay():
+    return TS_STATUS_INTERVAL * random.uniform(1 - STATUS_JITTER, 1 + STATUS_JITTER)
+
+def _run_prober():
+    '''
+    Prober loop checking every tenant's dependencies.
+    '''
+    while True:
+        for tenant in tenants.get_all():
+            try:
+                with _get_lock(tenant):
+                    probe(tenant)
+            except Exception as e:
+                log_exception(e)
+        time.sleep(_get_delay())
+
+def start_prober():
+    '''
+    Start probing dependencies in the background.
+    '''
+    global _prober
+    if _prober is not None:
+        return
+
+    _prober = threading.Thread(target=_run_prober, name='status-prober')
+    _prober.daemon = True
+    _prober.start()
+
+    _logger.info('Probing dependencies every {}s'.format(TS_STATUS_INTERVAL))
@@ -0,0 +1,261 @@
+'''
+Archive alerts from Threat Stack webhooks.
+
+In sync mode webhooks are archived while the request waits.  In async mode
+webhooks are written to a local spool and acknowledged right away, and
+background workers drain the spool.
+'''
+from app import concurrency, dedup, enrichment, guards, metrics, tenants, tracing, wal
+from app.errors import AppBaseError, log_exception
+import app.models.threatstack as threatstack_model
+from app.spool import Spool
+import config
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+WEBHOOK_ONLY_ALERTS = metrics.Counter(
+    'threatstack_to_s3_webhook_only_alerts_total',
+    'Alerts archived without their details because Threat Stack was unavailable.'
+)
+
+TS_INGEST_MODE = config.TS_INGEST_MODE
+TS_INGEST_SPOOL_DIR = config.TS_INGEST_SPOOL_DIR
+TS_INGEST_WORKERS = config.TS_INGEST_WORKERS
+TS_INGEST_MAX_ATTEMPTS = config.TS_INGEST_MAX_ATTEMPTS
+TS_WEBHOOK_ONLY_FALLBACK = config.TS_WEBHOOK_ONLY_FALLBACK
+
+# Seconds an idle worker waits before checking the spool again.  Workers in
+# this process are woken sooner when a webhook is spooled.
+POLL_INTERVAL = 1.0
+MAX_RETRY_DELAY = 60
+
+# Seconds between checks for claims abandoned by workers that died, eg.
+# killed by gunicorn's timeout.
+RECOVER_INTERVAL = 60
+
+_spool = None
+_spool_lock = threading.Lock()
+_wakeup = threading.Event()
+_workers = []
+_last_recover = 0
+
+class IngestError(AppBaseError):
+    '''
+    One or more alerts in a webhook failed to archive.
+    '''
+    def __init__(self, message, details):
+        super(IngestError, self).__init__(message)
+        self.details = details
+
+def archive_alert(alert, inline=False):
+    '''
+    Fetch an alert's details from Threat Stack and archive both to S3.
+
+    The alert is archived to its organization's tenant.  Alerts already
+    archived are skipped.  Writes S3 fails are logged for replay if the
+    write-ahead log is enabled.  Only the webhook data is archived if
+    Threat Stack calls are being shed and TS_WEBHOOK_ONLY_FALLBACK is set.
+    With deferred enrichment the details are fetched after we return.
+
+    With inline the details are always fetched before we return, or the
+    alert fails, for callers like backfill that run no enrichment workers.
+    '''
+    tenant = tenants.get_tenant(alert.get('organization_id'))
+    with tenants.using(tenant), tenant.limit(), tracing.span('archive_alert', id=alert.get('id')):
+        digest = dedup.get_digest(alert)
+        if dedup.is_archived(alert, digest):
+            return None
+
+        if enrichment.is_deferred() and not inline:
+            wal.write('webhook', alert)
+            enrichment.enqueue(alert)
+            dedup.add(alert, digest)
+            return None
+
+        try:
+            alert_full = threatstack_model.get_alert_by_id(alert.get('id'))
+        except guards.DependencyUnavailableError as e:
+            if inline or not TS_WEBHOOK_ONLY_FALLBACK:
+                raise
+            # Not added to dedup so a redelivery still fetches the details.
+            _logger.warning('Archiving webhook data only for alert {}: {}'.format(alert.get('id'), e))
+            wal.write('webhook', alert)
+            WEBHOOK_ONLY_ALERTS.inc()
+            # Reads fetch the details if the batch worker hasn't by then.
+            if enrichment.is_running():
+                enrichment.enqueue(alert)
+            return None
+
+        # The two writes are independent of each other.
+        concurrency.map(
+            lambda put: put(),
+            [lambda: wal.write('webhook', alert),
+             lambda: wal.write('alert', alert_full)],
+            2
+        )
+        dedup.add(alert, digest)
+
+    return None
+
+def _archive_alert_or_error(alert):
+    '''
+    Archive an alert and return a description of any failure.
+    '''
+    try:
+        archive_alert(alert)
+    except AppBaseError as e:
+        log_exception(e)
+        return {
+            'id': alert.get('id'),
+            'type': e.__class__.__name__,
+            'message': [str(x) for x in e.args]
+        }
+    except Exception as e:
+        log_exception(e)
+        return {
+            'id': alert.get('id'),
+            'type': 'UnexpectedException',
+            'message': 'An unexpected error has occurred.'
+        }
+
+    return None
+
+def archive_webhook(webhook_data):
+    '''
+    Archive every alert in a webhook.
+
+    Alerts are archived concurrently, up to the smallest alert_concurrency
+    of the tenants involved.  Every alert is attempted and the failures are
+    raised together.
+    '''
+    alerts = webhook_data.get('alerts')
+    alert_concurrency = min(
+        tenants.get_tenant(alert.get('organization_id')).alert_concurrency
+        for alert in alerts
+    )
+    results = concurrency.map(_archive_alert_or_error, alerts, alert_concurrency)
+
+    failures = [result for result in results if result]
+    if failures:
+        msg = '{} of {} alerts failed to archive'.format(len(failures), len(alerts))
+        raise IngestError(msg, failures)
+
+    return None
+
+def is_async():
+    '''
+    Return whether webhooks are spooled rather than archived inline.
+    '''
+    return TS_INGEST_MODE == 'async'
+
+def get_spool():
+    '''
+    Return the ingest spool, creating it if needed.
+    '''
+    global _spool
+    if _spool is None:
+        with _spool_lock:
+            if _spool is None:
+                _spool = Spool(TS_INGEST_SPOOL_DIR,
+                               max_attempts=TS_INGEST_MAX_ATTEMPTS)
+
+    return _spool
+
+def enqueue_webhook(webhook_data):
+    '''
+    Spool a validated webhook for the background workers.
+
+    Alerts this process has already archived aren't spooled.  Returns the
+    spool record name, or None if there was nothing left to spool.
+    '''
+    alerts = [alert for alert in webhook_data.get('alerts')
+              if not dedup.is_archived(alert, dedup.get_digest(alert), local_only=True)]
+    if not alerts:
+        return None
+
+    webhook_data = dict(webhook_data, alerts=alerts)
+    name = get_spool().put(webhook_data)
+    _wakeup.set()
+
+    return name
+
+def _recover_spool(spool):
+    '''
+    Return abandoned claims to the spool every RECOVER_INTERVAL seconds.
+    '''
+    global _last_recover
+    if time.time() - _last_recover >= RECOVER_INTERVAL:
+        _last_recover = time.time()
+        spool.recover()
+
+def _drain_spool():
+    '''
+    Worker loop archiving spooled webhooks.
+    '''
+    spool = get_spool()
+    while True:
+        try:
+            _recover_spool(spool)
+            record = spool.claim()
+        except Exception as e:
+            log_exception(e)
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        if record is None:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+
+        try:
+            archive_webhook(record.data)
+            archived = True
+        except Exception as e:
+            log_exception(e)
+            archived = False
+
+        try:
+            if archived:
+                spool.ack(record)
+            else:
+                spool.release(record)
+        except Exception as e:
+            # The claim is recovered once it has been abandoned long enough.
+            log_exception(e)
+
+        if not archived:
+            # Don't spin on a dependency that is down.
+            time.sleep(min(2 ** record.attempt, MAX_RETRY_DELAY))
+
+def start_workers():
+    '''
+    Start background workers draining the spool.
+    '''
+    while len(_workers) < TS_INGEST_WORKERS:
+        worker = threading.Thread(target=_drain_spool, name='ingest-worker')
+        worker.daemon = True
+        worker.start()
+        _workers.append(worker)
+
+    _logger.info('Started {} ingest workers'.format(len(_workers)))
+
+def get_status():
+    '''
+    Return ingest mode, worker and spool state.
+    '''
+    status = {'mode': TS_INGEST_MODE}
+    dedup_stats = dedup.get_stats()
+    if dedup_stats is not None:
+        status['dedup'] = dedup_stats
+    if is_async():
+        status['workers'] = len([w for w in _workers if w.is_alive()])
+        status['queue'] = get_spool().stats()
+    if wal.is_enabled():
+        status['wal'] = wal.get_stats()
+    if enrichment.is_running():
+        status['enrichment'] = enrichment.get_stats()
+
+    return status
@@ -0,0 +1,279 @@
+'''
+Prometheus metrics.
+
+Counters and histograms are kept in process memory.  Recording is a dict
+update under a lock so it is cheap enough for hot paths, and the lock is a
+greenlet lock under gevent.
+
+gunicorn runs several worker processes and a scrape reaches only one of
+them.  When TS_METRICS_DIR is set each process writes a snapshot of its
+metrics there every TS_METRICS_INTERVAL seconds and at exit, and a scrape
+adds up every process's latest snapshot.  Snapshots of exited workers are
+kept so counters don't go backwards; clear the directory when the service
+starts.  Without TS_METRICS_DIR a scrape reports only its own process,
+which is right for Lambda and single process servers.
+'''
+from collections import OrderedDict
+from contextlib import contextmanager
+import atexit
+import config
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+TS_METRICS_DIR = config.TS_METRICS_DIR
+TS_METRICS_INTERVAL = config.TS_METRICS_INTERVAL
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = OrderedDict()
+_writer = None
+_writer_lock = threading.Lock()
+
+class _Metric(object):
+    '''
+    A named metric with a value per combination of label values.
+    '''
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics[name] = self
+
+    def _get_key(self, labels):
+        return tuple(str(labels.get(l, '')) for l in self.labelnames)
+
+    def snapshot(self):
+        '''
+        Return this metric's definition and values as JSON data.
+        '''
+        with self._lock:
+            samples = [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'labelnames': list(self.labelnames),
+            'samples': samples
+        }
+
+class Counter(_Metric):
+    '''
+    A count that only goes up.
+    '''
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''
+        Add amount to the count for these labels.
+        '''
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+class Histogram(_Metric):
+    '''
+    A distribution of observed values, usually durations in seconds.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        '''
+        Record a value for these labels.
+        '''
+        key = self._get_key(labels)
+        with self._lock:
+            # Per bucket counts followed by the sum.  Cumulated on output.
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Record the duration of a with block, whether or not it raises.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    def snapshot(self):
+        snapshot = super(Histogram, self).snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+def timed(histogram, errors=None, **labels):
+    '''
+    Decorate a function to record its duration, and exceptions in errors.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if errors is not None:
+                        errors.inc(type=e.__class__.__name__, **labels)
+                    raise
+        return wrapper
+    return decorator
+
+def snapshot():
+    '''
+    Return a snapshot of every metric in this process.
+    '''
+    return OrderedDict((name, metric.snapshot()) for name, metric in _metrics.items())
+
+def _get_snapshot_path(pid):
+    return os.path.join(TS_METRICS_DIR, '{}.json'.format(pid))
+
+def write_snapshot():
+    '''
+    Write this process's snapshot to TS_METRICS_DIR.
+    '''
+    path = _get_snapshot_path(os.getpid())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot(), f)
+    os.rename(tmp_path, path)
+
+def _read_snapshots():
+    '''
+    Return snapshots of every process, this one up to date.
+    '''
+    write_snapshot()
+
+    snapshots = []
+    for name in os.listdir(TS_METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(TS_METRICS_DIR, name)) as f:
+                snapshots.append(json.load(f))
+        except (IOError, OSError, ValueError) as e:
+            # Being replaced or left half written by a killed worker.
+            _logger.debug('Skipping metrics snapshot {}: {}'.format(name, e))
+
+    return snapshots
+
+def _merge_snapshots(snapshots):
+    '''
+    Add up snapshots from several processes.
+    '''
+    merged = OrderedDict()
+    for process_snapshot in snapshots:
+        for name, metric in process_snapshot.items():
+            merged_metric = merged.setdefault(name, dict(metric, samples=OrderedDict()))
+            for key, value in metric['samples']:
+                key = tuple(key)
+                if metric['type'] == 'histogram':
+                    total = merged_metric['samples'].get(key, [0] * len(value))
+                    merged_metric['samples'][key] = [a + b for a, b in zip(total, value)]
+                else:
+                    merged_metric['samples'][key] = merged_metric['samples'].get(key, 0) + value
+
+    for metric in merged.values():
+        metric['samples'] = list(metric['samples'].items())
+
+    return merged
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(n, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for n, v in pairs) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    '''
+    Return metrics in the Prometheus text format.
+    '''
+    if TS_METRICS_DIR:
+        metrics = _merge_snapshots(_read_snapshots())
+    else:
+        metrics = _merge_snapshots([snapshot()])
+
+    lines = []
+    for name, metric in metrics.items():
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        labelnames = metric['labelnames']
+        for key, value in sorted(metric['samples']):
+            if metric['type'] == 'histogram':
+                cumulative = 0
+                bounds = [repr(float(b)) for b in metric['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value[:-1]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labelnames, key, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labelnames, key), _format_value(value[-1])))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labelnames, key), cumulative))
+            else:
+                lines.append('{}{} {}'.format(name, _format_labels(labelnames, key), _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+def _write_snapshots():
+    '''
+    Writer loop saving this process's snapshot.
+    '''
+    while True:
+        time.sleep(TS_METRICS_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception as e:
+            _logger.warning('Unable to write metrics snapshot: {}'.format(e))
+
+def start():
+    '''
+    Start writing snapshots for other processes' scrapes if configured.
+    '''
+    global _writer
+    if not TS_METRICS_DIR:
+        return
+
+    with _writer_lock:
+        if _writer is not None:
+            return
+        if not os.path.isdir(TS_METRICS_DIR):
+            os.makedirs(TS_METRICS_DIR)
+        _writer = threading.Thread(target=_write_snapshots, name='metrics-writer')
+        _writer.daemon = True
+        _writer.start()
+        atexit.register(write_snapshot)
@@ -0,0 +1,98 @@
+'''
+Alert filters and projections.
+
+A query can be evaluated locally or rendered as S3 Select SQL.  Both follow
+S3 Select semantics so results don't depend on where the query runs:
+values are compared as SQL strings, and missing, null and non-scalar values
+never match.
+'''
+import logging
+import six
+
+_logger = logging.getLogger(__name__)
+
+def _to_sql_string(value):
+    '''
+    Return value as CAST(value AS STRING) would, or None if it can't be.
+    '''
+    # bool is an int so check it first.
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.integer_types):
+        return str(value)
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    if isinstance(value, six.string_types):
+        return value
+
+    return None
+
+def _quote_identifier(name):
+    '''
+    Quote an S3 Select identifier.
+    '''
+    return '"{}"'.format(name.replace('"', '""'))
+
+def _quote_string(value):
+    '''
+    Quote an S3 Select string literal.
+    '''
+    return "'{}'".format(value.replace("'", "''"))
+
+class AlertQuery(object):
+    '''
+    Filters and a projection over alert or webhook JSON documents.
+
+    filters maps a top level field to the set of acceptable string values.
+    A document matches when every filtered field matches one of its values.
+    fields lists the top level fields to return, or is empty for all.
+    '''
+    def __init__(self, filters=None, fields=None):
+        self.filters = filters or {}
+        self.fields = list(fields or [])
+
+    def matches(self, document):
+        '''
+        Return whether a document matches every filter.
+        '''
+        for field, values in self.filters.items():
+            if _to_sql_string(document.get(field)) not in values:
+                return False
+
+        return True
+
+    def project(self, document):
+        '''
+        Return a copy of document with only the projected fields.
+        '''
+        if not self.fields:
+            return document
+
+        return dict((f, document[f]) for f in self.fields if f in document)
+
+    def to_sql(self, fields=None):
+        '''
+        Return the S3 Select expression for this query.
+
+        fields overrides the projected fields.
+        '''
+        fields = self.fields if fields is None else fields
+        if fields:
+            select = ', '.join('s.' + _quote_identifier(f) for f in fields)
+        else:
+            select = '*'
+
+        expression = 'SELECT {} FROM S3Object s'.format(select)
+
+        conditions = []
+        for field in sorted(self.filters):
+            values = ', '.join(_quote_string(v) for v in sorted(self.filters[field]))
+            conditions.append('CAST(s.{} AS STRING) IN ({})'.format(
+                _quote_identifier(field), values))
+
+        if conditions:
+            expression += ' WHERE ' + ' AND '.join(conditions)
+
+        return expression
@@ -1,29 +1,239 @@
 '''
 AWS S3 communication
 '''
-from app.errors import AppBaseError
-import boto3
+from app import clients, concurrency, metrics, serializer, tenants
+from app.cache import LRUCache
+from app.errors import AppBaseError, log_exception
+from app.models.query import AlertQuery
+import atexit
+import calendar
+import collections
 from botocore.exceptions import ClientError
 from botocore.vendored.requests.exceptions import RequestException
 import config
 import datetime
+import gzip
+import hashlib
 from iso8601 import UTC
+import itertools
 import json
 import logging
+import re
 import six
 import sys
+import threading
 import time
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 _logger = logging.getLogger(__name__)
 
-TS_AWS_S3_BUCKET = config.TS_AWS_S3_BUCKET
-TS_AWS_S3_PREFIX = config.TS_AWS_S3_PREFIX
+S3_REQUEST_SECONDS = metrics.Histogram(
+    'threatstack_to_s3_s3_request_seconds',
+    'S3 request latency by operation.',
+    ['operation']
+)
+S3_REQUEST_ERRORS = metrics.Counter(
+    'threatstack_to_s3_s3_request_errors_total',
+    'Failed S3 requests by operation and error.',
+    ['operation', 'type']
+)
+S3_LIST_PAGES = metrics.Counter(
+    'threatstack_to_s3_s3_list_pages_total',
+    'Pages of objects fetched by listings.'
+)
+S3_LISTED_OBJECTS = metrics.Counter(
+    'threatstack_to_s3_s3_listed_objects_total',
+    'Objects returned by listings.'
+)
+WEBHOOK_LISTING_SECONDS = metrics.Histogram(
+    'threatstack_to_s3_webhook_listing_seconds',
+    'Time a date range query spent finding its webhooks, by source.',
+    ['source']
+)
+ALERT_READ_SECONDS = metrics.Histogram(
+    'threatstack_to_s3_alert_read_seconds',
+    'Time to read an archived alert by ID.'
+)
+ALERT_READS = metrics.Counter(
+    'threatstack_to_s3_alert_reads_total',
+    'Archived alerts read by ID, by where they were found.',
+    ['source']
+)
+
+TS_S3_INDEX_WRITES = config.TS_S3_INDEX_WRITES
+TS_S3_INDEX_READS = config.TS_S3_INDEX_READS
+TS_S3_INDEX_FLUSH_MAX_AGE = config.TS_S3_INDEX_FLUSH_MAX_AGE
+TS_S3_SEGMENTS = config.TS_S3_SEGMENTS
+TS_S3_SEGMENT_MAX_BYTES = config.TS_S3_SEGMENT_MAX_BYTES
+TS_S3_SEGMENT_MAX_AGE = config.TS_S3_SEGMENT_MAX_AGE
+TS_S3_SEGMENT_COMPRESSION = config.TS_S3_SEGMENT_COMPRESSION
+TS_S3_LOCATOR_CACHE_RECHECK = config.TS_S3_LOCATOR_CACHE_RECHECK
+TS_ALERT_CACHE = config.TS_ALERT_CACHE
+TS_S3_SELECT = config.TS_S3_SELECT
+
+WEBHOOK_TIME_PATH_FORMAT = '%Y/%m/%d/%H/%M'
+
+# Webhook fields alerts can be filtered on.  These are kept in the hourly
+# indexes so filtering doesn't need the webhook records.
+FILTER_FIELDS = ('severity', 'source', 'organization_id', 'server_or_region')
+INDEX_TIME_PATH_FORMAT = '%Y/%m/%d/%H'
+
+# Index entries a shard holds before its writer starts a new one, and
+# seconds a shard may sit unwritten before its writer starts a new one
+# rather than adding to it.
+INDEX_SHARD_MAX_ENTRIES = 1000
+INDEX_SHARD_MAX_IDLE = 300
+
+# Index entries waiting to be written before a writer writes them without
+# waiting for TS_S3_INDEX_FLUSH_MAX_AGE.
+INDEX_FLUSH_MAX_ENTRIES = 100
+
+# Hours each writer keeps a shard open for.
+INDEX_OPEN_HOURS = 24
+
+# Seconds since a shard was last written before rebuilding its hour may
+# delete it.  Well past INDEX_SHARD_MAX_IDLE so no writer is still adding
+# to it.
+INDEX_SHARD_DELETE_AFTER = 3600
+
+SEGMENT_EXTENSIONS = {
+    'gzip': '.ndjson.gz',
+    'zstd': '.ndjson.zst'
+}
+
+# Threat Stack alert IDs are Mongo ObjectIds which start with the time they
+# were created.  That lets us find an alert's segment locator from its ID.
+OBJECT_ID_RE = re.compile('^[0-9a-f]{24}$')
+
+# Seconds after an hour ends that its locator is still likely to be
+# written to by alerts of that hour arriving late.
+LOCATOR_SETTLE_SECONDS = 3600
+
+# Max locators cached and seconds before a cached one is read in full again.
+LOCATOR_CACHE_MAX_ENTRIES = 1000
+LOCATOR_CACHE_TTL = 3600
+
+# Seconds the time in an alert's ID may be from its created_at.
+WEBHOOK_ID_TIME_SLACK = 60
+
+# Errors meaning S3 Select isn't available to us.
+SELECT_UNSUPPORTED_ERROR_CODES = ('MethodNotAllowed', 'NotImplemented', 'XNotImplemented')
+
+# Errors that will fail however often the request is retried, until someone
+# fixes the bucket, its policy or our credentials.
+PERMANENT_ERROR_CODES = (
+    'AccessDenied',
+    'AccountProblem',
+    'AllAccessDisabled',
+    'InvalidAccessKeyId',
+    'InvalidArgument',
+    'InvalidBucketName',
+    'InvalidRequest',
+    'NoSuchBucket',
+    'SignatureDoesNotMatch'
+)
+
+# Index shards are named for the process writing them.
+_index_writer_id = uuid.uuid4().hex
+_index_shard_count = itertools.count()
+_index_writers = {}
+_index_writer_lock = threading.Lock()
+
+_segment_writers = {}
+_segment_writer_lock = threading.Lock()
+
+# Set False once S3 tells us Select isn't available.
+_select_supported = True
+
+# Archived alerts never change so they can be cached for as long as we have
+# room.
+_alert_cache = None
+if TS_ALERT_CACHE:
+    _alert_cache = LRUCache(config.TS_ALERT_CACHE_MAX_ENTRIES,
+                            config.TS_ALERT_CACHE_MAX_BYTES,
+                            config.TS_ALERT_CACHE_TTL)
+
+# Locator shards never change once written so cached entries can be
+# trusted for the alerts they list.
+_locator_cache = LRUCache(LOCATOR_CACHE_MAX_ENTRIES,
+                          config.TS_S3_LOCATOR_CACHE_MAX_BYTES,
+                          LOCATOR_CACHE_TTL)
 
 class S3ClientError(AppBaseError):
     '''
     S3 client communication errors.
     '''
 
+def _get_bucket():
+    '''
+    Return the current tenant's bucket.
+    '''
+    return tenants.get_current().bucket
+
+def _get_prefix():
+    '''
+    Return the current tenant's key prefix.
+    '''
+    return tenants.get_current().prefix
+
+def _get_s3_concurrency():
+    '''
+    Return the current tenant's limit on concurrent S3 requests per request.
+    '''
+    return tenants.get_current().s3_concurrency
+
+def _get_s3_client():
+    '''
+    Return the current tenant's S3 client.
+    '''
+    tenant = tenants.get_current()
+    return clients.get_client('s3', tenant.name, tenant.pool_connections)
+
+def initialize():
+    '''
+    Create the current tenant's S3 client ahead of its first use.
+    '''
+    _get_s3_client()
+
+def _get_cache_key(alert_id):
+    '''
+    Return the cache key of an alert.  Tenants never share cached alerts.
+    '''
+    return (tenants.get_current().name, alert_id)
+
+def _get_client_error_code(error):
+    '''
+    Return the S3 error code from a botocore ClientError.
+    '''
+    return error.response.get('Error', {}).get('Code')
+
+def is_permanent_error(error):
+    '''
+    Return whether an S3ClientError will recur however often the request
+    is retried.
+    '''
+    client_error = error.args[0] if error.args else None
+    if not isinstance(client_error, ClientError):
+        return False
+
+    return _get_client_error_code(client_error) in PERMANENT_ERROR_CODES
+
+def _reraise_s3_client_error():
+    '''
+    Re-raise the exception being handled as an S3ClientError.
+    '''
+    exc_info = sys.exc_info()
+    if isinstance(exc_info[1], ClientError):
+        error = S3ClientError(exc_info[1])
+    else:
+        error = S3ClientError('Failure to communicate with S3')
+    six.reraise(S3ClientError, error, exc_info[2])
+
 def _get_alert_data_key(alert_id):
     '''
     Takes an alert ID and returns an S3 key path.
@@ -34,35 +244,52 @@ def _get_alert_data_key(alert_id):
                           alert_id
                           ])
 
-    if TS_AWS_S3_PREFIX:
-        alert_key = '/'.join([TS_AWS_S3_PREFIX, alert_key])
+    prefix = _get_prefix()
+    if prefix:
+        alert_key = '/'.join([prefix, alert_key])
 
     return alert_key
 
-def _get_bucket_objects(prefix=None):
+@metrics.timed(S3_REQUEST_SECONDS, S3_REQUEST_ERRORS, operation='list_objects_v2')
+def _list_objects(s3_client, params):
+    '''
+    Fetch one page of a listing.
+    '''
+    response = s3_client.list_objects_v2(**params)
+    S3_LIST_PAGES.inc()
+    S3_LISTED_OBJECTS.inc(response.get('KeyCount', len(response.get('Contents', []))))
+
+    return response
+
+def _iter_bucket_objects(prefix=None, start_after=None):
     '''
-    Return a list of S3 objects under a given prefix.
+    Yield S3 objects under a given prefix, one page at a time.
+
+    Listing starts after the key start_after when given.  Stopping iteration
+    early saves fetching the remaining pages.
     '''
     # We can only get 1000 objects at a time.  Also, list_objects() was not
     # returning a Marker on truncated responses so using list_objects_v2()
     # here instead.
-    objects = []
     client_continuation_token = ''
 
-    s3_client = boto3.client('s3')
+    s3_client = _get_s3_client()
     while True:
         list_object_params = {
-            'Bucket': TS_AWS_S3_BUCKET,
+            'Bucket': _get_bucket(),
         }
 
         if prefix:
             list_object_params['Prefix'] = prefix
 
+        if start_after:
+            list_object_params['StartAfter'] = start_after
+
         if client_continuation_token:
             list_object_params['ContinuationToken'] = client_continuation_token
 
         try:
-            response = s3_client.list_objects_v2(**list_object_params)
+            response = _list_objects(s3_client, list_object_params)
         except ClientError as e:
             exc_info = sys.exc_info()
             if sys.version_info >= (3,0,0):
@@ -76,7 +303,9 @@ def _get_bucket_objects(prefix=None):
             else:
                 six.reraise(S3ClientError, S3ClientError('Failure to communicate with S3'), exc_info[2])
 
-        objects += response.get('Contents')
+        # Contents is absent when nothing matches.
+        for obj in response.get('Contents', []):
+            yield obj
 
         # Break if response tells us there is no more.
         if response.get('IsTruncated'):
@@ -84,28 +313,904 @@ def _get_bucket_objects(prefix=None):
         else:
             break
 
-    return objects
+def _get_webhook_minute_bounds(start, end):
+    '''
+    Return the first and last webhook minutes strictly between start and end.
+    '''
+    one_minute = datetime.timedelta(minutes=1)
+
+    # Keys are in UTC so do our arithmetic there too.
+    start = start.astimezone(UTC)
+    end = end.astimezone(UTC)
+
+    first = start.replace(second=0, microsecond=0) + one_minute
+    last = end.replace(second=0, microsecond=0)
+    if last == end:
+        last -= one_minute
+
+    return first, last
+
+def _plan_webhook_time_ranges(start, end):
+    '''
+    Return the smallest set of webhook key ranges covering start to end.
+
+    Webhook keys are stored by minute so only minutes strictly after start
+    and strictly before end can match.  Those minutes are covered by whole
+    day and hour prefixes where possible.  Partial hours at either edge are
+    returned as an hour prefix with the first and last minute to include.
+    Each range is a (time_prefix, first_minute, last_minute) tuple where the
+    minutes are webhook time paths, or None when the whole prefix is wanted.
+    Ranges are returned in key order.
+    '''
+    one_minute = datetime.timedelta(minutes=1)
+    one_hour = datetime.timedelta(hours=1)
+    one_day = datetime.timedelta(days=1)
+
+    first, last = _get_webhook_minute_bounds(start, end)
+
+    ranges = []
+    cursor = first
+    while cursor <= last:
+        if cursor.hour == 0 and cursor.minute == 0 and cursor + one_day - one_minute <= last:
+            ranges.append((cursor.strftime('%Y/%m/%d'), None, None))
+            cursor += one_day
+        elif cursor.minute == 0 and cursor + one_hour - one_minute <= last:
+            ranges.append((cursor.strftime('%Y/%m/%d/%H'), None, None))
+            cursor += one_hour
+        else:
+            hour_start = cursor.replace(minute=0)
+            hour_last = hour_start + one_hour - one_minute
+            first_minute = None
+            last_minute = None
+            if cursor != hour_start:
+                first_minute = cursor.strftime(WEBHOOK_TIME_PATH_FORMAT)
+            if last < hour_last:
+                last_minute = last.strftime(WEBHOOK_TIME_PATH_FORMAT)
+            ranges.append((hour_start.strftime('%Y/%m/%d/%H'), first_minute, last_minute))
+            cursor = hour_start + one_hour
+
+    return ranges
+
+def _iter_webhook_keys_in_range(time_range, after=None):
+    '''
+    Yield webhook keys in a range planned by _plan_webhook_time_ranges().
+
+    Keys are listed lazily so stopping early saves listing the rest.  When
+    after is given only keys after that webhook reference are listed.
+    '''
+    time_prefix, first_minute, last_minute = time_range
+    webhooks_prefix = _get_webhooks_key_prefix()
+
+    prefix = '/'.join([webhooks_prefix, time_prefix, ''])
+    start_after = None
+    if first_minute:
+        # Keys in the first minute sort after the bare minute path.
+        start_after = '/'.join([webhooks_prefix, first_minute])
+
+    if after:
+        after_key = '/'.join([webhooks_prefix, after])
+        if start_after is None or after_key > start_after:
+            start_after = after_key
+
+    for obj in _iter_bucket_objects(prefix, start_after):
+        key = obj.get('Key')
+        if last_minute:
+            webhook_time_prefix = key[len(webhooks_prefix) + 1:].rsplit('/', 1)[0]
+            # Keys are listed in time order so we're done.
+            if webhook_time_prefix > last_minute:
+                break
+        yield key
+
+def _get_webhook_keys_in_range(time_range, after=None):
+    '''
+    Return webhook keys in a range planned by _plan_webhook_time_ranges().
+    '''
+    return list(_iter_webhook_keys_in_range(time_range, after))
+
+def _is_range_before(time_range, after):
+    '''
+    Return whether every key in a planned range sorts before webhook
+    reference after.
+    '''
+    range_prefix = time_range[0] + '/'
+    return after > range_prefix and not after.startswith(range_prefix)
 
 def _get_webhooks_key_prefix():
     '''
     Return key prefix where webhook data is stored.
     '''
-    if TS_AWS_S3_PREFIX:
-        webhooks_prefix = '/'.join([TS_AWS_S3_PREFIX, 'webhooks'])
+    prefix = _get_prefix()
+    if prefix:
+        webhooks_prefix = '/'.join([prefix, 'webhooks'])
     else:
         webhooks_prefix = 'webhooks'
 
     return webhooks_prefix
 
+def _get_webhook_time_path(created_at):
+    '''
+    Return the webhook time path for an alert created_at in milliseconds.
+    '''
+    alert_time = time.gmtime(created_at/1000)
+    return time.strftime(WEBHOOK_TIME_PATH_FORMAT, alert_time)
+
+def _get_index_shard_prefix(hour_path):
+    '''
+    Return the key prefix of an hour's index shards.
+    '''
+    return _add_key_prefix('/'.join(['index', hour_path, '']))
+
+def _get_index_shard_key(hour_path):
+    '''
+    Return a new index shard key for an hour.
+    '''
+    shard_name = '{}-{}.json.gz'.format(_index_writer_id, next(_index_shard_count))
+    return _get_index_shard_prefix(hour_path) + shard_name
+
+def _get_index_entry(alert):
+    '''
+    Return the index entry for webhook alert data.
+    '''
+    entry = {
+        'created_at': alert.get('created_at'),
+        'id': alert.get('id')
+    }
+    for field in FILTER_FIELDS:
+        entry[field] = alert.get(field)
+
+    return entry
+
+def _get_index_entry_sort_key(entry):
+    '''
+    Sort index entries the same way their webhook keys are listed.
+    '''
+    return (_get_webhook_time_path(entry.get('created_at')), entry.get('id'))
+
+def _read_index_object(key):
+    '''
+    Return the entries of a gzipped JSON index object.
+
+    A missing index has no entries.
+    '''
+    s3_client = _get_s3_client()
+    try:
+        response = s3_client.get_object(Bucket=_get_bucket(), Key=key)
+        body = response.get('Body').read()
+    except ClientError as e:
+        if _get_client_error_code(e) == 'NoSuchKey':
+            return []
+        _reraise_s3_client_error()
+    except RequestException:
+        _reraise_s3_client_error()
+
+    return serializer.loads(gzip.GzipFile(fileobj=six.BytesIO(body)).read())
+
+def _encode_index(entries):
+    '''
+    Return index entries as gzipped JSON.
+    '''
+    index_json = json.dumps(entries, separators=(',', ':')).encode('utf-8')
+    index_body = six.BytesIO()
+    with gzip.GzipFile(fileobj=index_body, mode='wb') as f:
+        f.write(index_json)
+
+    return index_body.getvalue()
+
+def _put_index_object(key, entries):
+    '''
+    Write a gzipped JSON index object, replacing any already there.
+    '''
+    return _put_s3_object(key, _encode_index(entries))
+
+class _IndexShard(object):
+    '''
+    Index entries for one hour that one writer puts in its own object.
+    '''
+    def __init__(self, hour_path):
+        self.key = _get_index_shard_key(hour_path)
+        self.entries = []
+        self.written_at = time.time()
+        self.write_lock = threading.Lock()
+
+class _IndexBatch(object):
+    '''
+    Index entries waiting to be written, by hour.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.size = 0
+        self.flushed = threading.Event()
+        self.error = None
+
+class _IndexWriter(object):
+    '''
+    Add webhooks to hourly index shards that only this writer writes.
+
+    Entries are gathered until max_entries are waiting or the oldest has
+    waited max_age seconds.  Each hour's shard is then written whole with
+    them added, without reading it first, so writers never conflict.
+    Writers block until their entry is stored so a write returning means
+    the webhook is indexed.
+    '''
+    def __init__(self, max_entries, max_age, tenant=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.tenant = tenant
+        self._lock = threading.Lock()
+        self._batch = None
+        self._shards = collections.OrderedDict()
+
+    def write(self, hour_path, entry):
+        '''
+        Add an entry to an hour's index and wait for it to be written.
+        '''
+        full_batch = None
+        with self._lock:
+            if self._batch is None:
+                self._batch = _IndexBatch()
+                timer = threading.Timer(self.max_age, self._flush_expired, [self._batch])
+                timer.daemon = True
+                timer.start()
+
+            batch = self._batch
+            batch.entries.setdefault(hour_path, []).append(entry)
+            batch.size += 1
+            if batch.size >= self.max_entries:
+                full_batch = batch
+                self._batch = None
+
+        if full_batch:
+            self._flush(full_batch)
+
+        batch.flushed.wait()
+        if batch.error:
+            # Keep the S3 error so callers can tell what went wrong.
+            if isinstance(batch.error, S3ClientError):
+                raise S3ClientError(*batch.error.args)
+            raise S3ClientError('Unable to write index: {}'.format(batch.error))
+
+        return None
+
+    def flush(self):
+        '''
+        Write the waiting entries now.
+        '''
+        with self._lock:
+            batch = self._batch
+            self._batch = None
+
+        if batch:
+            self._flush(batch)
+
+    def _flush_expired(self, batch):
+        with self._lock:
+            if self._batch is not batch:
+                # Already flushed for being full.
+                return
+            self._batch = None
+
+        self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            with tenants.using(self.tenant):
+                concurrency.map(self._write_shard,
+                                sorted(batch.entries.items()),
+                                _get_s3_concurrency())
+        except Exception as e:
+            log_exception(e)
+            batch.error = e
+        finally:
+            batch.flushed.set()
+
+    def _get_shard(self, hour_path):
+        '''
+        Return the shard to add an hour's entries to.
+        '''
+        shard = self._shards.pop(hour_path, None)
+        if (shard is None or
+                len(shard.entries) >= INDEX_SHARD_MAX_ENTRIES or
+                time.time() - shard.written_at > INDEX_SHARD_MAX_IDLE):
+            shard = _IndexShard(hour_path)
+        # Keep the most recently used hours open.
+        self._shards[hour_path] = shard
+        while len(self._shards) > INDEX_OPEN_HOURS:
+            self._shards.popitem(last=False)
+
+        return shard
+
+    def _write_shard(self, item):
+        hour_path, entries = item
+        with self._lock:
+            shard = self._get_shard(hour_path)
+            shard.entries.extend(entries)
+
+        # Entries are copied under the write lock so each write of a shard
+        # holds everything the one before it did.
+        with shard.write_lock:
+            with self._lock:
+                shard_entries = sorted(shard.entries, key=_get_index_entry_sort_key)
+            _put_index_object(shard.key, shard_entries)
+            shard.written_at = time.time()
+
+def _get_index_writer():
+    '''
+    Return the current tenant's index writer, creating it if needed.
+    '''
+    tenant = tenants.get_current()
+    index_writer = _index_writers.get(tenant.name)
+    if index_writer is None:
+        with _index_writer_lock:
+            index_writer = _index_writers.get(tenant.name)
+            if index_writer is None:
+                index_writer = _IndexWriter(INDEX_FLUSH_MAX_ENTRIES,
+                                            TS_S3_INDEX_FLUSH_MAX_AGE,
+                                            tenant)
+                _index_writers[tenant.name] = index_writer
+
+    return index_writer
+
+@atexit.register
+def flush_index_writers():
+    '''
+    Write any index entries waiting for a shard.
+    '''
+    for index_writer in list(_index_writers.values()):
+        index_writer.flush()
+
+def _list_index_objects(hour_path):
+    '''
+    Return the S3 objects holding an hour's index shards.
+    '''
+    return list(_iter_bucket_objects(_get_index_shard_prefix(hour_path)))
+
+def _read_index(hour_path):
+    '''
+    Return the entries of an hour's webhook index, merged from its shards.
+
+    Entries are keyed on webhook time and alert ID just like webhook keys.
+    '''
+    index_keys = [obj.get('Key') for obj in _list_index_objects(hour_path)]
+    shard_entries = concurrency.map(
+        _read_index_object,
+        index_keys,
+        _get_s3_concurrency()
+    )
+
+    merged = dict((_get_index_entry_sort_key(e), e)
+                  for e in itertools.chain.from_iterable(shard_entries))
+
+    return [merged[k] for k in sorted(merged)]
+
+def _get_index_hours(start, end):
+    '''
+    Return index hour paths that may hold webhooks between start and end.
+    '''
+    one_hour = datetime.timedelta(hours=1)
+    first, last = _get_webhook_minute_bounds(start, end)
+
+    hours = []
+    cursor = first.replace(minute=0)
+    while cursor <= last:
+        hours.append(cursor.strftime(INDEX_TIME_PATH_FORMAT))
+        cursor += one_hour
+
+    return hours
+
+def _iter_webhook_refs_from_index(start, end, after=None):
+    '''
+    Yield (webhook_ref, alert_id, entry) between start and end from hourly
+    indexes.
+    '''
+    hours = _get_index_hours(start, end)
+    if after:
+        # Webhook references start with their hour path.
+        after_hour_path = after[:len('YYYY/MM/DD/HH')]
+        hours = [h for h in hours if h >= after_hour_path]
+
+    hour_entries = concurrency.imap(
+        _read_index,
+        hours,
+        _get_s3_concurrency()
+    )
+
+    for entry in itertools.chain.from_iterable(hour_entries):
+        webhook_time_prefix = _get_webhook_time_path(entry.get('created_at'))
+        webhook_ref = '/'.join([webhook_time_prefix, entry.get('id')])
+        if after and webhook_ref <= after:
+            continue
+
+        alert_time = time.gmtime(entry.get('created_at')/1000)
+        webhook_time = datetime.datetime(*alert_time[:5], tzinfo=UTC)
+
+        if start < webhook_time < end:
+            yield webhook_ref, entry.get('id'), entry
+
+def _get_s3_object_body(key, **kwargs):
+    '''
+    Return the body of an S3 object.
+
+    Extra keyword arguments are passed to get_object().
+    '''
+    s3_client = _get_s3_client()
+    try:
+        response = s3_client.get_object(
+            Bucket=_get_bucket(),
+            Key=key,
+            **kwargs
+        )
+        body = response.get('Body').read()
+    except (ClientError, RequestException):
+        _reraise_s3_client_error()
+
+    return body
+
+def _select_s3_object(key, expression):
+    '''
+    Run an S3 Select expression over a JSON object and return the records.
+
+    Returns None when S3 Select is disabled or unavailable so callers can
+    evaluate the query themselves.
+    '''
+    global _select_supported
+    if not (TS_S3_SELECT and _select_supported):
+        return None
+
+    s3_client = _get_s3_client()
+    try:
+        response = s3_client.select_object_content(
+            Bucket=_get_bucket(),
+            Key=key,
+            Expression=expression,
+            ExpressionType='SQL',
+            InputSerialization={'JSON': {'Type': 'DOCUMENT'}},
+            OutputSerialization={'JSON': {'RecordDelimiter': '\n'}}
+        )
+        payload = b''.join(
+            event['Records']['Payload']
+            for event in response.get('Payload')
+            if 'Records' in event
+        )
+    except ClientError as e:
+        if _get_client_error_code(e) in SELECT_UNSUPPORTED_ERROR_CODES:
+            _logger.warning('S3 Select unavailable, evaluating queries locally: {}'.format(e))
+            _select_supported = False
+            return None
+        _reraise_s3_client_error()
+    except RequestException:
+        _reraise_s3_client_error()
+
+    return [json.loads(line) for line in payload.splitlines() if line.strip()]
+
+def _get_s3_object_json(key):
+    '''
+    Return the decoded JSON body of an S3 object.
+    '''
+    return serializer.loads(_get_s3_object_body(key))
+
+def _rebuild_index_hour(hour_path):
+    '''
+    Index every webhook stored in an hour in one new shard.
+
+    Shards no writer has written for INDEX_SHARD_DELETE_AFTER seconds are
+    then deleted.  Their entries are all in the new shard since an entry is
+    only written once its webhook is stored.  Newer shards are left alone
+    so entries still being added to them aren't lost.
+    '''
+    stale_before = datetime.datetime.now(UTC) - datetime.timedelta(seconds=INDEX_SHARD_DELETE_AFTER)
+    # Listed before the webhooks so every stale entry's webhook is listed.
+    stale_keys = [obj.get('Key') for obj in _list_index_objects(hour_path)
+                  if obj.get('LastModified') and obj.get('LastModified') < stale_before]
+
+    webhook_keys = _get_webhook_keys_in_range((hour_path, None, None))
+    webhooks = concurrency.map(_get_s3_object_json, webhook_keys, _get_s3_concurrency())
+    if webhooks:
+        entries = sorted((_get_index_entry(w) for w in webhooks), key=_get_index_entry_sort_key)
+        _put_index_object(_get_index_shard_key(hour_path), entries)
+
+    concurrency.map(_delete_s3_object, stale_keys, _get_s3_concurrency())
+
+    return len(webhooks)
+
+def rebuild_index(start, end):
+    '''
+    Backfill hourly indexes from webhooks stored between start and end,
+    compacting each hour's idle shards into one.
+
+    Returns the number of webhooks indexed.
+    '''
+    hours = _get_index_hours(start, end)
+    counts = concurrency.imap(_rebuild_index_hour, hours, _get_s3_concurrency())
+
+    total = 0
+    for hour_path, count in zip(hours, counts):
+        _logger.info('Indexed {} webhooks for {}'.format(count, hour_path))
+        total += count
+
+    return total
+
+def _add_key_prefix(key):
+    '''
+    Return key under the tenant's prefix if one is set.
+    '''
+    prefix = _get_prefix()
+    if prefix:
+        key = '/'.join([prefix, key])
+
+    return key
+
+def _get_alert_id_hour_path(alert_id):
+    '''
+    Return the hour path of the time an alert ID was created.
+
+    Returns None for IDs that don't carry a creation time.
+    '''
+    if not OBJECT_ID_RE.match(alert_id):
+        return None
+
+    alert_id_time = time.gmtime(int(alert_id[0:8], 16))
+    return time.strftime(INDEX_TIME_PATH_FORMAT, alert_id_time)
+
+def _get_locator_prefix(hour_path):
+    '''
+    Return the key prefix of the locator shards for alert IDs created in an
+    hour.
+    '''
+    return _add_key_prefix('/'.join(['locators', hour_path, '']))
+
+def _get_locator_key(hour_path, segment_key, entries):
+    '''
+    Return the key of a segment's locator shard for alert IDs created in an
+    hour.
+
+    The shard is named for the first and last alert ID it lists, so readers
+    can tell from a listing which shards may hold an alert.
+    '''
+    segment_name = segment_key.rsplit('/', 1)[-1].split('.', 1)[0]
+    shard_name = '{}-{}-{}.json.gz'.format(entries[0].get('id'), entries[-1].get('id'), segment_name)
+
+    return _get_locator_prefix(hour_path) + shard_name
+
+def _locator_may_hold(locator_key, alert_id):
+    '''
+    Return whether a locator shard's ID range includes an alert ID.
+    '''
+    first_id, last_id, _ = locator_key.rsplit('/', 1)[-1].split('-', 2)
+    return first_id <= alert_id <= last_id
+
+def _get_segment_key(compression):
+    '''
+    Return a new segment key for the current hour.
+    '''
+    hour_path = time.strftime(INDEX_TIME_PATH_FORMAT, time.gmtime())
+    segment_name = uuid.uuid4().hex + SEGMENT_EXTENSIONS[compression]
+
+    return _add_key_prefix('/'.join(['segments', hour_path, segment_name]))
+
+def _compress_record(data, compression):
+    '''
+    Compress one segment record so it can be read on its own.
+
+    Concatenated gzip members and zstd frames are themselves valid gzip and
+    zstd streams so a whole segment still decompresses as NDJSON.
+    '''
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+
+    record = six.BytesIO()
+    with gzip.GzipFile(fileobj=record, mode='wb') as f:
+        f.write(data)
+
+    return record.getvalue()
+
+def _decompress_record(data, segment_key):
+    '''
+    Decompress one record read from a segment.
+    '''
+    if segment_key.endswith(SEGMENT_EXTENSIONS['zstd']):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return gzip.GzipFile(fileobj=six.BytesIO(data)).read()
+
+class _SegmentBatch(object):
+    '''
+    Alerts waiting to be written to one segment.
+    '''
+    def __init__(self):
+        self.records = []
+        self.size = 0
+        self.flushed = threading.Event()
+        self.segment_key = None
+        self.error = None
+
+class _SegmentWriter(object):
+    '''
+    Gather alerts and write them to S3 as compressed NDJSON segments.
+
+    A segment is written once it reaches max_bytes or once its oldest alert
+    has waited max_age seconds.  Writers block until their alert's segment
+    and locator entries are stored so a write returning means the alert is
+    archived.  Segments are written to tenant's bucket whichever thread
+    flushes them.
+    '''
+    def __init__(self, max_bytes, max_age, compression, tenant=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compression = compression
+        self.tenant = tenant
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def write(self, alert_id, data):
+        '''
+        Add an alert to the current segment and wait for it to be written.
+
+        Returns the alert's ETag.
+        '''
+        # One JSON document per line once the segment is decompressed.
+        record = _compress_record(data + b'\n', self.compression)
+
+        full_batch = None
+        with self._lock:
+            if self._batch is None:
+                self._batch = _SegmentBatch()
+                timer = threading.Timer(self.max_age, self._flush_expired, [self._batch])
+                timer.daemon = True
+                timer.start()
+
+            batch = self._batch
+            offset = batch.size
+            batch.records.append((alert_id, record))
+            batch.size += len(record)
+            if batch.size >= self.max_bytes:
+                full_batch = batch
+                self._batch = None
+
+        if full_batch:
+            self._flush(full_batch)
+
+        batch.flushed.wait()
+        if batch.error:
+            # Keep the S3 error so callers can tell what went wrong.
+            if isinstance(batch.error, S3ClientError):
+                raise S3ClientError(*batch.error.args)
+            raise S3ClientError('Unable to write segment: {}'.format(batch.error))
+
+        return _get_segment_etag(batch.segment_key, offset)
+
+    def flush(self):
+        '''
+        Write the current segment now.
+        '''
+        with self._lock:
+            batch = self._batch
+            self._batch = None
+
+        if batch:
+            self._flush(batch)
+
+    def _flush_expired(self, batch):
+        with self._lock:
+            if self._batch is not batch:
+                # Already flushed for being full.
+                return
+            self._batch = None
+
+        self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            with tenants.using(self.tenant):
+                batch.segment_key = _put_segment(batch.records, self.compression)
+        except Exception as e:
+            log_exception(e)
+            batch.error = e
+        finally:
+            batch.flushed.set()
+
+def _put_segment(records, compression):
+    '''
+    Write (alert_id, record) pairs as a segment and record their locations.
+    '''
+    segment_key = _get_segment_key(compression)
+    _put_s3_object(segment_key, b''.join(record for _, record in records))
+
+    locators = {}
+    offset = 0
+    for alert_id, record in records:
+        hour_path = _get_alert_id_hour_path(alert_id)
+        locators.setdefault(hour_path, []).append({
+            'id': alert_id,
+            'segment': segment_key,
+            'offset': offset,
+            'length': len(record)
+        })
+        offset += len(record)
+
+    # Each segment gets its own locator shards, written once, so writers
+    # never read or contend for a shared locator.
+    def _put_locator(item):
+        hour_path, entries = item
+        entries.sort(key=lambda entry: entry.get('id'))
+        locator_key = _get_locator_key(hour_path, segment_key, entries)
+        _put_index_object(locator_key, entries)
+        _get_locator_hour(hour_path).add(locator_key, entries)
+
+    concurrency.map(_put_locator, sorted(locators.items()), _get_s3_concurrency())
+
+    return segment_key
+
+def _get_segment_writer():
+    '''
+    Return the current tenant's segment writer, creating it if needed.
+    '''
+    tenant = tenants.get_current()
+    segment_writer = _segment_writers.get(tenant.name)
+    if segment_writer is None:
+        with _segment_writer_lock:
+            segment_writer = _segment_writers.get(tenant.name)
+            if segment_writer is None:
+                compression = TS_S3_SEGMENT_COMPRESSION
+                if compression == 'zstd' and zstandard is None:
+                    _logger.warning('zstandard is not installed, compressing segments with gzip')
+                    compression = 'gzip'
+                segment_writer = _SegmentWriter(TS_S3_SEGMENT_MAX_BYTES,
+                                                TS_S3_SEGMENT_MAX_AGE,
+                                                compression,
+                                                tenant)
+                _segment_writers[tenant.name] = segment_writer
+
+    return segment_writer
+
+@atexit.register
+def flush_segments():
+    '''
+    Write any alerts waiting for a segment.
+    '''
+    for segment_writer in list(_segment_writers.values()):
+        segment_writer.flush()
+
+def _get_segment_etag(segment_key, offset):
+    '''
+    Return the ETag of an alert stored in a segment.
+
+    Segments are never rewritten so the segment key and the alert's offset
+    identify its content.
+    '''
+    digest = hashlib.sha1('{}:{}'.format(segment_key, offset).encode('utf-8'))
+    return '"{}"'.format(digest.hexdigest())
+
+class _LocatorHour(object):
+    '''
+    Locator entries of one hour read so far, and the shards listed for it.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.read_keys = set()
+        self.listed_keys = []
+        self.listed_at = 0
+        self._lock = threading.Lock()
+
+    def add(self, locator_key, entries):
+        '''
+        Add the entries of a locator shard.
+        '''
+        with self._lock:
+            self.read_keys.add(locator_key)
+            for entry in entries:
+                self.entries[entry.get('id')] = entry
+
+    def get_unread_keys(self, alert_id):
+        '''
+        Return listed shards not read yet whose ID range includes alert_id.
+        '''
+        with self._lock:
+            return [key for key in self.listed_keys
+                    if key not in self.read_keys and _locator_may_hold(key, alert_id)]
+
+    def get_size(self):
+        '''
+        Return roughly what the entries cost to keep.
+        '''
+        return 200 * len(self.entries) + 100 * len(self.listed_keys) + 100
+
+def _get_locator_hour(hour_path):
+    '''
+    Return the current tenant's cached locator entries for an hour,
+    creating them if needed.
+    '''
+    cache_key = (tenants.get_current().name, hour_path)
+    locator_hour = _locator_cache.get(cache_key)
+    if locator_hour is None:
+        locator_hour = _LocatorHour()
+    # Set again so the cache knows its size as it grows.
+    _locator_cache.set(cache_key, locator_hour, locator_hour.get_size())
+
+    return locator_hour
+
+def _is_hour_settled(hour_path):
+    '''
+    Return whether alerts of an hour are unlikely to still be arriving.
+    '''
+    hour_time = calendar.timegm(time.strptime(hour_path, INDEX_TIME_PATH_FORMAT))
+    return time.time() > hour_time + 3600 + LOCATOR_SETTLE_SECONDS
+
+def _read_locator_shards(locator_hour, alert_id):
+    '''
+    Read the listed locator shards that may hold an alert and return its
+    entry, or None if none of them list it.
+    '''
+    locator_keys = locator_hour.get_unread_keys(alert_id)
+    shard_entries = concurrency.map(_read_index_object, locator_keys, _get_s3_concurrency())
+    for locator_key, entries in zip(locator_keys, shard_entries):
+        locator_hour.add(locator_key, entries)
+
+    return locator_hour.entries.get(alert_id)
+
+def _get_locator_entry(alert_id):
+    '''
+    Return where in a segment an alert is stored, or None if it isn't.
+
+    Locator entries are cached.  When they don't list the alert its hour's
+    shards are listed again, unless the hour has settled and was listed
+    within TS_S3_LOCATOR_CACHE_RECHECK seconds, and the new ones that may
+    hold it are read.
+    '''
+    hour_path = _get_alert_id_hour_path(alert_id)
+    if not hour_path:
+        return None
+
+    locator_hour = _get_locator_hour(hour_path)
+    entry = locator_hour.entries.get(alert_id) or _read_locator_shards(locator_hour, alert_id)
+    if entry is not None:
+        return entry
+
+    if (_is_hour_settled(hour_path) and
+            time.time() - locator_hour.listed_at < TS_S3_LOCATOR_CACHE_RECHECK):
+        return None
+
+    listed_at = time.time()
+    locator_hour.listed_keys = [obj.get('Key') for obj in
+                                _iter_bucket_objects(_get_locator_prefix(hour_path))]
+    locator_hour.listed_at = listed_at
+
+    return _read_locator_shards(locator_hour, alert_id)
+
+def _get_segment_alert_data(alert_id, etags=None):
+    '''
+    Return an alert's stored JSON and ETag from its segment.
+
+    Returns None if the alert is not in a segment.  The JSON is None if the
+    ETag is one of etags.
+    '''
+    entry = _get_locator_entry(alert_id)
+    if entry is None:
+        return None
+
+    segment_key = entry.get('segment')
+    first_byte = entry.get('offset')
+    etag = _get_segment_etag(segment_key, first_byte)
+    if _etag_matches(etag, etags):
+        return None, etag
+
+    last_byte = first_byte + entry.get('length') - 1
+    record = _get_s3_object_body(
+        segment_key,
+        Range='bytes={}-{}'.format(first_byte, last_byte)
+    )
+
+    return _decompress_record(record, segment_key), etag
+
+@metrics.timed(S3_REQUEST_SECONDS, S3_REQUEST_ERRORS, operation='put_object')
 def _put_s3_object(key, body):
     '''
     Put an object in S3.
     '''
-    s3_client = boto3.client('s3')
+    s3_client = _get_s3_client()
     try:
         response = s3_client.put_object(
             Body=body,
-            Bucket=TS_AWS_S3_BUCKET,
+            Bucket=_get_bucket(),
             Key=key
         )
     except ClientError as e:
@@ -123,15 +1228,30 @@ def _put_s3_object(key, body):
 
     return response
 
+@metrics.timed(S3_REQUEST_SECONDS, S3_REQUEST_ERRORS, operation='delete_object')
+def _delete_s3_object(key):
+    '''
+    Delete an object from S3.
+    '''
+    s3_client = _get_s3_client()
+    try:
+        s3_client.delete_object(
+            Bucket=_get_bucket(),
+            Key=key
+        )
+    except (ClientError, RequestException):
+        _reraise_s3_client_error()
+
 def is_available():
     '''
     Check ability to access S3 bucket.
     '''
-    s3_client = boto3.client('s3')
+    s3_client = _get_s3_client()
     try:
-        kwargs = {'Bucket': TS_AWS_S3_BUCKET}
-        if TS_AWS_S3_PREFIX:
-            kwargs['Prefix'] = TS_AWS_S3_PREFIX
+        # One key is enough to prove access.
+        kwargs = {'Bucket': _get_bucket(), 'MaxKeys': 1}
+        if _get_prefix():
+            kwargs['Prefix'] = _get_prefix()
         s3_client.list_objects(**kwargs)
     except ClientError as e:
         exc_info = sys.exc_info()
@@ -148,18 +1268,98 @@ def is_available():
 
     return True
 
-def get_alert_by_id(alert_id):
+def get_cache_stats():
     '''
-    Get alert by alert ID
+    Return alert cache statistics, or None if the cache is disabled.
     '''
+    if _alert_cache is None:
+        return None
+
+    return _alert_cache.stats()
+
+def _cache_alert(alert_id, alert_data, etag):
+    '''
+    Add an alert's stored JSON and ETag to the cache if it is enabled.
+    '''
+    if _alert_cache is not None:
+        _alert_cache.set(_get_cache_key(alert_id), (alert_data, etag), len(alert_data))
+
+def _etag_matches(etag, etags):
+    '''
+    Return whether etag satisfies a list of If-None-Match ETags.
+    '''
+    if not etags:
+        return False
+
+    return '*' in etags or etag in etags
+
+def _is_not_modified_error(error):
+    '''
+    Return whether a ClientError is S3 answering a conditional GET with 304.
+    '''
+    status_code = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status_code == 304 or _get_client_error_code(error) in ('304', 'NotModified')
+
+def get_alert_ids_etag(alert_ids):
+    '''
+    Return an ETag for a list of alert IDs.
+
+    Archived alerts don't change so the IDs identify the content.
+    '''
+    digest = hashlib.sha1('\n'.join(alert_ids).encode('utf-8'))
+    return '"{}"'.format(digest.hexdigest())
+
+@metrics.timed(ALERT_READ_SECONDS)
+def get_alert_data_with_etag(alert_id, etags=None):
+    '''
+    Get an alert's stored JSON and its ETag by alert ID
+
+    etags is a list of ETags the caller already has, as sent in
+    If-None-Match.  If the alert's ETag is one of them the alert is not
+    downloaded and None is returned in its place.
+
+    The JSON is returned as stored, undecoded, so it can be passed through
+    to responses.
+    '''
+    if _alert_cache is not None:
+        cached = _alert_cache.get(_get_cache_key(alert_id))
+        if cached is not None:
+            alert_data, etag = cached
+            ALERT_READS.inc(source='cache')
+            if _etag_matches(etag, etags):
+                return None, etag
+            return alert_data, etag
+
+    # Alerts archived before segments were enabled are stored individually.
+    if TS_S3_SEGMENTS:
+        segment_alert = _get_segment_alert_data(alert_id, etags)
+        if segment_alert is not None:
+            alert_data, etag = segment_alert
+            ALERT_READS.inc(source='segment')
+            if alert_data is None:
+                return None, etag
+            # Segment records end in a newline.
+            alert_data = alert_data.rstrip(b'\n')
+            _cache_alert(alert_id, alert_data, etag)
+            return alert_data, etag
+
     alert_key = _get_alert_data_key(alert_id)
-    s3_client = boto3.client('s3')
+    get_object_params = {
+        'Bucket': _get_bucket(),
+        'Key': alert_key
+    }
+    # S3 only takes a single ETag.  We compare lists ourselves below.
+    if etags and len(etags) == 1:
+        get_object_params['IfNoneMatch'] = etags[0]
+
+    s3_client = _get_s3_client()
     try:
-        alert_data = s3_client.get_object(
-            Bucket=TS_AWS_S3_BUCKET,
-            Key=alert_key
-        )
+        alert_data = s3_client.get_object(**get_object_params)
     except ClientError as e:
+        if _is_not_modified_error(e):
+            ALERT_READS.inc(source='object')
+            return None, etags[0]
+
         exc_info = sys.exc_info()
         if sys.version_info >= (3,0,0):
             raise S3ClientError(e).with_traceback(exc_info[2])
@@ -172,28 +1372,135 @@ def get_alert_by_id(alert_id):
         else:
             six.reraise(S3ClientError, S3ClientError('Failure to communicate with S3'), exc_info[2])
 
-
+    ALERT_READS.inc(source='object')
+    etag = alert_data.get('ETag')
     body = alert_data.get('Body')
     body_text = body.read()
 
-    return json.loads(body_text)
+    _cache_alert(alert_id, body_text, etag)
 
-def get_alerts_by_date(start, end):
+    if _etag_matches(etag, etags):
+        return None, etag
+
+    return body_text, etag
+
+def get_alert_with_etag(alert_id, etags=None):
     '''
-    Get alerts between given date start and end.
+    Get alert and its ETag by alert ID
 
-    both start and end are datetime objects with timezone info
+    Like get_alert_data_with_etag() but the alert is decoded.
+    '''
+    alert_data, etag = get_alert_data_with_etag(alert_id, etags)
+    if alert_data is None:
+        return None, etag
+
+    return serializer.loads(alert_data), etag
+
+def alert_exists(alert_id):
     '''
-    # We store webhooks by date and time so we search for those first.
+    Return whether an alert's data is archived, without downloading it.
+    '''
+    if _alert_cache is not None and _alert_cache.get(_get_cache_key(alert_id)) is not None:
+        return True
+
+    if TS_S3_SEGMENTS and _get_locator_entry(alert_id) is not None:
+        return True
+
+    s3_client = _get_s3_client()
+    try:
+        s3_client.head_object(
+            Bucket=_get_bucket(),
+            Key=_get_alert_data_key(alert_id)
+        )
+    except ClientError as e:
+        if _get_client_error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        _reraise_s3_client_error()
+    except RequestException:
+        _reraise_s3_client_error()
+
+    return True
+
+def get_alert_by_id(alert_id):
+    '''
+    Get alert by alert ID
+    '''
+    return get_alert_with_etag(alert_id)[0]
+
+def get_alert_data_by_id(alert_id):
+    '''
+    Get an alert's stored JSON by alert ID
+    '''
+    return get_alert_data_with_etag(alert_id)[0]
+
+def _time_webhook_refs(webhook_refs, source):
+    '''
+    Yield from webhook_refs, recording the time spent waiting on them but
+    not the time the caller spends between them.
+    '''
+    webhook_refs = iter(webhook_refs)
+    elapsed = 0
+    try:
+        while True:
+            started = time.time()
+            try:
+                webhook_ref = next(webhook_refs)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - started
+            yield webhook_ref
+    finally:
+        # Also recorded when the caller stops early, eg. at a page's limit.
+        WEBHOOK_LISTING_SECONDS.observe(elapsed, source=source)
+
+def _iter_webhook_refs(start, end, after=None, lazy=False):
+    '''
+    Yield (webhook_ref, alert_id, entry) for webhooks between start and end.
+
+    A webhook reference is its key relative to the webhooks prefix, e.g.
+    YYYY/MM/DD/HH/MM/<alert ID>.  entry is the webhook's index entry, or None
+    when the webhook was found by listing.  Webhooks are yielded in key order
+    starting after the reference after, if given.  Set lazy to list only as
+    much as the caller consumes rather than listing ahead concurrently.
+    '''
+    if TS_S3_INDEX_READS:
+        webhook_refs = _iter_webhook_refs_from_index(start, end, after)
+        return _time_webhook_refs(webhook_refs, 'index')
+
+    webhook_refs = _iter_webhook_refs_from_listing(start, end, after, lazy)
+    return _time_webhook_refs(webhook_refs, 'listing')
+
+def _iter_webhook_refs_from_listing(start, end, after=None, lazy=False):
+    '''
+    Yield (webhook_ref, alert_id, None) for webhooks between start and end
+    found by listing their keys.
+    '''
+    # We store webhooks by date and time so we search for those first.  Only
+    # list the prefixes covering our range.
     webhooks_prefix = _get_webhooks_key_prefix()
-    webhook_objects = _get_bucket_objects(webhooks_prefix)
+    time_ranges = _plan_webhook_time_ranges(start, end)
+    if after:
+        time_ranges = [r for r in time_ranges if not _is_range_before(r, after)]
 
-    alert_ids = []
-    for obj in webhook_objects:
-        key = obj.get('Key')
+    if lazy:
+        webhook_keys = itertools.chain.from_iterable(
+            _iter_webhook_keys_in_range(r, after) for r in time_ranges
+        )
+    else:
+        webhook_keys = itertools.chain.from_iterable(
+            concurrency.imap(
+                lambda time_range: _get_webhook_keys_in_range(time_range, after),
+                time_ranges,
+                _get_s3_concurrency()
+            )
+        )
+
+    for key in webhook_keys:
         # Remove webhook path prefix (and delimiter) and split string into
         # time prefix and alert ID.
-        webhook_time_prefix, alert_id = key[len(webhooks_prefix) + 1:].rsplit('/', 1)
+        webhook_ref = key[len(webhooks_prefix) + 1:]
+        webhook_time_prefix, alert_id = webhook_ref.rsplit('/', 1)
         # There are more compact ways of doing the following but I prefer to
         # show the sequence of events.
         #
@@ -207,27 +1514,212 @@ def get_alerts_by_date(start, end):
         webhook_time = datetime.datetime(*webhook_time_prefix_ints, tzinfo=UTC)
 
         if start < webhook_time < end:
-            alert_ids.append(alert_id)
+            yield webhook_ref, alert_id, None
+
+def _filter_webhook_refs(webhook_refs, query):
+    '''
+    Yield webhook references whose webhook data matches query.
+
+    Index entries are used where they hold the filtered fields.  Otherwise
+    the filter is pushed down to S3 Select on the webhook record, or the
+    small webhook record is fetched and checked here.  Either way that
+    saves fetching the alert itself.
+    '''
+    webhooks_prefix = _get_webhooks_key_prefix()
+
+    def _webhook_ref_matches(webhook_ref_item):
+        webhook_ref, _, entry = webhook_ref_item
+        if entry is not None and all(field in entry for field in query.filters):
+            return webhook_ref_item, query.matches(entry)
+
+        webhook_key = '/'.join([webhooks_prefix, webhook_ref])
+        records = _select_s3_object(webhook_key, query.to_sql(fields=['id']))
+        if records is not None:
+            return webhook_ref_item, bool(records)
+
+        return webhook_ref_item, query.matches(_get_s3_object_json(webhook_key))
+
+    for webhook_ref_item, matches in concurrency.imap(_webhook_ref_matches,
+                                                      webhook_refs,
+                                                      _get_s3_concurrency()):
+        if matches:
+            yield webhook_ref_item
+
+def get_alert_ids_by_date(start, end):
+    '''
+    Get IDs of alerts between given date start and end.
 
-    alerts = []
-    for alert_id in alert_ids:
-        alert_data = get_alert_by_id(alert_id)
-        alerts.append(alert_data)
+    both start and end are datetime objects with timezone info
+    '''
+    return [webhook_ref[1] for webhook_ref in _iter_webhook_refs(start, end)]
+
+def get_alert_ids_page_by_date(start, end, limit=None, after=None, filters=None):
+    '''
+    Get a page of IDs of alerts between given date start and end.
 
-    return alerts
+    Returns up to limit alert IDs following the webhook reference after,
+    and the reference to pass as after for the next page.  That reference
+    is None when there are no more alerts.  filters maps webhook fields in
+    FILTER_FIELDS to sets of acceptable values.
+    '''
+    webhook_refs = _iter_webhook_refs(start, end, after, lazy=limit is not None)
+    if filters:
+        webhook_refs = _filter_webhook_refs(webhook_refs, AlertQuery(filters=filters))
+    try:
+        if limit is None:
+            page = list(webhook_refs)
+        else:
+            # Look one ahead to learn if there is another page.
+            page = list(itertools.islice(webhook_refs, limit + 1))
+    finally:
+        webhook_refs.close()
+
+    next_after = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_after = page[-1][0]
+
+    return [webhook_ref[1] for webhook_ref in page], next_after
+
+def _get_projected_alert(alert_id, query):
+    '''
+    Get an alert with only the fields in query.
+
+    The projection is pushed down to S3 Select when possible so only the
+    projected fields are downloaded.
+    '''
+    # Segment records can't be selected from individually.
+    if not TS_S3_SEGMENTS:
+        cached = _alert_cache.get(_get_cache_key(alert_id)) if _alert_cache is not None else None
+        if cached is None:
+            records = _select_s3_object(_get_alert_data_key(alert_id), query.to_sql())
+            if records is not None:
+                return records[0]
+        else:
+            return query.project(serializer.loads(cached[0]))
+
+    return query.project(get_alert_by_id(alert_id))
+
+def iter_alerts_by_id(alert_ids, fields=None, on_missing=None, raw=False):
+    '''
+    Yield alerts for the given alert IDs in order.
+
+    Alerts are fetched concurrently but only a bounded number are held in
+    memory at once so callers can stream large result sets.  When fields is
+    given only those top level fields of each alert are returned.  Alerts
+    whose data isn't stored are on_missing(alert_id), if given.  With raw,
+    and no fields, each alert's stored JSON is yielded undecoded.
+    '''
+    query = AlertQuery(fields=fields)
+    if fields:
+        get_alert = lambda alert_id: _get_projected_alert(alert_id, query)
+        raw = False
+    elif raw:
+        get_alert = get_alert_data_by_id
+    else:
+        get_alert = get_alert_by_id
+
+    if on_missing is not None:
+        get_stored_alert = get_alert
+
+        def get_alert(alert_id):
+            try:
+                return get_stored_alert(alert_id)
+            except S3ClientError:
+                if alert_exists(alert_id):
+                    raise
+            alert = query.project(on_missing(alert_id))
+            return serializer.dumps(alert) if raw else alert
+
+    return concurrency.imap(get_alert, alert_ids, _get_s3_concurrency())
+
+def iter_alerts_by_date(start, end):
+    '''
+    Yield alerts between given date start and end.
+
+    Alert IDs are looked up before returning so listing errors are raised to
+    the caller immediately.
+    '''
+    alert_ids = get_alert_ids_by_date(start, end)
+
+    return iter_alerts_by_id(alert_ids)
+
+def get_alerts_by_date(start, end):
+    '''
+    Get alerts between given date start and end.
+
+    both start and end are datetime objects with timezone info
+    '''
+    return list(iter_alerts_by_date(start, end))
+
+def _get_webhook_data_key(alert):
+    '''
+    Takes alert webhook data and returns its S3 key path.
+    '''
+    alert_time_path = _get_webhook_time_path(alert.get('created_at'))
+    webhooks_prefix = _get_webhooks_key_prefix()
+
+    return '/'.join([webhooks_prefix, alert_time_path, alert.get('id')])
+
+def _get_s3_object_etag(key):
+    '''
+    Return the ETag of an S3 object, or None if missing.
+    '''
+    s3_client = _get_s3_client()
+    try:
+        resp = s3_client.head_object(
+            Bucket=_get_bucket(),
+            Key=key
+        )
+    except ClientError as e:
+        if _get_client_error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        _reraise_s3_client_error()
+    except RequestException:
+        _reraise_s3_client_error()
+
+    return resp.get('ETag')
+
+def get_webhook_etag(alert):
+    '''
+    Return the ETag of an alert's stored webhook data, or None if missing.
+    '''
+    return _get_s3_object_etag(_get_webhook_data_key(alert))
+
+def webhook_exists(alert_id):
+    '''
+    Return whether webhook data is stored for an alert ID.
+
+    Webhooks are stored by their alert's created_at, which only the time in
+    an ID tells us, so the minutes either side of it are checked too.  IDs
+    that don't carry a time are never found.
+    '''
+    if not OBJECT_ID_RE.match(alert_id):
+        return False
+
+    alert_id_time = int(alert_id[0:8], 16)
+    webhooks_prefix = _get_webhooks_key_prefix()
+    for offset in (0, -WEBHOOK_ID_TIME_SLACK, WEBHOOK_ID_TIME_SLACK):
+        time_path = time.strftime(WEBHOOK_TIME_PATH_FORMAT, time.gmtime(alert_id_time + offset))
+        if _get_s3_object_etag('/'.join([webhooks_prefix, time_path, alert_id])) is not None:
+            return True
+
+    return False
 
 def put_webhook_data(alert):
     '''
     Put alert webhook data in S3 bucket.
     '''
-    alert_time = time.gmtime(alert.get('created_at')/1000)
-    alert_time_path = time.strftime('%Y/%m/%d/%H/%M', alert_time)
-    webhooks_prefix = _get_webhooks_key_prefix()
-    alert_key = '/'.join([webhooks_prefix, alert_time_path, alert.get('id')])
-    alert_json = json.dumps(alert)
+    alert_time_path = _get_webhook_time_path(alert.get('created_at'))
+    alert_key = _get_webhook_data_key(alert)
+    alert_json = serializer.dumps(alert)
 
     _put_s3_object(alert_key, alert_json)
 
+    if TS_S3_INDEX_WRITES:
+        hour_path = alert_time_path.rsplit('/', 1)[0]
+        _get_index_writer().write(hour_path, _get_index_entry(alert))
+
     return None
 
 def put_alert_data(alert):
@@ -236,9 +1728,16 @@ def put_alert_data(alert):
     '''
     alert_id = alert.get('id')
     alert_key = _get_alert_data_key(alert_id)
-    alert_json = json.dumps(alert)
+    alert_json = serializer.dumps(alert)
 
-    _put_s3_object(alert_key, alert_json)
+    # We can only find alerts in segments by IDs that carry a time.
+    if TS_S3_SEGMENTS and _get_alert_id_hour_path(alert_id):
+        etag = _get_segment_writer().write(alert_id, alert_json)
+    else:
+        etag = _put_s3_object(alert_key, alert_json).get('ETag')
+
+    # Recently archived alerts are the ones most likely to be read.
+    _cache_alert(alert_id, alert_json, etag)
 
     return None
 
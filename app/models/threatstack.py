@@ -1,17 +1,47 @@
 '''
 Communicate with Threat Stack
 '''
+from app import guards, metrics, tenants, tracing
+from app.concurrency import RateLimiter
 from app.errors import AppBaseError
 import config
 import logging
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import six
+from six.moves.urllib.parse import urlparse
 import sys
+import threading
+from urllib3.util.retry import Retry
 
 _logger = logging.getLogger(__name__)
 
-THREATSTACK_API_KEY = config.THREATSTACK_API_KEY
+THREATSTACK_REQUEST_SECONDS = metrics.Histogram(
+    'threatstack_to_s3_threatstack_request_seconds',
+    'Threat Stack API call latency, including retries.',
+    ['call']
+)
+THREATSTACK_REQUEST_ERRORS = metrics.Counter(
+    'threatstack_to_s3_threatstack_request_errors_total',
+    'Failed Threat Stack API calls by error.',
+    ['call', 'type']
+)
+
 THREATSTACK_BASE_URL = config.THREATSTACK_BASE_URL
+THREATSTACK_CONNECT_TIMEOUT = config.THREATSTACK_CONNECT_TIMEOUT
+THREATSTACK_READ_TIMEOUT = config.THREATSTACK_READ_TIMEOUT
+THREATSTACK_MAX_RETRIES = config.THREATSTACK_MAX_RETRIES
+THREATSTACK_RATE_LIMIT = config.THREATSTACK_RATE_LIMIT
+THREATSTACK_MAX_IN_FLIGHT = config.THREATSTACK_MAX_IN_FLIGHT
+THREATSTACK_LATENCY_TARGET = config.THREATSTACK_LATENCY_TARGET
+
+# Responses worth retrying.  429 is Threat Stack rate limiting us.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_session_lock = threading.Lock()
+_rate_limiter = None
 
 class ThreatStackError(AppBaseError):
     '''
@@ -28,6 +58,104 @@ class ThreatStackAPIError(ThreatStackError):
     Threat Stack API error.
     '''
 
+class _JitteredRetry(Retry):
+    '''
+    Retry with full jitter applied to the exponential backoff.
+
+    Spreads out retries from many workers hitting the same rate limit.  A
+    Retry-After header from the API still takes precedence.
+    '''
+    def get_backoff_time(self):
+        backoff = super(_JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff)
+
+def _get_session():
+    '''
+    Return the current tenant's HTTP session for the Threat Stack API.
+
+    Reusing one session keeps connections to the API alive between calls.
+    Each tenant has its own session and connection pool.
+    '''
+    tenant = tenants.get_current()
+    session = _sessions.get(tenant.name)
+    if session is None:
+        with _session_lock:
+            session = _sessions.get(tenant.name)
+            if session is None:
+                retry = _JitteredRetry(
+                    total=THREATSTACK_MAX_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=RETRY_STATUS_CODES,
+                    respect_retry_after_header=True,
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=tenant.api_pool_connections,
+                    max_retries=retry
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[tenant.name] = session
+
+    return session
+
+def initialize():
+    '''
+    Create the current tenant's API session ahead of its first use.
+    '''
+    _get_session()
+
+def set_rate_limit(rate):
+    '''
+    Limit Threat Stack API calls from this process to rate per second.
+
+    A rate of 0 removes the limit.
+    '''
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rate) if rate else None
+
+def _throttle():
+    '''
+    Wait until our rate limit allows another API call.
+    '''
+    if _rate_limiter is not None:
+        _rate_limiter.acquire()
+
+def get_guard():
+    '''
+    Return the current tenant's concurrency limit and circuit breaker for
+    API calls.
+    '''
+    return guards.get_guard('threatstack',
+                            tenants.get_current().name,
+                            THREATSTACK_MAX_IN_FLIGHT,
+                            THREATSTACK_LATENCY_TARGET)
+
+def _get(url, params=None):
+    '''
+    GET a Threat Stack API URL as the current tenant.
+
+    Raises DependencyUnavailableError if the call is shed.
+    '''
+    with tracing.span('threatstack.get', path=urlparse(url).path) as span, get_guard().call() as call:
+        resp = _get_session().get(
+            url,
+            headers={'Authorization': tenants.get_current().api_key},
+            params=params,
+            timeout=(THREATSTACK_CONNECT_TIMEOUT, THREATSTACK_READ_TIMEOUT)
+        )
+        if resp.status_code in RETRY_STATUS_CODES:
+            call.fail()
+        retries = getattr(resp.raw, 'retries', None)
+        span.set(status=resp.status_code,
+                 bytes=len(resp.content),
+                 retries=len(retries.history) if retries else 0)
+
+    return resp
+
+@metrics.timed(THREATSTACK_REQUEST_SECONDS, THREATSTACK_REQUEST_ERRORS, call='is_available')
 def is_available():
     '''
     Check connectivity to Threat Stack.
@@ -38,11 +166,9 @@ def is_available():
 
     alerts_url = '{}/alerts?count=1'.format(THREATSTACK_BASE_URL)
 
+    _throttle()
     try:
-        resp = requests.get(
-            alerts_url,
-            headers={'Authorization': THREATSTACK_API_KEY}
-        )
+        resp = _get(alerts_url)
 
     except requests.exceptions.RequestException as e:
         exc_info = sys.exc_info()
@@ -67,17 +193,60 @@ def is_available():
 
     return True
 
+@metrics.timed(THREATSTACK_REQUEST_SECONDS, THREATSTACK_REQUEST_ERRORS, call='get_alert_by_id')
 def get_alert_by_id(alert_id):
     '''
     Retrieve an alert from Threat Stack by alert ID.
     '''
     alerts_url = '{}/alerts/{}'.format(THREATSTACK_BASE_URL, alert_id)
 
+    _throttle()
     try:
-        resp = requests.get(
-            alerts_url,
-            headers={'Authorization': THREATSTACK_API_KEY}
-        )
+        resp = _get(alerts_url)
+
+    except requests.exceptions.RequestException as e:
+        exc_info = sys.exc_info()
+        if sys.version_info >= (3,0,0):
+            raise ThreatStackRequestError(e).with_traceback(exc_info[2])
+        else:
+            six.reraise(
+                ThreatStackRequestError,
+                ThreatStackRequestError(e),
+                exc_info[2]
+            )
+
+    if not resp.ok:
+        if 'application/json' in resp.headers.get('Content-Type'):
+            raise ThreatStackAPIError(
+                resp.reason,
+                resp.status_code,
+                resp.json()
+            )
+        else:
+            raise ThreatStackRequestError(resp.reason, resp.status_code)
+
+    return resp.json()
+
+
+@metrics.timed(THREATSTACK_REQUEST_SECONDS, THREATSTACK_REQUEST_ERRORS, call='get_alerts')
+def get_alerts(start, end, page=0, count=100):
+    '''
+    Retrieve a page of alerts created between start and end.
+
+    start and end are datetime objects with timezone info.  Returns an
+    empty list past the last page.
+    '''
+    alerts_url = '{}/alerts'.format(THREATSTACK_BASE_URL)
+    params = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'page': page,
+        'count': count
+    }
+
+    _throttle()
+    try:
+        resp = _get(alerts_url, params=params)
 
     except requests.exceptions.RequestException as e:
         exc_info = sys.exc_info()
@@ -102,3 +271,5 @@ def get_alert_by_id(alert_id):
 
     return resp.json()
 
+# Apply any configured limit to the whole process.
+set_rate_limit(THREATSTACK_RATE_LIMIT)
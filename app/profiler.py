@@ -0,0 +1,160 @@
+'''
+Sampling profiler writing collapsed stacks for flame graphs.
+
+While running, a CPU time interval timer samples the stacks of every thread
+each TS_PROFILE_INTERVAL seconds of CPU time.  The profile is rewritten to
+TS_PROFILE_DIR/<pid>.collapsed every TS_PROFILE_WRITE_INTERVAL seconds and
+when stopped.  Each line is a stack, outermost frame first, and its sample
+count, as read by flamegraph.pl and speedscope.
+
+Samples are taken in a SIGPROF handler, which Python runs in the main
+thread with the frame it interrupted.  Under gevent that is the frame of
+the greenlet that was running, which a sampling thread can't see.
+
+Start it with TS_PROFILE, or toggle it at runtime with SIGUSR2.  Both must
+happen in the main thread.
+'''
+import config
+import errno
+import logging
+import os
+import signal
+import sys
+import time
+
+_logger = logging.getLogger(__name__)
+
+TS_PROFILE = config.TS_PROFILE
+TS_PROFILE_DIR = config.TS_PROFILE_DIR
+TS_PROFILE_INTERVAL = config.TS_PROFILE_INTERVAL
+TS_PROFILE_WRITE_INTERVAL = 10
+
+if sys.version_info >= (3,0,0):
+    import _thread as thread_module
+else:
+    import thread as thread_module
+
+_running = False
+_counts = {}
+_last_write = 0
+_main_thread_id = None
+
+def _get_native_thread_id():
+    '''
+    Return the OS thread ID, even when gevent patched get_ident.
+    '''
+    try:
+        from gevent import monkey
+    except ImportError:
+        return thread_module.get_ident()
+
+    return monkey.get_original(thread_module.__name__, 'get_ident')()
+
+def get_path():
+    '''
+    Return this process's collapsed stacks file.
+    '''
+    return os.path.join(TS_PROFILE_DIR, '{}.collapsed'.format(os.getpid()))
+
+def _get_stack(frame):
+    '''
+    Return a frame's stack in collapsed form, outermost first.
+    '''
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+
+    return ';'.join(reversed(stack))
+
+def _write():
+    '''
+    Replace the collapsed stacks file.
+    '''
+    try:
+        os.makedirs(TS_PROFILE_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    path = get_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for stack, count in sorted(_counts.items()):
+            f.write('{} {}\n'.format(stack, count))
+    os.rename(tmp_path, path)
+
+def _sample(signum, frame):
+    '''
+    SIGPROF handler recording a sample of every thread.
+    '''
+    global _last_write
+    if not _running:
+        return
+
+    stacks = [_get_stack(frame)]
+    for thread_id, thread_frame in sys._current_frames().items():
+        # The main thread's frame is the one we were handed.
+        if thread_id != _main_thread_id:
+            stacks.append(_get_stack(thread_frame))
+
+    for stack in stacks:
+        _counts[stack] = _counts.get(stack, 0) + 1
+
+    if time.time() - _last_write > TS_PROFILE_WRITE_INTERVAL:
+        _last_write = time.time()
+        try:
+            _write()
+        except (IOError, OSError) as e:
+            _logger.warning('Unable to write profile: {}'.format(e))
+
+def start():
+    '''
+    Start sampling.  Each start begins a new profile.
+    '''
+    global _running, _last_write, _main_thread_id
+    if _running:
+        return
+
+    _counts.clear()
+    _last_write = time.time()
+    _main_thread_id = _get_native_thread_id()
+    signal.signal(signal.SIGPROF, _sample)
+    signal.setitimer(signal.ITIMER_PROF, TS_PROFILE_INTERVAL, TS_PROFILE_INTERVAL)
+    _running = True
+    _logger.info('Started profiler')
+
+def stop():
+    '''
+    Stop sampling and write the profile.
+    '''
+    global _running
+    if not _running:
+        return
+
+    signal.setitimer(signal.ITIMER_PROF, 0)
+    _running = False
+    _write()
+    _logger.info('Wrote profile to {}'.format(get_path()))
+
+def toggle(*args):
+    '''
+    Start sampling if stopped, otherwise stop.  Usable as a signal handler.
+    '''
+    if _running:
+        stop()
+    else:
+        start()
+
+def init():
+    '''
+    Install the SIGUSR2 toggle and start sampling if TS_PROFILE is set.
+    '''
+    try:
+        signal.signal(signal.SIGUSR2, toggle)
+        if TS_PROFILE:
+            start()
+    except (AttributeError, ValueError) as e:
+        # No SIGUSR2 or SIGPROF on this platform, or not the main thread.
+        _logger.warning('Profiler unavailable: {}'.format(e))
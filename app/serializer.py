@@ -0,0 +1,62 @@
+'''
+JSON encoding and decoding for alerts.
+
+Uses orjson when it is installed, which is several times faster than the
+standard library, and falls back to json otherwise.  Set TS_JSON_BACKEND
+to json to always use the standard library.  The backends format output
+differently so alerts stored by one won't be byte for byte equal to the
+other's.
+'''
+import config
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_logger = logging.getLogger(__name__)
+
+TS_JSON_BACKEND = config.TS_JSON_BACKEND
+
+def _get_backend():
+    '''
+    Return the name of the backend to use.
+    '''
+    if TS_JSON_BACKEND == 'json':
+        return 'json'
+
+    if orjson is None:
+        if TS_JSON_BACKEND == 'orjson':
+            _logger.warning('orjson is not installed, using json')
+        return 'json'
+
+    return 'orjson'
+
+BACKEND = _get_backend()
+
+def dumps(data):
+    '''
+    Return data encoded as UTF-8 JSON bytes.
+    '''
+    if BACKEND == 'orjson':
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # Eg. integers over 64 bits, which json handles.
+            pass
+
+    return json.dumps(data).encode('utf-8')
+
+def loads(data):
+    '''
+    Decode JSON bytes or text.
+    '''
+    if BACKEND == 'orjson':
+        return orjson.loads(data)
+
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+
+    return json.loads(data)
@@ -1,8 +1,8 @@
 '''
 Handle SNS compatibility.
 '''
+from app import clients
 from app.errors import AppBaseError
-import boto3
 from flask import jsonify, request
 from functools import wraps
 import json
@@ -38,7 +38,7 @@ def confirm_aws_sns_subscription(confirmation):
     '''
     Confirm an SNS subscription
     '''
-    sns_client = boto3.client('sns')
+    sns_client = clients.get_client('sns')
     kwargs = {'TopicArn': confirmation['TopicArn'],
               'Token': confirmation['Token'],
               'AuthenticateOnUnsubscribe': 'true'}
@@ -0,0 +1,159 @@
+'''
+Durable local spool of JSON records.
+
+Each record is its own file so records can be claimed by any worker in any
+process on the host with an atomic rename.  Layout under the spool
+directory:
+
+    tmp/       records being written
+    pending/   records waiting to be processed
+    claimed/   records being processed
+    failed/    records that ran out of attempts
+'''
+from app import files
+from app.errors import AppBaseError
+import json
+import logging
+import os
+import six
+import sys
+import time
+import uuid
+
+_logger = logging.getLogger(__name__)
+
+class SpoolError(AppBaseError):
+    '''
+    Unable to write to the local spool.
+    '''
+    status_code = 503
+
+class SpoolRecord(object):
+    '''
+    A claimed spool record.
+    '''
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    @property
+    def attempt(self):
+        '''
+        Number of times this record has been claimed.
+        '''
+        return int(self.name.rsplit('.', 2)[-2])
+
+    @property
+    def created(self):
+        '''
+        Time the record was spooled, in seconds from epoch.
+        '''
+        return int(self.name.split('-', 1)[0]) / 1000.0
+
+def _next_attempt(name):
+    '''
+    Return a record's name with its attempt number incremented.
+    '''
+    base, attempt, ext = name.rsplit('.', 2)
+    return '.'.join([base, str(int(attempt) + 1), ext])
+
+class Spool(object):
+    '''
+    A directory of JSON records processed oldest first.
+    '''
+    def __init__(self, path, max_attempts=5, claim_timeout=300):
+        self.path = path
+        self.max_attempts = max_attempts
+        for subdir in ('tmp', 'pending', 'claimed', 'failed'):
+            files.makedirs(self._path(subdir))
+        self._queue = files.ClaimQueue(self._path('pending'),
+                                       self._path('claimed'),
+                                       claim_timeout)
+
+    def _path(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def put(self, data):
+        '''
+        Durably add a record to the spool.
+        '''
+        # Names sort by spool time.  The trailing number is the attempt.
+        name = '{:013d}-{}.0.json'.format(int(time.time() * 1000), uuid.uuid4().hex)
+        tmp_path = self._path('tmp', name)
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._path('pending', name))
+            files.fsync_dir(self._path('pending'))
+        except (IOError, OSError) as e:
+            exc_info = sys.exc_info()
+            if sys.version_info >= (3,0,0):
+                raise SpoolError('Unable to spool record: {}'.format(e)).with_traceback(exc_info[2])
+            else:
+                six.reraise(SpoolError, SpoolError('Unable to spool record: {}'.format(e)), exc_info[2])
+
+        return name
+
+    def claim(self):
+        '''
+        Claim the oldest pending record.  Returns None if there are none.
+        '''
+        claimed_name = self._queue.claim(_next_attempt)
+        if claimed_name is None:
+            return None
+
+        with open(self._path('claimed', claimed_name)) as f:
+            data = json.load(f)
+
+        return SpoolRecord(claimed_name, data)
+
+    def ack(self, record):
+        '''
+        Remove a processed record.
+        '''
+        os.remove(self._path('claimed', record.name))
+
+    def release(self, record):
+        '''
+        Return a record that failed processing to the spool.
+
+        Records that have used up their attempts are moved aside to failed/.
+        '''
+        if record.attempt >= self.max_attempts:
+            _logger.error('Giving up on spool record {}'.format(record.name))
+            os.rename(self._path('claimed', record.name),
+                      self._path('failed', record.name))
+        else:
+            os.rename(self._path('claimed', record.name),
+                      self._path('pending', record.name))
+
+    def recover(self):
+        '''
+        Return claims abandoned by dead workers to pending.
+        '''
+        for name in self._queue.recover():
+            _logger.warning('Recovering abandoned spool record {}'.format(name))
+
+    def stats(self):
+        '''
+        Return spool depth and the age of the oldest record in seconds.
+        '''
+        pending = os.listdir(self._path('pending'))
+        claimed = os.listdir(self._path('claimed'))
+        failed = os.listdir(self._path('failed'))
+
+        lag = 0
+        names = pending + claimed
+        if names:
+            oldest = SpoolRecord(min(names), None).created
+            lag = max(time.time() - oldest, 0)
+
+        return {
+            'depth': len(pending) + len(claimed),
+            'pending': len(pending),
+            'in_progress': len(claimed),
+            'failed': len(failed),
+            'lag_seconds': round(lag, 3)
+        }
@@ -0,0 +1,201 @@
+'''
+Route alerts to per-tenant buckets and Threat Stack API keys.
+
+A tenant is a Threat Stack organization with its own bucket, key prefix,
+API key, connection pools and concurrency limits.  Tenants are read from
+the JSON file named by TS_TENANTS_FILE, keyed by organization ID:
+
+    {
+        "<organization_id>": {
+            "bucket": "<S3 bucket>",
+            "prefix": "<key prefix (optional)>",
+            "api_key": "<Threat Stack API key>",
+            "s3_concurrency": 10,
+            "alert_concurrency": 10,
+            "max_in_flight": 0,
+            "pool_connections": 25,
+            "api_pool_connections": 10
+        }
+    }
+
+Organizations without an entry use the default tenant built from
+TS_AWS_S3_BUCKET, TS_AWS_S3_PREFIX and THREATSTACK_API_KEY.
+
+The tenant being served is kept per thread (per greenlet under gevent).
+concurrency.imap carries it into its worker threads.
+'''
+from app.errors import AppBaseError
+import config
+from contextlib import contextmanager
+import json
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+TS_TENANTS_FILE = config.TS_TENANTS_FILE
+
+_tenants = None
+_tenants_lock = threading.Lock()
+_default_tenant = None
+_local = threading.local()
+
+class TenantError(AppBaseError):
+    '''
+    No tenant to route an organization's alerts to.
+    '''
+    status_code = 400
+
+class Tenant(object):
+    '''
+    Storage, credentials and limits for one Threat Stack organization.
+
+    The default tenant is named None.
+    '''
+    def __init__(self,
+                 name,
+                 bucket,
+                 prefix=None,
+                 api_key=None,
+                 s3_concurrency=config.TS_S3_CONCURRENCY,
+                 alert_concurrency=config.TS_ALERT_CONCURRENCY,
+                 max_in_flight=config.TS_TENANT_MAX_IN_FLIGHT,
+                 pool_connections=config.TS_AWS_MAX_POOL_CONNECTIONS,
+                 api_pool_connections=config.THREATSTACK_POOL_CONNECTIONS):
+        self.name = name
+        self.bucket = bucket
+        self.prefix = prefix
+        self.api_key = api_key
+        self.s3_concurrency = s3_concurrency
+        self.alert_concurrency = alert_concurrency
+        self.max_in_flight = max_in_flight
+        self.pool_connections = pool_connections
+        self.api_pool_connections = api_pool_connections
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+
+    @contextmanager
+    def limit(self):
+        '''
+        Wait for one of this tenant's max_in_flight alert slots.
+        '''
+        if self._in_flight is None:
+            yield
+            return
+
+        self._in_flight.acquire()
+        try:
+            yield
+        finally:
+            self._in_flight.release()
+
+def _load_tenants(path):
+    '''
+    Read tenants from a JSON file.
+    '''
+    with open(path) as f:
+        tenants_config = json.load(f)
+
+    tenants = {}
+    for organization_id, tenant_config in tenants_config.items():
+        if not tenant_config.get('bucket'):
+            raise TenantError('Tenant {} lacks a bucket'.format(organization_id))
+        tenants[organization_id] = Tenant(organization_id, **tenant_config)
+
+    _logger.info('Loaded {} tenants from {}'.format(len(tenants), path))
+
+    return tenants
+
+def get_tenants():
+    '''
+    Return configured tenants by organization ID.
+    '''
+    global _tenants
+    if _tenants is None:
+        with _tenants_lock:
+            if _tenants is None:
+                _tenants = _load_tenants(TS_TENANTS_FILE) if TS_TENANTS_FILE else {}
+
+    return _tenants
+
+def get_default_tenant():
+    '''
+    Return the tenant for organizations without their own.
+    '''
+    global _default_tenant
+    if _default_tenant is None:
+        _default_tenant = Tenant(None,
+                                 config.TS_AWS_S3_BUCKET,
+                                 prefix=config.TS_AWS_S3_PREFIX,
+                                 api_key=config.THREATSTACK_API_KEY)
+
+    return _default_tenant
+
+def get_all():
+    '''
+    Return every tenant with a bucket, the default tenant last if it has one.
+    '''
+    tenant_list = list(get_tenants().values())
+    default_tenant = get_default_tenant()
+    if default_tenant.bucket:
+        tenant_list.append(default_tenant)
+
+    return tenant_list
+
+def get_tenant(organization_id=None):
+    '''
+    Return the tenant for an organization.
+
+    Raises TenantError if the organization has no tenant and there is no
+    default bucket to fall back to.
+    '''
+    tenant = get_tenants().get(organization_id)
+    if tenant is not None:
+        return tenant
+
+    default_tenant = get_default_tenant()
+    if default_tenant.bucket is None and get_tenants():
+        raise TenantError('No tenant for organization: {}'.format(organization_id))
+
+    return default_tenant
+
+def get_current():
+    '''
+    Return the tenant being served by this thread.
+    '''
+    tenant = getattr(_local, 'tenant', None)
+    if tenant is None:
+        tenant = get_tenant()
+
+    return tenant
+
+def set_current(tenant):
+    '''
+    Set the tenant served by this thread.  None means the default tenant.
+    '''
+    _local.tenant = tenant
+
+@contextmanager
+def using(tenant):
+    '''
+    Serve tenant for the duration of a with block.
+    '''
+    previous = getattr(_local, 'tenant', None)
+    _local.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        _local.tenant = previous
+
+def bind(func):
+    '''
+    Return func wrapped to run as the current tenant from any thread.
+    '''
+    tenant = getattr(_local, 'tenant', None)
+    if tenant is None:
+        return func
+
+    def _bound(*args, **kwargs):
+        with using(tenant):
+            return func(*args, **kwargs)
+
+    return _bound
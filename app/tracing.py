@@ -0,0 +1,240 @@
+'''
+Opt-in request tracing.
+
+A traced request records a span for each S3 and Threat Stack call it makes,
+with attributes like key, bytes and retries, and logs them all as one JSON
+line when the response is finished.  Requests are traced when TS_TRACING
+is on or when they carry the TS_TRACE_HEADER header.  Untraced requests pay
+for a thread local lookup per call.
+
+The trace is kept per thread (per greenlet under gevent).
+concurrency.imap carries it into its worker threads.
+'''
+from contextlib import contextmanager
+import config
+from flask import request
+import json
+import logging
+import threading
+import time
+import uuid
+
+_logger = logging.getLogger(__name__)
+
+TS_TRACING = config.TS_TRACING
+TS_TRACE_HEADER = config.TS_TRACE_HEADER
+
+_local = threading.local()
+
+class Span(object):
+    '''
+    A timed operation within a trace.
+    '''
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def set(self, **attributes):
+        '''
+        Add attributes to the span.
+        '''
+        self.attributes.update(attributes)
+
+    def finish(self, error=None):
+        '''
+        End the span.
+        '''
+        self.end = time.time()
+        if error is not None:
+            self.error = error.__class__.__name__
+
+class _NullSpan(object):
+    '''
+    Stands in for a span when the request isn't traced.
+    '''
+    def set(self, **attributes):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+_null_span = _NullSpan()
+
+class Trace(object):
+    '''
+    The spans recorded for one request.
+    '''
+    def __init__(self, name, attributes):
+        self.id = uuid.uuid4().hex
+        self.root = Span(name, attributes)
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        '''
+        Return the trace as JSON data with times in milliseconds from its start.
+        '''
+        start = self.root.start
+
+        def _span_dict(span):
+            end = span.end if span.end is not None else time.time()
+            data = {
+                'name': span.name,
+                'start_ms': round((span.start - start) * 1000, 3),
+                'duration_ms': round((end - span.start) * 1000, 3),
+                'thread': span.thread,
+                'attributes': span.attributes
+            }
+            if span.error:
+                data['error'] = span.error
+            return data
+
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+
+        data = _span_dict(self.root)
+        data['trace_id'] = self.id
+        data['spans'] = [_span_dict(span) for span in spans]
+
+        return data
+
+def get_current():
+    '''
+    Return the trace of this thread's request, or None if not traced.
+    '''
+    return getattr(_local, 'trace', None)
+
+def start_span(name, **attributes):
+    '''
+    Start a span in the current trace.  Call finish() on the result.
+    '''
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _null_span
+
+    span = Span(name, attributes)
+    trace.add(span)
+
+    return span
+
+@contextmanager
+def span(name, **attributes):
+    '''
+    Record a with block as a span in the current trace.
+    '''
+    current_span = start_span(name, **attributes)
+    try:
+        yield current_span
+    except Exception as e:
+        current_span.finish(e)
+        raise
+    current_span.finish()
+
+def bind(func):
+    '''
+    Return func wrapped to record spans in the current trace from any thread.
+    '''
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return func
+
+    def _bound(*args, **kwargs):
+        previous = getattr(_local, 'trace', None)
+        _local.trace = trace
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.trace = previous
+
+    return _bound
+
+def _is_requested():
+    if TS_TRACING:
+        return True
+
+    return bool(TS_TRACE_HEADER and request.headers.get(TS_TRACE_HEADER))
+
+def _start_request_trace():
+    if _is_requested():
+        _local.trace = Trace('{} {}'.format(request.method, request.path),
+                             {'method': request.method, 'path': request.path})
+    else:
+        _local.trace = None
+
+def _finish_request_trace(response):
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return response
+
+    trace.root.set(status=response.status_code)
+    response.headers['X-Trace-Id'] = trace.id
+
+    # Streamed responses are still being generated so wait for the close.
+    def _log_trace():
+        trace.root.finish()
+        _logger.info('trace {}'.format(json.dumps(trace.to_dict())))
+
+    response.call_on_close(_log_trace)
+    _local.trace = None
+
+    return response
+
+def init_app(application):
+    '''
+    Trace requests to an application.
+    '''
+    application.before_request(_start_request_trace)
+    application.after_request(_finish_request_trace)
+
+def _before_aws_call(params, model, context, **kwargs):
+    current_span = start_span(
+        'aws.{}'.format(model.name),
+        bucket=params.get('Bucket'),
+        key=params.get('Key') or params.get('Prefix')
+    )
+    # boto3 may have wrapped a bytes Body in a BytesIO already.
+    body = params.get('Body')
+    if hasattr(body, '__len__'):
+        current_span.set(bytes=len(body))
+    elif hasattr(body, 'getbuffer'):
+        current_span.set(bytes=body.getbuffer().nbytes)
+    context['trace_span'] = current_span
+
+def _after_aws_call(http_response, parsed, context, **kwargs):
+    current_span = context.get('trace_span')
+    if current_span is None:
+        return
+
+    metadata = parsed.get('ResponseMetadata', {})
+    current_span.set(status=metadata.get('HTTPStatusCode'),
+                     retries=metadata.get('RetryAttempts', 0))
+    if 'ContentLength' in parsed:
+        current_span.set(bytes=parsed['ContentLength'])
+    if 'KeyCount' in parsed:
+        current_span.set(keys=parsed['KeyCount'])
+    current_span.finish()
+    if http_response.status_code >= 300:
+        current_span.error = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+
+def _after_aws_call_error(exception, context, **kwargs):
+    current_span = context.get('trace_span')
+    if current_span is not None:
+        current_span.finish(exception)
+
+def instrument_client(client):
+    '''
+    Record a span for every call made with a boto3 client.
+    '''
+    events = client.meta.events
+    # Not before-call, which stops at the first handler with a response.
+    events.register('before-parameter-build', _before_aws_call)
+    events.register('after-call', _after_aws_call)
+    events.register('after-call-error', _after_aws_call_error)
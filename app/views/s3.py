@@ -2,18 +2,32 @@
 API to archive alerts from Threat Stack to S3
 '''
 
+from app import enrichment, guards, health, ingest, metrics, serializer, tenants
 from app.errors import AppBaseError
 import app.models.s3 as s3_model
-import app.models.threatstack as threatstack_model
 from app.sns import check_aws_sns
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, g, jsonify, request
+import base64
+import datetime
 import iso8601
+import itertools
 import logging
+import re
+import time
 
 _logger = logging.getLogger(__name__)
 
 s3 = Blueprint('s3', __name__)
 
+REQUEST_SECONDS = metrics.Histogram(
+    'threatstack_to_s3_request_seconds',
+    'Time to handle a request, until its response starts.',
+    ['route', 'method', 'status']
+)
+
+# Cursors wrap a webhook reference, YYYY/MM/DD/HH/MM/<alert ID>.
+WEBHOOK_REF_RE = re.compile(r'^\d{4}/\d{2}/\d{2}/\d{2}/\d{2}/[^/]+$')
+
 class S3ViewError(AppBaseError):
     '''
     Base S3 View error class.
@@ -30,6 +44,11 @@ class S3ViewWebhookDataError(S3ViewError):
     There is an issue with the webhook data.
     '''
 
+class S3ViewQueryError(S3ViewError):
+    '''
+    Invalid query parameter.
+    '''
+
 def _parse_date(date):
     '''
     Parse a date string and return a datetime object.
@@ -39,26 +58,200 @@ def _parse_date(date):
     except iso8601.ParseError:
         raise S3ViewDateParseError('Unable to parse date: {}'.format(date))
 
+def _parse_limit(limit):
+    '''
+    Parse a page size.  None means no limit.
+    '''
+    if limit is None:
+        return None
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise S3ViewQueryError('Unable to parse limit: {}'.format(limit))
+
+    if limit < 1:
+        raise S3ViewQueryError('limit must be at least 1: {}'.format(limit))
+
+    return limit
+
+def _encode_cursor(webhook_ref):
+    '''
+    Return an opaque cursor for a webhook reference.
+    '''
+    if webhook_ref is None:
+        return None
+
+    cursor = base64.urlsafe_b64encode(webhook_ref.encode('utf-8'))
+    return cursor.decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor, start, end):
+    '''
+    Return the webhook reference in a cursor.  None means no cursor.
+
+    A cursor refers to the last webhook of a page between start and end, so
+    one from a query of another range is refused rather than followed.
+    '''
+    if not cursor:
+        return None
+
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        webhook_ref = base64.urlsafe_b64decode(str(cursor + padding)).decode('utf-8')
+        if not WEBHOOK_REF_RE.match(webhook_ref):
+            raise ValueError(webhook_ref)
+        webhook_time = datetime.datetime.strptime(webhook_ref[:len('YYYY/MM/DD/HH/MM')],
+                                                  '%Y/%m/%d/%H/%M')
+    except (TypeError, ValueError):
+        raise S3ViewQueryError('Invalid cursor: {}'.format(cursor))
+
+    if not start < webhook_time.replace(tzinfo=iso8601.UTC) < end:
+        raise S3ViewQueryError('Cursor is not from a query of this range: {}'.format(cursor))
+
+    return webhook_ref
+
+def _get_list_parameter(name):
+    '''
+    Return values of a repeatable, comma separated request parameter.
+    '''
+    values = []
+    for value in request.args.getlist(name) + request.form.getlist(name):
+        values += [v.strip() for v in value.split(',') if v.strip()]
+
+    return values
+
+def _get_filters():
+    '''
+    Return alert filters given in the request.
+    '''
+    filters = {}
+    for field in s3_model.FILTER_FIELDS:
+        values = _get_list_parameter(field)
+        if values:
+            filters[field] = set(values)
+
+    return filters
+
+def _get_if_none_match():
+    '''
+    Return the ETags in the request's If-None-Match header.
+
+    If-None-Match uses weak comparison so weak ETags are returned as their
+    strong form.
+    '''
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return []
+
+    etags = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag:
+            etags.append(etag)
+
+    return etags
+
+def _not_modified(etag):
+    '''
+    Return a 304 response for etag.
+    '''
+    return Response(status=304, headers={'ETag': etag})
+
+def _stream_alerts(alerts, paginated=False, next_cursor=None):
+    '''
+    Generate a JSON alerts response one alert at a time.
+
+    Alerts already encoded, as bytes, are passed through as they are.
+    '''
+    yield b'{"success": true, "alerts": ['
+    for count, alert in enumerate(alerts):
+        if count:
+            yield b', '
+        yield alert if isinstance(alert, bytes) else serializer.dumps(alert)
+    yield b']'
+    if paginated:
+        yield b', "next_cursor": ' + serializer.dumps(next_cursor)
+    yield b'}'
+
+@s3.before_request
+def _start_timer():
+    g.request_start = time.time()
+
+@s3.after_request
+def _record_request(response):
+    # The rule, not the path, so alert IDs don't each get a series.
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_SECONDS.observe(time.time() - g.request_start,
+                            route=route,
+                            method=request.method,
+                            status=response.status_code)
+    return response
+
+@s3.before_request
+def _set_tenant():
+    '''
+    Serve the tenant named by the organization_id parameter, if any.
+
+    organization_id also filters alerts, but with tenants configured a
+    request can only read one organization's tenant.  Webhook alerts are
+    routed by their own organization_id.
+    '''
+    organization_ids = _get_list_parameter('organization_id')
+    if len(organization_ids) > 1 and tenants.get_tenants():
+        raise S3ViewQueryError(
+            'Only one organization_id may be given: {}'.format(','.join(organization_ids)))
+
+    organization_id = organization_ids[0] if organization_ids else None
+    tenants.set_current(tenants.get_tenant(organization_id) if organization_id else None)
+
 # Service routes.
+@s3.route('/live', methods=['GET'])
+def is_alive():
+    '''
+    Report that the service is up without checking its dependencies.
+    '''
+    return jsonify(success=True), 200
+
 @s3.route('/status', methods=['GET'])
 def is_available():
     '''
-    Test that Threat Stack and S3 bucket are reachable.
+    Report whether Threat Stack and S3 bucket are reachable.
+
+    Dependencies are checked in the background, so this reports the last
+    check and its age.  Responds 503 if the last check failed.
     '''
     _logger.info('{}: {}'.format(request.method, request.path))
-    s3_status = s3_model.is_available()
-    s3_info = {'success': s3_status}
+    status = health.get_status()
+    s3_info = status['s3']
+    cache_stats = s3_model.get_cache_stats()
+    if cache_stats is not None:
+        s3_info['cache'] = cache_stats
 
-    ts_status = threatstack_model.is_available()
-    ts_info = {'success': ts_status}
+    ts_info = status['threatstack']
 
-    status_code = 200
-    if s3_status and ts_status:
+    guard_stats = guards.get_stats(tenants.get_current().name)
+    if 's3' in guard_stats:
+        s3_info['guard'] = guard_stats['s3']
+    if 'threatstack' in guard_stats:
+        ts_info['guard'] = guard_stats['threatstack']
+
+    if s3_info['success'] and ts_info['success']:
         success = True
+        status_code = 200
     else:
         success = False
+        status_code = 503
 
-    return jsonify(success=success, s3=s3_info, threatstack=ts_info), status_code
+    return jsonify(success=success, age=status['age'], s3=s3_info, threatstack=ts_info), status_code
+
+@s3.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Report service metrics in the Prometheus text format.
+    '''
+    return Response(metrics.render(), status=200, content_type=metrics.CONTENT_TYPE)
 
 @s3.route('/alert', methods=['POST'])
 @check_aws_sns
@@ -91,19 +284,37 @@ def put_alert():
             msg = "alert lacks 'created_at' field: {}".format(webhook_data)
             raise S3ViewWebhookDataError(msg)
 
-    # Process alerts in webhook
-    for alert in webhook_data.get('alerts'):
-        alert_full = threatstack_model.get_alert_by_id(alert.get('id'))
+        # Raises if there is nowhere to archive the alert.
+        tenants.get_tenant(alert.get('organization_id'))
 
-        s3_model.put_webhook_data(alert)
-        s3_model.put_alert_data(alert_full)
+    # Process alerts in webhook, or leave that to the ingest workers.
+    if ingest.is_async():
+        ingest.enqueue_webhook(webhook_data)
+        status_code = 202
+    else:
+        ingest.archive_webhook(webhook_data)
+        status_code = 200
 
-    status_code = 200
     success = True
     response = {'success': success}
 
     return jsonify(response), status_code
 
+@s3.route('/ingest/status', methods=['GET'])
+def get_ingest_status():
+    '''
+    Report ingest mode and spool queue depth and lag.
+    '''
+    _logger.info('{}: {}'.format(request.method, request.path))
+    status_code = 200
+    success = True
+    response = {
+        'success': success,
+        'ingest': ingest.get_status()
+    }
+
+    return jsonify(response), status_code
+
 @s3.route('/alert', methods=['GET'])
 def get_alerts_by_form_parameters():
     '''
@@ -111,6 +322,8 @@ def get_alerts_by_form_parameters():
     '''
     start = request.args.get('start') or request.form.get('start')
     end = request.args.get('end') or request.form.get('end')
+    limit = request.args.get('limit') or request.form.get('limit')
+    cursor = request.args.get('cursor') or request.form.get('cursor')
 
     _logger.info('{}: {} - {}'.format(request.method,
                                       request.path,
@@ -119,16 +332,44 @@ def get_alerts_by_form_parameters():
     # Convert to datetime objects
     start_datetime = _parse_date(start)
     end_datetime = _parse_date(end)
+    limit = _parse_limit(limit)
+    after = _decode_cursor(cursor, start_datetime, end_datetime)
+    filters = _get_filters()
+    fields = _get_list_parameter('fields')
 
-    alerts = s3_model.get_alerts_by_date(start_datetime, end_datetime)
-    status_code = 200
-    success = True
-    response = {
-        'success': success,
-        'alerts': alerts
-    }
+    alert_ids, next_after = s3_model.get_alert_ids_page_by_date(
+        start_datetime,
+        end_datetime,
+        limit,
+        after,
+        filters
+    )
+    next_cursor = _encode_cursor(next_after)
 
-    return jsonify(response), status_code
+    # Archived alerts don't change so the same IDs mean the same response.
+    etag = s3_model.get_alert_ids_etag(alert_ids + [next_cursor or ''] + fields)
+    etags = _get_if_none_match()
+    if '*' in etags or etag in etags:
+        return _not_modified(etag)
+
+    # Whole alerts are passed through as stored rather than decoded and
+    # encoded again.  Alerts whose details weren't archived are fetched now,
+    # and if that fails so does the request: the ETag covers every ID, so a
+    # response leaving one out would be cached as complete.
+    alerts = s3_model.iter_alerts_by_id(alert_ids, fields, enrichment.get_missing_alert, raw=True)
+
+    # Fetch the first alert before we start responding so a failure can
+    # still be returned as an error response.  Later failures can only cut
+    # the response short, which clients don't take as complete.
+    first_alert = list(itertools.islice(alerts, 1))
+    alerts = itertools.chain(first_alert, alerts)
+
+    status_code = 200
+    paginated = limit is not None
+    return Response(_stream_alerts(alerts, paginated, next_cursor),
+                    status=status_code,
+                    mimetype='application/json',
+                    headers={'ETag': etag})
 
 @s3.route('/alert/<alert_id>', methods=['GET'])
 def get_alert_by_id(alert_id):
@@ -136,13 +377,17 @@ def get_alert_by_id(alert_id):
     Get an alert by alert ID.
     '''
     _logger.info('{}: {}'.format(request.method, request.path))
-    alert = s3_model.get_alert_by_id(alert_id)
+    alert_data, etag = enrichment.get_alert_data_with_etag(alert_id, _get_if_none_match())
+    if alert_data is None:
+        return _not_modified(etag)
+
+    # The stored alert is spliced into the response rather than decoded and
+    # encoded again.
     status_code = 200
-    success = True
-    response = {
-        'success': success,
-        'alert': alert
-    }
+    response = b'{"success": true, "alert": ' + alert_data + b'}'
 
-    return jsonify(response), status_code
+    return Response(response,
+                    status=status_code,
+                    mimetype='application/json',
+                    headers={'ETag': etag})
 
@@ -0,0 +1,468 @@
+'''
+Write-ahead log of S3 writes made while S3 is failing.
+
+A write that fails is appended to a local log instead of failing the
+webhook, and later writes for the same tenant skip S3 and go straight to
+the log until its bucket recovers.  Writes that can never succeed, eg. to a
+bucket that doesn't exist, fail as usual.  A background flusher replays the log with the same writers, so
+replayed objects land on the same keys and replaying twice is harmless.
+
+The log is a directory of append-only segment files, one line per record:
+
+    active/      segments being appended to by a process
+    sealed/      segments waiting to be replayed
+    replaying/   segments being replayed
+    failed/      records that can never be replayed
+
+Each line carries a CRC32 of its JSON so a torn write at the end of a
+segment is skipped instead of stopping replay.
+'''
+from app import concurrency, files, guards, metrics, tenants
+from app.errors import AppBaseError, log_exception
+import app.models.s3 as s3_model
+import collections
+import config
+import json
+import logging
+import os
+import six
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+WAL_RECORDS = metrics.Counter(
+    'threatstack_to_s3_wal_records_total',
+    'S3 writes appended to and replayed from the write-ahead log.',
+    ['event']
+)
+
+TS_WAL = config.TS_WAL
+TS_WAL_DIR = config.TS_WAL_DIR
+TS_WAL_SEGMENT_BYTES = config.TS_WAL_SEGMENT_BYTES
+TS_WAL_REPLAY_CONCURRENCY = config.TS_WAL_REPLAY_CONCURRENCY
+
+# Seconds between flusher passes, and the longest it backs off while S3 is
+# still failing.
+FLUSH_INTERVAL = 1.0
+MAX_RETRY_DELAY = 60
+
+# Seconds over which the replay rate is reported.
+REPLAY_RATE_WINDOW = 60
+
+# How each kind of record is written to S3.
+WRITERS = {
+    'webhook': s3_model.put_webhook_data,
+    'alert': s3_model.put_alert_data
+}
+
+# Errors meaning S3 is failing, or we've stopped calling it for now.
+S3_ERRORS = (s3_model.S3ClientError, guards.DependencyUnavailableError)
+
+# Outcomes of replaying a record.
+REPLAYED = 'replayed'
+RETRY = 'retry'
+FAILED = 'failed'
+
+_wal = None
+_wal_lock = threading.Lock()
+_flusher = None
+# Names of tenants whose S3 writes are failing.
+_degraded = set()
+_replay_concurrency = 1
+_replayed = collections.deque()
+
+class WALError(AppBaseError):
+    '''
+    Unable to write to the write-ahead log.
+    '''
+    status_code = 503
+
+class WriteAheadLog(object):
+    '''
+    A directory of append-only segment files.
+
+    Each process appends to its own active segment.  Segments are sealed
+    before they are replayed, and claimed for replay with an atomic rename
+    so any process on the host can replay any segment.
+    '''
+    def __init__(self, path, segment_bytes=16 * 1024 * 1024, claim_timeout=300):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._name = None
+        for subdir in ('active', 'sealed', 'replaying', 'failed'):
+            files.makedirs(self._path(subdir))
+        self._queue = files.ClaimQueue(self._path('sealed'),
+                                       self._path('replaying'),
+                                       claim_timeout)
+
+    def _path(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def _new_name(self):
+        # Names sort by creation time.
+        return '{:013d}-{}.wal'.format(int(time.time() * 1000), uuid.uuid4().hex)
+
+    def append(self, record):
+        '''
+        Durably append a record to this process's active segment.
+        '''
+        line = _encode_record(record)
+        try:
+            with self._lock:
+                if self._file is None:
+                    self._name = self._new_name()
+                    self._file = open(self._path('active', self._name), 'a')
+                    files.fsync_dir(self._path('active'))
+                self._file.write(line)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                if self._file.tell() >= self.segment_bytes:
+                    self._seal()
+        except (IOError, OSError) as e:
+            exc_info = sys.exc_info()
+            if sys.version_info >= (3,0,0):
+                raise WALError('Unable to append to write-ahead log: {}'.format(e)).with_traceback(exc_info[2])
+            else:
+                six.reraise(WALError, WALError('Unable to append to write-ahead log: {}'.format(e)), exc_info[2])
+
+    def seal(self):
+        '''
+        Make this process's active segment available for replay.
+        '''
+        with self._lock:
+            self._seal()
+
+    def _seal(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.rename(self._path('active', self._name), self._path('sealed', self._name))
+        files.fsync_dir(self._path('sealed'))
+        self._file = None
+        self._name = None
+
+    def claim(self):
+        '''
+        Claim the oldest sealed segment.
+
+        Returns the segment name and its records, or None if there are none.
+        '''
+        name = self._queue.claim()
+        if name is None:
+            return None
+
+        return name, _read_segment(self._path('replaying', name))
+
+    def touch(self, name):
+        '''
+        Keep a claimed segment from being recovered as abandoned.
+        '''
+        self._queue.touch(name)
+
+    def complete(self, name):
+        '''
+        Remove a replayed segment.
+        '''
+        os.remove(self._path('replaying', name))
+
+    def requeue(self, name, records):
+        '''
+        Replace a claimed segment with the records still to be replayed.
+        '''
+        self._write_segment('sealed', records)
+        os.remove(self._path('replaying', name))
+
+    def fail(self, records):
+        '''
+        Set aside records that can never be replayed.
+        '''
+        self._write_segment('failed', records)
+
+    def _write_segment(self, subdir, records):
+        if not records:
+            return
+        name = self._new_name()
+        path = self._path('active', name)
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(_encode_record(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path, self._path(subdir, name))
+        files.fsync_dir(self._path(subdir))
+
+    def recover(self):
+        '''
+        Return segments abandoned by dead processes to sealed.
+
+        Live processes seal their active segment every flush and touch
+        segments they are replaying, so only abandoned ones go stale.
+        '''
+        for name in self._queue.recover([self._path('active')], [self._name]):
+            _logger.warning('Recovering abandoned write-ahead log segment {}'.format(name))
+
+    def stats(self):
+        '''
+        Return the segments and bytes waiting to be replayed and the age of
+        the oldest in seconds.
+        '''
+        segments = 0
+        size = 0
+        oldest = None
+        for subdir in ('active', 'sealed', 'replaying'):
+            for name in os.listdir(self._path(subdir)):
+                try:
+                    size += os.path.getsize(self._path(subdir, name))
+                except OSError:
+                    continue
+                segments += 1
+                created = int(name.split('-', 1)[0]) / 1000.0
+                oldest = created if oldest is None else min(oldest, created)
+
+        return {
+            'segments': segments,
+            'bytes': size,
+            'failed_segments': len(os.listdir(self._path('failed'))),
+            'oldest_seconds': round(max(time.time() - oldest, 0), 3) if oldest else 0
+        }
+
+def _get_crc(payload):
+    return '{:08x}'.format(zlib.crc32(payload.encode('utf-8')) & 0xffffffff)
+
+def _encode_record(record):
+    '''
+    Return a record as a segment line.
+    '''
+    payload = json.dumps(record, sort_keys=True)
+    return '{} {}\n'.format(_get_crc(payload), payload)
+
+def _read_segment(path):
+    '''
+    Return the intact records in a segment file.
+    '''
+    records = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            crc, _, payload = line.rstrip('\n').partition(' ')
+            if crc != _get_crc(payload):
+                _logger.warning('Skipping corrupt record {} of {}'.format(line_number, path))
+                continue
+            records.append(json.loads(payload))
+
+    return records
+
+def is_enabled():
+    '''
+    Return whether failed S3 writes are logged for replay.
+    '''
+    return TS_WAL
+
+def get_wal():
+    '''
+    Return the write-ahead log, creating it if needed.
+    '''
+    global _wal
+    if _wal is None:
+        with _wal_lock:
+            if _wal is None:
+                _wal = WriteAheadLog(TS_WAL_DIR, TS_WAL_SEGMENT_BYTES)
+
+    return _wal
+
+def _is_permanent_error(error):
+    '''
+    Return whether a failed write would fail again on replay.
+    '''
+    return isinstance(error, s3_model.S3ClientError) and s3_model.is_permanent_error(error)
+
+def _set_degraded(tenant_name, degraded):
+    '''
+    Record whether a tenant's S3 writes are failing.
+    '''
+    if degraded and tenant_name not in _degraded:
+        _logger.warning('S3 writes for tenant {} are failing, logging them for replay'.format(tenant_name))
+        _degraded.add(tenant_name)
+    elif not degraded and tenant_name in _degraded:
+        _logger.info('S3 writes for tenant {} are succeeding again'.format(tenant_name))
+        _degraded.discard(tenant_name)
+
+def write(kind, data):
+    '''
+    Write data to S3 as the current tenant, or log it for replay.
+
+    kind names the writer in WRITERS.  Writes go straight to the log while
+    the tenant's S3 writes are failing.  Errors that replaying can't fix
+    are raised.
+    '''
+    if not TS_WAL:
+        return WRITERS[kind](data)
+
+    tenant_name = tenants.get_current().name
+    if tenant_name not in _degraded:
+        try:
+            return WRITERS[kind](data)
+        except S3_ERRORS as e:
+            if _is_permanent_error(e):
+                raise
+            log_exception(e)
+            _set_degraded(tenant_name, True)
+
+    get_wal().append({'tenant': tenant_name, 'kind': kind, 'data': data})
+    WAL_RECORDS.inc(event='appended')
+
+    return None
+
+def _get_record_tenant(record):
+    '''
+    Return the tenant a record was written as, or None if it is gone.
+    '''
+    name = record.get('tenant')
+    if name is None:
+        return tenants.get_default_tenant()
+
+    return tenants.get_tenants().get(name)
+
+def _replay_record(record):
+    '''
+    Replay a record.  Returns REPLAYED, RETRY or FAILED.
+    '''
+    try:
+        with tenants.using(_get_record_tenant(record)):
+            WRITERS[record['kind']](record['data'])
+    except S3_ERRORS as e:
+        log_exception(e)
+        return FAILED if _is_permanent_error(e) else RETRY
+
+    return REPLAYED
+
+def replay_segment(wal, name, records):
+    '''
+    Replay a claimed segment's records in batches.
+
+    Batches grow by one record at a time while they succeed, up to
+    TS_WAL_REPLAY_CONCURRENCY run at once, and drop back to one record
+    when any fails.  Once one of a tenant's records fails its remaining
+    records are left for a later pass while other tenants' are replayed.
+    Records S3 rejects for good are set aside.  Returns whether every
+    record was replayed.
+    '''
+    global _replay_concurrency
+    replayable = [r for r in records if r.get('kind') in WRITERS and _get_record_tenant(r)]
+    if len(replayable) < len(records):
+        _logger.error('Setting aside {} write-ahead log records for unknown tenants or writers'.format(
+            len(records) - len(replayable)))
+        wal.fail([r for r in records if r not in replayable])
+    records = replayable
+
+    retry = []
+    failed = []
+    failing_tenants = set()
+    while records:
+        batch, records = records[:_replay_concurrency], records[_replay_concurrency:]
+        results = concurrency.map(_replay_record, batch, len(batch))
+
+        replayed = 0
+        for record, result in zip(batch, results):
+            if result == REPLAYED:
+                replayed += 1
+                _set_degraded(record.get('tenant'), False)
+            elif result == RETRY:
+                retry.append(record)
+                failing_tenants.add(record.get('tenant'))
+                _set_degraded(record.get('tenant'), True)
+            else:
+                # S3 is answering, just not in our favor.
+                failed.append(record)
+                _set_degraded(record.get('tenant'), False)
+
+        if replayed:
+            WAL_RECORDS.inc(replayed, event='replayed')
+            _replayed.append((time.time(), replayed))
+
+        if replayed == len(batch):
+            _replay_concurrency = min(_replay_concurrency + 1, TS_WAL_REPLAY_CONCURRENCY)
+        else:
+            _replay_concurrency = 1
+
+        # Don't keep calling a bucket that is failing.
+        retry.extend(r for r in records if r.get('tenant') in failing_tenants)
+        records = [r for r in records if r.get('tenant') not in failing_tenants]
+        wal.touch(name)
+
+    if failed:
+        _logger.error('Setting aside {} write-ahead log records S3 rejected'.format(len(failed)))
+        WAL_RECORDS.inc(len(failed), event='failed')
+        wal.fail(failed)
+
+    if retry:
+        WAL_RECORDS.inc(len(retry), event='replay_failed')
+        wal.requeue(name, retry)
+        return False
+
+    wal.complete(name)
+
+    return True
+
+def _flush():
+    '''
+    Flusher loop replaying sealed segments.
+    '''
+    wal = get_wal()
+    failures = 0
+    while True:
+        delay = FLUSH_INTERVAL
+        try:
+            wal.seal()
+            wal.recover()
+            while True:
+                claimed = wal.claim()
+                if claimed is None:
+                    failures = 0
+                    break
+                if not replay_segment(wal, *claimed):
+                    # Don't hammer S3 while it is still failing.
+                    failures += 1
+                    delay = min(2 ** failures, MAX_RETRY_DELAY)
+                    break
+        except Exception as e:
+            log_exception(e)
+
+        time.sleep(delay)
+
+def start_flusher():
+    '''
+    Start the background flusher replaying the log.
+    '''
+    global _flusher
+    if _flusher is not None:
+        return
+
+    _flusher = threading.Thread(target=_flush, name='wal-flusher')
+    _flusher.daemon = True
+    _flusher.start()
+    _logger.info('Started write-ahead log flusher')
+
+def get_stats():
+    '''
+    Return write-ahead log size, age and replay rate.
+    '''
+    now = time.time()
+    while _replayed and _replayed[0][0] < now - REPLAY_RATE_WINDOW:
+        _replayed.popleft()
+    replayed = sum(count for _, count in list(_replayed))
+
+    stats = get_wal().stats()
+    stats.update({
+        'degraded': bool(_degraded),
+        'degraded_tenants': sorted(_degraded, key=str),
+        'replay_concurrency': _replay_concurrency,
+        'replay_rate': round(replayed / float(REPLAY_RATE_WINDOW), 3)
+    })
+
+    return stats
@@ -0,0 +1,8 @@
+'''
+Benchmarks run against local S3 and Threat Stack stand-ins.
+
+Run from the repository root:
+
+    python -m bench.run --keys 10000 --save bench/baseline.json
+    python -m bench.coldstart --budget-ms 1500
+'''
@@ -0,0 +1,111 @@
+'''
+Synthetic alert archives.
+
+Alert IDs carry their creation time like Threat Stack's so webhook and
+alert bodies can be rendered from the key alone, which lets the S3
+stand-in hold archives of millions of alerts without storing bodies.
+'''
+import calendar
+import datetime
+import json
+import time
+
+ARCHIVE_START = datetime.datetime(2017, 1, 1)
+ARCHIVE_DAYS = 30
+
+SEVERITIES = (1, 2, 3)
+SOURCES = ('host', 'cloudtrail', 'file integrity')
+
+def make_alert_id(timestamp, number):
+    '''
+    Return an ObjectId style alert ID for a time in seconds and a counter.
+    '''
+    return '{:08x}{:016x}'.format(int(timestamp), number)
+
+def parse_alert_id(alert_id):
+    '''
+    Return the time in seconds and counter of an alert ID.
+    '''
+    return int(alert_id[0:8], 16), int(alert_id[8:], 16)
+
+def get_webhook_key(alert_id):
+    timestamp, _ = parse_alert_id(alert_id)
+    return 'webhooks/{}/{}'.format(time.strftime('%Y/%m/%d/%H/%M', time.gmtime(timestamp)), alert_id)
+
+def get_alert_key(alert_id):
+    return 'alerts/{}/{}/{}'.format(alert_id[0:2], alert_id[2:4], alert_id)
+
+def get_webhook(alert_id):
+    '''
+    Return the webhook data of an alert.
+    '''
+    timestamp, number = parse_alert_id(alert_id)
+    return {
+        'id': alert_id,
+        'title': 'Suspicious activity detected by rule {}'.format(number % 50),
+        'created_at': timestamp * 1000,
+        'severity': SEVERITIES[number % len(SEVERITIES)],
+        'organization_id': 'bench',
+        'server_or_region': 'host-{}'.format(number % 20),
+        'source': SOURCES[number % len(SOURCES)]
+    }
+
+def get_alert(alert_id):
+    '''
+    Return the alert details Threat Stack would return for an alert.
+    '''
+    timestamp, number = parse_alert_id(alert_id)
+    alert = get_webhook(alert_id)
+    alert.update({
+        'rule_id': 'rule-{}'.format(number % 50),
+        'ruleset_id': 'ruleset-1',
+        'agent_id': 'agent-{}'.format(number % 20),
+        'expires_at': (timestamp + 86400) * 1000,
+        'latest_events': [
+            {
+                'timestamp': timestamp * 1000 + i,
+                'type': 'audit',
+                'syscall': 'execve',
+                'exe': '/usr/bin/curl',
+                'args': ['curl', '-s', 'http://example.com/{}'.format(i)],
+                'user': 'www-data',
+                'session': number + i,
+                'tty': None,
+                'cwd': '/var/www'
+            }
+            for i in range(4)
+        ]
+    })
+
+    return alert
+
+def synthesize(key):
+    '''
+    Render the body of a webhook or alert key.
+    '''
+    alert_id = key.rsplit('/', 1)[-1]
+    if key.startswith('webhooks/'):
+        data = get_webhook(alert_id)
+    else:
+        data = get_alert(alert_id)
+
+    return json.dumps(data).encode('utf-8')
+
+def generate(count, start=ARCHIVE_START, days=ARCHIVE_DAYS):
+    '''
+    Return the IDs of count alerts spread evenly over days from start.
+    '''
+    first = calendar.timegm(start.timetuple())
+    interval = days * 86400.0 / count
+
+    return [make_alert_id(first + i * interval, i) for i in range(count)]
+
+def get_keys(alert_ids):
+    '''
+    Return the sorted webhook and alert keys of an archive.
+    '''
+    keys = [get_webhook_key(alert_id) for alert_id in alert_ids]
+    keys.extend(get_alert_key(alert_id) for alert_id in alert_ids)
+    keys.sort()
+
+    return keys
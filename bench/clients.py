@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+'''
+Measure what creating an AWS client per call costs against sharing one.
+
+Times getting an S3 client the way the service used to, a new boto3
+client for every call, against app.clients.get_client(), and the same
+with a HeadObject against the S3 stand-in so the connection each new
+client opens is counted too.
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import sys
+from timeit import default_timer as timer
+
+from bench import s3server
+
+KEY = 'bench/object'
+
+def _parse_args(argv=None):
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=100,
+                        help='Calls per round (default: 100).')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Rounds to run, the fastest is reported (default: 5).')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare results with a saved baseline.')
+
+    return parser.parse_args(argv)
+
+def _configure(s3):
+    '''
+    Point the service at the stand-in before it reads its settings.
+    '''
+    os.environ.update({
+        'TS_AWS_S3_ENDPOINT_URL': s3.url,
+        'TS_AWS_S3_BUCKET': 'bench',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1'
+    })
+
+def _time(function, calls, rounds):
+    '''
+    Return the fastest round's microseconds per call.
+    '''
+    best = None
+    for _ in range(rounds):
+        start = timer()
+        for _ in range(calls):
+            function()
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return round(best * 1e6 / calls, 1)
+
+def main(argv=None):
+    args = _parse_args(argv)
+
+    store = s3server.S3Store()
+    store.put(KEY, b'{}')
+    s3 = s3server.start(store)
+    _configure(s3)
+
+    # Settings are read when the service is imported.
+    import boto3
+    from app import clients
+
+    def _new_client():
+        return boto3.client('s3', endpoint_url=s3.url)
+
+    def _shared_client():
+        return clients.get_client('s3')
+
+    results = {}
+    for name, get_client in (('per_call', _new_client), ('shared', _shared_client)):
+        s3.reset_stats()
+        client_us = _time(get_client, args.calls, args.rounds)
+
+        def _head_object():
+            get_client().head_object(Bucket='bench', Key=KEY)
+
+        s3.reset_stats()
+        head_object_us = _time(_head_object, args.calls, args.rounds)
+        results[name] = {
+            'client_us': client_us,
+            'head_object_us': head_object_us,
+            'connections': round(float(s3.connections) / (args.calls * args.rounds), 3)
+        }
+
+    print('{:10} {:>12} {:>16} {:>18}'.format('client', 'client_us', 'head_object_us', 'connections/call'))
+    for name in ('per_call', 'shared'):
+        result = results[name]
+        print('{:10} {:>12} {:>16} {:>18}'.format(
+            name, result['client_us'], result['head_object_us'], result['connections']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\nCompared with baseline:')
+        for name in ('per_call', 'shared'):
+            for measure in ('client_us', 'head_object_us'):
+                before = baseline.get(name, {}).get(measure)
+                value = results[name][measure]
+                if before:
+                    print('  {:10} {:16} {} -> {} ({:+.1f}%)'.format(
+                        name, measure, before, value, (value - before) * 100.0 / before))
+
+    if args.save:
+        output = {
+            'meta': {
+                'calls': args.calls,
+                'rounds': args.rounds,
+                'python': platform.python_version(),
+                'boto3': boto3.__version__
+            },
+            'results': results
+        }
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.save))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+'''
+Measure cold start time against a budget.
+
+Each run starts a fresh interpreter, as a Lambda cold start does, and times
+importing the app, create_app() and the first and second alert reads from
+the S3 stand-in.  Runs are set up like Lambda, so clients are preloaded
+unless --env TS_PRELOAD_CLIENTS=false is passed.  Exits non-zero if the
+median cold start, import through first response, is over --budget-ms.
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+
+from bench import archive, s3server, threatstack_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ('import', 'init', 'first_request', 'second_request', 'cold_start')
+
+# Runs in the fresh interpreter and prints its timings as JSON.
+CHILD = '''
+from timeit import default_timer as timer
+import json, sys
+started = timer()
+from app import create_app
+imported = timer()
+application = create_app()
+initialized = timer()
+client = application.test_client()
+timings = {'import': imported - started, 'init': initialized - imported}
+for phase in ('first_request', 'second_request'):
+    start = timer()
+    response = client.get('/threatstack-to-s3/api/v1/s3/alert/' + sys.argv[1])
+    response.get_data()
+    timings[phase] = timer() - start
+    if response.status_code != 200:
+        sys.exit('{} failed: {}'.format(phase, response.status_code))
+timings['cold_start'] = timings['first_request'] + initialized - started
+print(json.dumps(timings))
+'''
+
+def _parse_args(argv=None):
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Cold starts to measure (default: 5).')
+    parser.add_argument('--budget-ms', type=float, default=1500,
+                        help='Median cold start budget in milliseconds (default: 1500).')
+    parser.add_argument('--top', type=int, default=0,
+                        help='Also list the N slowest imports.')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='Service setting for the runs.  May be repeated.')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare results with a saved baseline.')
+
+    return parser.parse_args(argv)
+
+def _get_env(args, s3, threatstack):
+    env = dict(os.environ)
+    env.update({
+        'AWS_LAMBDA_FUNCTION_NAME': 'threatstack-to-s3-bench',
+        'TS_AWS_S3_ENDPOINT_URL': s3.url,
+        'TS_AWS_S3_BUCKET': 'bench',
+        'THREATSTACK_BASE_URL': threatstack.url,
+        'THREATSTACK_API_KEY': 'bench',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'PYTHONDONTWRITEBYTECODE': ''
+    })
+    env.update(dict(setting.split('=', 1) for setting in args.env))
+
+    return env
+
+def _run(env, alert_id, options=()):
+    '''
+    Return the timings and stderr of one cold start.
+    '''
+    process = subprocess.Popen([sys.executable] + list(options) + ['-c', CHILD, alert_id],
+                               cwd=ROOT, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError('Cold start failed:\n' + stderr)
+
+    return json.loads(stdout.strip().splitlines()[-1]), stderr
+
+def _get_slowest_imports(stderr, count):
+    '''
+    Return the count top level imports with the largest cumulative time.
+    '''
+    imports = []
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+        if match and not match.group(2).startswith(' '):
+            imports.append((int(match.group(1)), match.group(2)))
+
+    return sorted(imports, reverse=True)[:count]
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main(argv=None):
+    args = _parse_args(argv)
+
+    alert_ids = archive.generate(100)
+    store = s3server.S3Store(archive.synthesize)
+    store.add_synthetic_keys(archive.get_keys(alert_ids))
+    s3 = s3server.start(store)
+    threatstack = threatstack_server.start(archive.get_alert)
+    env = _get_env(args, s3, threatstack)
+
+    runs = [_run(env, alert_ids[i % len(alert_ids)])[0] for i in range(args.runs)]
+    results = dict((phase, round(_median([run[phase] for run in runs]) * 1000, 3)) for phase in PHASES)
+
+    for phase in PHASES:
+        print('{:15} {:>10} ms'.format(phase, results[phase]))
+
+    if args.top:
+        _, stderr = _run(env, alert_ids[0], ['-X', 'importtime'])
+        print('\nSlowest imports:')
+        for microseconds, module in _get_slowest_imports(stderr, args.top):
+            print('  {:>10.3f} ms  {}'.format(microseconds / 1000.0, module))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\nCompared with baseline:')
+        for phase in PHASES:
+            if baseline.get(phase):
+                change = (results[phase] - baseline[phase]) * 100.0 / baseline[phase]
+                print('  {:15} {} -> {} ms ({:+.1f}%)'.format(phase, baseline[phase], results[phase], change))
+
+    if args.save:
+        output = {
+            'meta': {
+                'runs': args.runs,
+                'settings': dict(setting.split('=', 1) for setting in args.env),
+                'python': platform.python_version()
+            },
+            'results': results
+        }
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.save))
+
+    over_budget = results['cold_start'] > args.budget_ms
+    print('\nCold start {} ms is {} the {} ms budget'.format(
+        results['cold_start'], 'over' if over_budget else 'within', args.budget_ms))
+
+    return 1 if over_budget else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
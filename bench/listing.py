@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+'''
+Count the S3 list calls date-range queries make against a full listing.
+
+Builds a synthetic archive in the S3 stand-in and, for each range length,
+finds the alerts in ranges starting at random times twice: with the walk
+of time prefixes the service plans, and by listing every key under
+webhooks/ and filtering by time as the service used to.  Reports the list
+calls and time per query for each, and exits non-zero if they ever find
+different alerts.
+'''
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+from timeit import default_timer as timer
+
+from bench import archive, s3server
+
+def _parse_args(argv=None):
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=20000,
+                        help='Alerts in the synthetic archive (default: 20000).')
+    parser.add_argument('--ranges', default='5,60,1440',
+                        help='Comma separated range lengths in minutes (default: 5,60,1440).')
+    parser.add_argument('--queries', type=int, default=5,
+                        help='Queries per range length (default: 5).')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed (default: 1).')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare results with a saved baseline.')
+
+    return parser.parse_args(argv)
+
+def _configure(s3):
+    '''
+    Point the service at the stand-in before it reads its settings.
+    '''
+    os.environ.update({
+        'TS_AWS_S3_ENDPOINT_URL': s3.url,
+        'TS_AWS_S3_BUCKET': 'bench',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1'
+    })
+    # Compare listings, not the index.
+    os.environ.pop('TS_S3_INDEX_READS', None)
+
+def _get_alert_ids_by_full_listing(s3_model, start, end):
+    '''
+    Return the IDs of alerts between start and end found by listing every
+    webhook key.
+    '''
+    webhooks_prefix = s3_model._get_webhooks_key_prefix()
+    alert_ids = []
+    for obj in s3_model._iter_bucket_objects(webhooks_prefix + '/'):
+        webhook_time_prefix, alert_id = obj.get('Key')[len(webhooks_prefix) + 1:].rsplit('/', 1)
+        webhook_time = datetime.datetime(*[int(e) for e in webhook_time_prefix.split('/')],
+                                         tzinfo=s3_model.UTC)
+        if start < webhook_time < end:
+            alert_ids.append(alert_id)
+
+    return alert_ids
+
+def _measure(s3, get_alert_ids, start, end):
+    '''
+    Return the alert IDs get_alert_ids finds, its list calls and seconds.
+    '''
+    s3.reset_stats()
+    started = timer()
+    alert_ids = get_alert_ids(start, end)
+    elapsed = timer() - started
+
+    return alert_ids, s3.requests.get('ListObjectsV2', 0), elapsed
+
+def main(argv=None):
+    args = _parse_args(argv)
+    rng = random.Random(args.seed)
+
+    alert_ids = archive.generate(args.keys)
+    store = s3server.S3Store(archive.synthesize)
+    store.add_synthetic_keys(archive.get_keys(alert_ids))
+    s3 = s3server.start(store)
+    _configure(s3)
+
+    # Settings are read when the service is imported.
+    import app.models.s3 as s3_model
+
+    first, _ = archive.parse_alert_id(alert_ids[0])
+    last, _ = archive.parse_alert_id(alert_ids[-1])
+
+    results = {}
+    identical = True
+    for minutes in [int(m) for m in args.ranges.split(',')]:
+        totals = {'alerts': 0, 'planned_lists': 0, 'full_lists': 0, 'planned_ms': 0.0, 'full_ms': 0.0}
+        for _ in range(args.queries):
+            # Ranges start on any second so both edges cut through minutes.
+            start_time = rng.uniform(first, max(first, last - minutes * 60))
+            start = datetime.datetime.utcfromtimestamp(start_time).replace(tzinfo=s3_model.UTC)
+            end = start + datetime.timedelta(minutes=minutes)
+
+            planned, planned_lists, planned_seconds = _measure(
+                s3, s3_model.get_alert_ids_by_date, start, end)
+            full, full_lists, full_seconds = _measure(
+                s3, lambda s, e: _get_alert_ids_by_full_listing(s3_model, s, e), start, end)
+
+            if planned != full:
+                identical = False
+                print('Listings differ for {} to {}: {} planned, {} full'.format(
+                    start.isoformat(), end.isoformat(), len(planned), len(full)))
+
+            totals['alerts'] += len(planned)
+            totals['planned_lists'] += planned_lists
+            totals['full_lists'] += full_lists
+            totals['planned_ms'] += planned_seconds * 1000
+            totals['full_ms'] += full_seconds * 1000
+
+        results[str(minutes)] = dict((name, round(value / args.queries, 1))
+                                     for name, value in totals.items())
+
+    print('{:>8} {:>8} {:>14} {:>11} {:>11} {:>9}   (per query)'.format(
+        'minutes', 'alerts', 'planned_lists', 'full_lists', 'planned_ms', 'full_ms'))
+    for minutes in sorted(results, key=int):
+        result = results[minutes]
+        print('{:>8} {:>8} {:>14} {:>11} {:>11} {:>9}'.format(
+            minutes, result['alerts'], result['planned_lists'], result['full_lists'],
+            result['planned_ms'], result['full_ms']))
+    print('Planned and full listings found {} alerts'.format(
+        'the same' if identical else 'DIFFERENT'))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\nCompared with baseline:')
+        for minutes in sorted(results, key=int):
+            for name in ('planned_lists', 'planned_ms'):
+                before = baseline.get(minutes, {}).get(name)
+                value = results[minutes][name]
+                if before:
+                    print('  {:>6} min {:14} {} -> {} ({:+.1f}%)'.format(
+                        minutes, name, before, value, (value - before) * 100.0 / before))
+
+    if args.save:
+        output = {
+            'meta': {
+                'keys': args.keys,
+                'queries': args.queries,
+                'seed': args.seed,
+                'python': platform.python_version()
+            },
+            'results': results
+        }
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.save))
+
+    return 0 if identical else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
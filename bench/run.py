@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+'''
+Benchmark the service against local S3 and Threat Stack stand-ins.
+
+Builds a synthetic archive, drives the app from create_app() with
+concurrent clients and reports throughput and latency percentiles per
+scenario:
+
+    ingest  POST /alert bursts of new webhooks
+    read    GET /alert/<id> of random archived alerts
+    range   GET /alert over random date ranges
+
+Service settings are passed with --env, eg. --env TS_S3_INDEX_READS=true.
+Results can be saved as a JSON baseline and compared with a later run.
+'''
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+from six.moves import queue
+import sys
+import threading
+from timeit import default_timer as timer
+
+from bench import archive, s3server, threatstack_server
+
+SCENARIOS = ('ingest', 'read', 'range')
+
+def _parse_args(argv=None):
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=10000,
+                        help='Alerts in the synthetic archive (default: 10000).')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated scenarios to run (default: all).')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests per scenario (default: 200).')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Concurrent clients (default: 10).')
+    parser.add_argument('--burst-alerts', type=int, default=5,
+                        help='Alerts per ingested webhook (default: 5).')
+    parser.add_argument('--range-minutes', type=int, default=60,
+                        help='Length of range queries (default: 60).')
+    parser.add_argument('--s3-latency', type=float, default=0.0,
+                        help='Seconds added to every S3 request (default: 0).')
+    parser.add_argument('--s3-error-rate', type=float, default=0.0,
+                        help='Fraction of S3 requests failing with 503 (default: 0).')
+    parser.add_argument('--ts-latency', type=float, default=0.05,
+                        help='Seconds added to every Threat Stack request (default: 0.05).')
+    parser.add_argument('--ts-error-rate', type=float, default=0.0,
+                        help='Fraction of Threat Stack requests failing with 429 or 503 (default: 0).')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='Service setting for this run.  May be repeated.')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed (default: 1).')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare results with a saved baseline.')
+
+    return parser.parse_args(argv)
+
+def _percentile(sorted_values, percent):
+    '''
+    Return the nearest rank percentile of sorted values.
+    '''
+    if not sorted_values:
+        return None
+    rank = max(int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def _drive(app, requests, concurrency):
+    '''
+    Make requests with concurrent clients.
+
+    requests is a list of (method, path, body).  Returns request latencies
+    in seconds, the count of failed requests and the elapsed time.
+    '''
+    work = queue.Queue()
+    for request in requests:
+        work.put(request)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def _client():
+        client = app.test_client()
+        while True:
+            try:
+                method, path, body = work.get_nowait()
+            except queue.Empty:
+                return
+            start = timer()
+            response = client.open(path, method=method, data=body)
+            # Streamed responses are generated as they are read.
+            response.get_data()
+            response.close()
+            elapsed = timer() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors[0] += 1
+
+    started = timer()
+    clients = [threading.Thread(target=_client) for _ in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    return latencies, errors[0], timer() - started
+
+def _summarize(latencies, errors, elapsed, items=None):
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': ms(_percentile(latencies, 50)),
+        'p99_ms': ms(_percentile(latencies, 99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'max_ms': ms(latencies[-1]) if latencies else None
+    }
+    if items is not None:
+        summary['items_per_second'] = round(items / elapsed, 2) if elapsed else None
+
+    return summary
+
+def _ingest_requests(args, alert_ids, rng):
+    '''
+    Return webhook POSTs of alerts newer than the archive.
+    '''
+    last_time, _ = archive.parse_alert_id(alert_ids[-1])
+    requests = []
+    number = len(alert_ids)
+    for i in range(args.requests):
+        alerts = []
+        for _ in range(args.burst_alerts):
+            alerts.append(archive.get_webhook(archive.make_alert_id(last_time + 60 + i, number)))
+            number += 1
+        requests.append(('POST', '/threatstack-to-s3/api/v1/s3/alert', json.dumps({'alerts': alerts})))
+
+    return requests, args.requests * args.burst_alerts
+
+def _read_requests(args, alert_ids, rng):
+    return [('GET', '/threatstack-to-s3/api/v1/s3/alert/' + rng.choice(alert_ids), None)
+            for _ in range(args.requests)], None
+
+def _range_requests(args, alert_ids, rng):
+    first, _ = archive.parse_alert_id(alert_ids[0])
+    last, _ = archive.parse_alert_id(alert_ids[-1])
+    window = args.range_minutes * 60
+    requests = []
+    for _ in range(args.requests):
+        start = rng.randint(first, max(last - window, first))
+        requests.append(('GET', '/threatstack-to-s3/api/v1/s3/alert?start={}&end={}'.format(
+            _isoformat(start), _isoformat(start + window)), None))
+
+    return requests, None
+
+def _isoformat(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+SCENARIO_REQUESTS = {
+    'ingest': _ingest_requests,
+    'read': _read_requests,
+    'range': _range_requests
+}
+
+def _configure(args, s3, threatstack):
+    '''
+    Point the service at the stand-ins before it reads its settings.
+    '''
+    os.environ.update({
+        'TS_AWS_S3_ENDPOINT_URL': s3.url,
+        'TS_AWS_S3_BUCKET': 'bench',
+        'THREATSTACK_BASE_URL': threatstack.url,
+        'THREATSTACK_API_KEY': 'bench',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1'
+    })
+    settings = dict(setting.split('=', 1) for setting in args.env)
+    os.environ.update(settings)
+
+    return settings
+
+def compare(results, baseline):
+    '''
+    Print changes from a baseline.
+    '''
+    print('\nCompared with baseline:')
+    for scenario, summary in results.items():
+        base = baseline['results'].get(scenario)
+        if not base:
+            continue
+        changes = []
+        for metric in ('throughput', 'p50_ms', 'p99_ms'):
+            if summary.get(metric) and base.get(metric):
+                change = (summary[metric] - base[metric]) * 100.0 / base[metric]
+                changes.append('{} {} -> {} ({:+.1f}%)'.format(metric, base[metric], summary[metric], change))
+        print('  {:8} {}'.format(scenario, ', '.join(changes)))
+
+def main(argv=None):
+    args = _parse_args(argv)
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+
+    started = timer()
+    alert_ids = archive.generate(args.keys)
+    store = s3server.S3Store(archive.synthesize)
+    store.add_synthetic_keys(archive.get_keys(alert_ids))
+    print('Built archive of {} alerts ({} keys) in {:.1f}s'.format(
+        len(alert_ids), len(store), timer() - started))
+
+    s3 = s3server.start(store, args.s3_latency, args.s3_error_rate)
+    threatstack = threatstack_server.start(archive.get_alert,
+                                           latency=args.ts_latency,
+                                           error_rate=args.ts_error_rate)
+    settings = _configure(args, s3, threatstack)
+
+    # Settings are read when the service is imported.
+    from app import create_app
+    import app.models.s3 as s3_model
+    app = create_app()
+
+    if settings.get('TS_S3_INDEX_READS', '').lower() in ('1', 'true', 'yes', 'on'):
+        started = timer()
+        first, _ = archive.parse_alert_id(alert_ids[0])
+        last, _ = archive.parse_alert_id(alert_ids[-1])
+        start = datetime.datetime.utcfromtimestamp(first - 3600).replace(tzinfo=s3_model.UTC)
+        end = datetime.datetime.utcfromtimestamp(last + 7200).replace(tzinfo=s3_model.UTC)
+        s3_model.rebuild_index(start, end)
+        print('Built indexes in {:.1f}s'.format(timer() - started))
+
+    results = {}
+    for scenario in args.scenarios.split(','):
+        requests, items = SCENARIO_REQUESTS[scenario](args, alert_ids, rng)
+        s3.reset_stats()
+        threatstack.reset_stats()
+        latencies, errors, elapsed = _drive(app, requests, args.concurrency)
+        summary = _summarize(latencies, errors, elapsed, items)
+        summary['s3_requests'] = dict(s3.requests)
+        summary['s3_connections'] = s3.connections
+        summary['threatstack_requests'] = threatstack.requests
+        summary['threatstack_connections'] = threatstack.connections
+        results[scenario] = summary
+
+        print('{:8} {:>8} req/s  p50 {:>9} ms  p99 {:>9} ms  errors {}  S3 {}  Threat Stack {}'.format(
+            scenario, summary['throughput'], summary['p50_ms'], summary['p99_ms'], errors,
+            sum(summary['s3_requests'].values()), summary['threatstack_requests']))
+
+    output = {
+        'meta': {
+            'keys': args.keys,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'burst_alerts': args.burst_alerts,
+            'range_minutes': args.range_minutes,
+            's3_latency': args.s3_latency,
+            's3_error_rate': args.s3_error_rate,
+            'ts_latency': args.ts_latency,
+            'ts_error_rate': args.ts_error_rate,
+            'settings': settings,
+            'python': platform.python_version()
+        },
+        'results': results
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.save))
+
+    return output
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
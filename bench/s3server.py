@@ -0,0 +1,440 @@
+'''
+Local S3 compatible stand-in.
+
+Implements the parts of the S3 REST API this service uses, path style:
+object PUT (with If-Match and If-None-Match), GET (with Range and
+If-None-Match), HEAD and DELETE, and bucket listing (v1 and v2).  Select
+answers NotImplemented so the service evaluates queries itself, unless the
+server is started with select, when it evaluates the SQL the service
+generates over JSON documents.  Every bucket shares one key space.
+
+Objects live in memory.  Archives too big for that can be synthesized:
+keys are registered without bodies and bodies are rendered on read.
+'''
+import binascii
+import bisect
+from email.utils import formatdate
+import hashlib
+import json
+import random
+import re
+import six
+import struct
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, unquote, urlparse
+import threading
+import time
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+LAST_MODIFIED = '2017-01-17T16:40:14.000Z'
+
+# The subset of S3 Select SQL the service generates.
+SELECT_RE = re.compile(r'^SELECT (?P<select>.+?) FROM S3Object s(?: WHERE (?P<where>.+))?$')
+SELECT_FIELD_RE = re.compile(r's\.("(?:[^"]|"")*")')
+CONDITION_RE = re.compile(r'^CAST\(s\.("(?:[^"]|"")*") AS STRING\) IN \((.*)\)$')
+STRING_RE = re.compile(r"'((?:[^']|'')*)'")
+
+class SelectError(Exception):
+    '''
+    An expression outside the supported subset.
+    '''
+
+def _unquote_identifier(quoted):
+    return quoted[1:-1].replace('""', '"')
+
+def _cast_to_string(value):
+    '''
+    Return a JSON value as S3 Select's CAST(value AS STRING), or None for
+    missing, null and non-scalar values, which never match.
+    '''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, six.integer_types + (float,)):
+        return repr(value)
+    if isinstance(value, six.string_types):
+        return value
+
+    return None
+
+def _split_conditions(where):
+    '''
+    Split a WHERE clause on the ANDs outside string literals.
+    '''
+    conditions = []
+    current = ''
+    for part in re.split(r"('(?:[^']|'')*')", where):
+        if part.startswith("'"):
+            current += part
+            continue
+        pieces = part.split(' AND ')
+        current += pieces[0]
+        for piece in pieces[1:]:
+            conditions.append(current)
+            current = piece
+    conditions.append(current)
+
+    return conditions
+
+def select(document, expression):
+    '''
+    Return the records an expression selects from a JSON document.
+    '''
+    match = SELECT_RE.match(expression)
+    if not match:
+        raise SelectError(expression)
+
+    for condition in _split_conditions(match.group('where') or ''):
+        if not condition:
+            continue
+        condition_match = CONDITION_RE.match(condition)
+        if not condition_match:
+            raise SelectError(condition)
+        field = _unquote_identifier(condition_match.group(1))
+        values = [v.replace("''", "'") for v in STRING_RE.findall(condition_match.group(2))]
+        if _cast_to_string(document.get(field)) not in values:
+            return []
+
+    if match.group('select') == '*':
+        return [document]
+
+    fields = [_unquote_identifier(f) for f in SELECT_FIELD_RE.findall(match.group('select'))]
+    return [dict((f, document[f]) for f in fields if f in document)]
+
+def _encode_event_header(name, value):
+    name = name.encode('utf-8')
+    value = value.encode('utf-8')
+    # Header value type 7 is a string.
+    return struct.pack('>B', len(name)) + name + struct.pack('>BH', 7, len(value)) + value
+
+def encode_event(event_type, payload=b'', content_type=None):
+    '''
+    Return one message of an AWS event stream.
+    '''
+    headers = [(':message-type', 'event'), (':event-type', event_type)]
+    if content_type:
+        headers.append((':content-type', content_type))
+    header_bytes = b''.join(_encode_event_header(n, v) for n, v in headers)
+
+    total_length = 12 + len(header_bytes) + len(payload) + 4
+    prelude = struct.pack('>II', total_length, len(header_bytes))
+    prelude += struct.pack('>I', binascii.crc32(prelude) & 0xffffffff)
+    message = prelude + header_bytes + payload
+
+    return message + struct.pack('>I', binascii.crc32(message) & 0xffffffff)
+
+class S3Store(object):
+    '''
+    Sorted in-memory key space.
+
+    synthesize, if given, renders the body of keys added without one.
+    '''
+    def __init__(self, synthesize=None):
+        self.synthesize = synthesize
+        self._keys = []
+        self._objects = {}
+        self._synthetic = set()
+        self._lock = threading.Lock()
+
+    def add_synthetic_keys(self, keys):
+        '''
+        Register keys whose bodies are synthesized.  keys must be sorted.
+        '''
+        with self._lock:
+            self._synthetic.update(keys)
+            self._keys = sorted(set(self._keys).union(keys)) if self._keys else list(keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, key):
+        '''
+        Return (body, etag) or None.
+        '''
+        with self._lock:
+            obj = self._objects.get(key)
+            synthetic = obj is None and key in self._synthetic
+        if obj is not None:
+            return obj
+        if synthetic:
+            body = self.synthesize(key)
+            return body, '"{}"'.format(hashlib.md5(body).hexdigest())
+
+        return None
+
+    def put(self, key, body, if_match=None, if_none_match=None):
+        '''
+        Store an object.  Returns its ETag, or None if a precondition failed.
+        '''
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        with self._lock:
+            exists = key in self._objects or key in self._synthetic
+            if if_none_match == '*' and exists:
+                return None
+            if if_match is not None:
+                current = self._objects.get(key)
+                if current is None and key in self._synthetic:
+                    current = (None, '"{}"'.format(hashlib.md5(self.synthesize(key)).hexdigest()))
+                if current is None or current[1] != if_match:
+                    return None
+
+            if not exists:
+                bisect.insort(self._keys, key)
+            self._synthetic.discard(key)
+            self._objects[key] = (body, etag)
+
+        return etag
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._objects or key in self._synthetic:
+                self._objects.pop(key, None)
+                self._synthetic.discard(key)
+                del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def list(self, prefix='', start_after='', max_keys=1000):
+        '''
+        Return up to max_keys keys after start_after under prefix, and
+        whether more remain.
+        '''
+        with self._lock:
+            i = bisect.bisect_right(self._keys, start_after) if start_after else 0
+            i = max(i, bisect.bisect_left(self._keys, prefix))
+            keys = []
+            while i < len(self._keys) and len(keys) < max_keys:
+                key = self._keys[i]
+                if not key.startswith(prefix):
+                    break
+                keys.append(key)
+                i += 1
+            truncated = i < len(self._keys) and self._keys[i].startswith(prefix)
+
+        return keys, truncated
+
+class S3Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    HTTP server for an S3Store with injected latency and errors.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store, latency=0.0, error_rate=0.0, select=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _S3Handler)
+        self.store = store
+        self.latency = latency
+        self.error_rate = error_rate
+        self.select = select
+        self.requests = {}
+        self.connections = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def count(self, operation):
+        with self._stats_lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.requests = {}
+            self.connections = 0
+
+    def process_request(self, request, client_address):
+        with self._stats_lock:
+            self.connections += 1
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+def _xml(tag, value):
+    return '<{0}>{1}</{0}>'.format(tag, escape(str(value)))
+
+class _S3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = unquote(parts[0])
+        key = unquote(parts[1]) if len(parts) > 1 else ''
+        query = dict((k, v[0]) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+        return bucket, key, query
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_error(self, status, code, message=''):
+        body = '<?xml version="1.0" encoding="UTF-8"?><Error>{}{}</Error>'.format(
+            _xml('Code', code), _xml('Message', message)).encode('utf-8')
+        headers = {'Content-Type': 'application/xml'}
+        if self.command == 'HEAD':
+            body = b''
+        self._send(status, body, headers)
+
+    def _inject(self, operation):
+        '''
+        Count, delay and maybe fail a request.  Returns True if it failed.
+        '''
+        self.server.count(operation)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self._send_error(503, 'SlowDown', 'Injected error')
+            return True
+        return False
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if self._inject('PutObject'):
+            return
+        etag = self.server.store.put(key, body,
+                                     if_match=self.headers.get('If-Match'),
+                                     if_none_match=self.headers.get('If-None-Match'))
+        if etag is None:
+            return self._send_error(412, 'PreconditionFailed')
+        self._send(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if self._inject('SelectObjectContent'):
+            return
+        if not self.server.select:
+            return self._send_error(501, 'NotImplemented', 'Select is not supported')
+
+        obj = self.server.store.get(key)
+        if obj is None:
+            return self._send_error(404, 'NoSuchKey')
+
+        # The request's XML elements are namespaced.
+        request = ElementTree.fromstring(body)
+        expression = [e.text for e in request.iter() if e.tag.endswith('Expression')][0]
+        try:
+            records = select(json.loads(obj[0].decode('utf-8')), expression)
+        except (SelectError, ValueError) as e:
+            return self._send_error(400, 'InvalidQuery', str(e))
+
+        events = b''
+        if records:
+            payload = b''.join(json.dumps(r).encode('utf-8') + b'\n' for r in records)
+            events += encode_event('Records', payload, 'application/octet-stream')
+        events += encode_event('End')
+        self._send(200, events, {'Content-Type': 'application/octet-stream'})
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        if self._inject('DeleteObject'):
+            return
+        self.server.store.delete(key)
+        self._send(204)
+
+    def do_HEAD(self):
+        self._get_object('HeadObject')
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if not key:
+            return self._list_objects(bucket, query)
+        self._get_object('GetObject')
+
+    def _get_object(self, operation):
+        bucket, key, query = self._parse()
+        if self._inject(operation):
+            return
+        obj = self.server.store.get(key)
+        if obj is None:
+            return self._send_error(404, 'NoSuchKey' if operation == 'GetObject' else 'NotFound')
+
+        body, etag = obj
+        headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(usegmt=True),
+            'Content-Type': 'binary/octet-stream',
+            'Accept-Ranges': 'bytes'
+        }
+        if etag in [e.strip() for e in (self.headers.get('If-None-Match') or '').split(',')]:
+            return self._send(304, headers={'ETag': etag})
+
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            first, last = byte_range[len('bytes='):].split('-')
+            first = int(first)
+            last = min(int(last) if last else len(body) - 1, len(body) - 1)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, len(body))
+            body = body[first:last + 1]
+            status = 206
+
+        if self.command == 'HEAD':
+            headers['Content-Length'] = str(len(body))
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+
+        self._send(status, body, headers)
+
+    def _list_objects(self, bucket, query):
+        v2 = query.get('list-type') == '2'
+        if self._inject('ListObjectsV2' if v2 else 'ListObjects'):
+            return
+
+        prefix = query.get('prefix', '')
+        max_keys = int(query.get('max-keys', 1000))
+        if v2:
+            start_after = query.get('continuation-token') or query.get('start-after', '')
+        else:
+            start_after = query.get('marker', '')
+        keys, truncated = self.server.store.list(prefix, start_after, max_keys)
+
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                 _xml('Name', bucket), _xml('Prefix', prefix), _xml('MaxKeys', max_keys),
+                 _xml('IsTruncated', 'true' if truncated else 'false')]
+        if v2:
+            parts.append(_xml('KeyCount', len(keys)))
+            if query.get('start-after'):
+                parts.append(_xml('StartAfter', query['start-after']))
+            if truncated:
+                parts.append(_xml('NextContinuationToken', keys[-1]))
+        elif truncated:
+            parts.append(_xml('NextMarker', keys[-1]))
+
+        for key in keys:
+            parts.append('<Contents>{}{}{}{}</Contents>'.format(
+                _xml('Key', key), _xml('LastModified', LAST_MODIFIED),
+                _xml('Size', 0), _xml('StorageClass', 'STANDARD')))
+        parts.append('</ListBucketResult>')
+
+        self._send(200, ''.join(parts).encode('utf-8'), {'Content-Type': 'application/xml'})
+
+def start(store, latency=0.0, error_rate=0.0, select=False):
+    '''
+    Serve store on a free local port in a background thread.
+
+    With select, Select requests are evaluated rather than refused.
+    '''
+    server = S3Server(('127.0.0.1', 0), store, latency, error_rate, select)
+    thread = threading.Thread(target=server.serve_forever, name='s3-stand-in')
+    thread.daemon = True
+    thread.start()
+
+    return server
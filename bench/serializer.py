@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+Compare JSON backends and raw passthrough on alert sized documents.
+
+For each backend installed, times encoding and decoding an alert, and
+building an alert response the old way, decoding the stored alert and
+encoding the response, against splicing the stored alert into the response
+as the API does now.
+'''
+from __future__ import print_function
+import argparse
+import json
+import platform
+import sys
+from timeit import default_timer as timer
+
+from app import serializer
+from bench import archive
+
+BACKENDS = ['json'] + (['orjson'] if serializer.orjson is not None else [])
+
+def _parse_args(argv=None):
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alerts', type=int, default=1000,
+                        help='Alerts per round (default: 1000).')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='Rounds to run, the fastest is reported (default: 20).')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare results with a saved baseline.')
+
+    return parser.parse_args(argv)
+
+def _decode_encode(alert_data):
+    return serializer.dumps({'success': True, 'alert': serializer.loads(alert_data)})
+
+def _passthrough(alert_data):
+    return b'{"success": true, "alert": ' + alert_data + b'}'
+
+def _time(function, items, rounds):
+    '''
+    Return the fastest round's microseconds per item.
+    '''
+    best = None
+    for _ in range(rounds):
+        start = timer()
+        for item in items:
+            function(item)
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return round(best * 1e6 / len(items), 3)
+
+def main(argv=None):
+    args = _parse_args(argv)
+
+    alerts = [archive.get_alert(alert_id) for alert_id in archive.generate(args.alerts)]
+    results = {}
+    for backend in BACKENDS:
+        serializer.BACKEND = backend
+        stored = [serializer.dumps(alert) for alert in alerts]
+        results[backend] = {
+            'encode': _time(serializer.dumps, alerts, args.rounds),
+            'decode': _time(serializer.loads, stored, args.rounds),
+            'decode_encode': _time(_decode_encode, stored, args.rounds),
+            'passthrough': _time(_passthrough, stored, args.rounds)
+        }
+
+    print('{:10} {:>12} {:>12} {:>15} {:>13}   (us per alert)'.format(
+        'backend', 'encode', 'decode', 'decode_encode', 'passthrough'))
+    for backend in BACKENDS:
+        result = results[backend]
+        print('{:10} {:>12} {:>12} {:>15} {:>13}'.format(
+            backend, result['encode'], result['decode'], result['decode_encode'], result['passthrough']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\nCompared with baseline:')
+        for backend in BACKENDS:
+            for name, value in sorted(results[backend].items()):
+                before = baseline.get(backend, {}).get(name)
+                if before:
+                    print('  {:10} {:15} {} -> {} us ({:+.1f}%)'.format(
+                        backend, name, before, value, (value - before) * 100.0 / before))
+
+    if args.save:
+        output = {
+            'meta': {
+                'alerts': args.alerts,
+                'rounds': args.rounds,
+                'python': platform.python_version()
+            },
+            'results': results
+        }
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.save))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
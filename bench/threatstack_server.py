@@ -0,0 +1,97 @@
+'''
+Fake Threat Stack API.
+
+Answers GET /alerts/<id> with an alert built by a callable, and GET
+/alerts with pages from a list, after an injected latency.  A fraction of
+requests fail with 429 or 503 to exercise retries.
+'''
+import json
+import random
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+import threading
+import time
+
+class ThreatStackServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    HTTP server for the fake API.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, get_alert, alerts=None, latency=0.0, error_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _ThreatStackHandler)
+        self.get_alert = get_alert
+        self.alerts = alerts or []
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.requests = 0
+            self.errors = 0
+            self.connections = 0
+
+    def process_request(self, request, client_address):
+        with self._stats_lock:
+            self.connections += 1
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+class _ThreatStackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server._stats_lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            with server._stats_lock:
+                server.errors += 1
+            if random.random() < 0.5:
+                return self._send_json(429, {'error': 'Rate limit exceeded'}, {'Retry-After': '0'})
+            return self._send_json(503, {'error': 'Service unavailable'})
+
+        url = urlparse(self.path)
+        parts = url.path.rstrip('/').split('/')
+        if parts[-1] == 'alerts':
+            query = parse_qs(url.query)
+            count = int(query.get('count', ['100'])[0])
+            page = int(query.get('page', ['0'])[0])
+            return self._send_json(200, server.alerts[page * count:(page + 1) * count])
+
+        self._send_json(200, server.get_alert(parts[-1]))
+
+def start(get_alert, alerts=None, latency=0.0, error_rate=0.0):
+    '''
+    Serve the fake API on a free local port in a background thread.
+    '''
+    server = ThreatStackServer(('127.0.0.1', 0), get_alert, alerts, latency, error_rate)
+    thread = threading.Thread(target=server.serve_forever, name='threatstack-stand-in')
+    thread.daemon = True
+    thread.start()
+
+    return server
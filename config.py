@@ -1,8 +1,174 @@
 import os
+import tempfile
+
+def _get_bool(name, default=False):
+    '''
+    Return a boolean from an environment variable.
+    '''
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
 
 THREATSTACK_API_KEY = os.environ.get('THREATSTACK_API_KEY')
 THREATSTACK_BASE_URL = os.environ.get('THREATSTACK_BASE_URL', 'https://app.threatstack.com/api/v1')
 
 TS_AWS_S3_BUCKET = os.environ.get('TS_AWS_S3_BUCKET')
 TS_AWS_S3_PREFIX = os.environ.get('TS_AWS_S3_PREFIX', None)
+# S3 compatible endpoint to use instead of AWS, eg. the benchmark stand-in.
+TS_AWS_S3_ENDPOINT_URL = os.environ.get('TS_AWS_S3_ENDPOINT_URL')
+
+# Create AWS clients and Threat Stack sessions when the app is created
+# instead of on first use.  On by default on Lambda, where init time is
+# spent before the first invocation.
+TS_PRELOAD_CLIENTS = _get_bool('TS_PRELOAD_CLIENTS', bool(os.environ.get('AWS_LAMBDA_FUNCTION_NAME')))
+
+
+# Maximum concurrent S3 requests made while serving a single request.
+TS_S3_CONCURRENCY = int(os.environ.get('TS_S3_CONCURRENCY', 10))
+
+# Connection pool size and retry attempts for shared AWS clients.
+TS_AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('TS_AWS_MAX_POOL_CONNECTIONS', 25))
+TS_AWS_MAX_ATTEMPTS = int(os.environ.get('TS_AWS_MAX_ATTEMPTS', 3))
+
+# Threat Stack API client timeouts (seconds), retries and connection pool size.
+THREATSTACK_CONNECT_TIMEOUT = float(os.environ.get('THREATSTACK_CONNECT_TIMEOUT', 5))
+THREATSTACK_READ_TIMEOUT = float(os.environ.get('THREATSTACK_READ_TIMEOUT', 30))
+THREATSTACK_MAX_RETRIES = int(os.environ.get('THREATSTACK_MAX_RETRIES', 3))
+THREATSTACK_POOL_CONNECTIONS = int(os.environ.get('THREATSTACK_POOL_CONNECTIONS', 10))
+# Maximum Threat Stack API requests per second per process, 0 for no limit.
+THREATSTACK_RATE_LIMIT = float(os.environ.get('THREATSTACK_RATE_LIMIT', 0))
+
+# Webhook ingest mode: 'sync' archives before responding, 'async' spools
+# webhooks locally and archives them in background workers.
+TS_INGEST_MODE = os.environ.get('TS_INGEST_MODE', 'sync')
+TS_INGEST_SPOOL_DIR = os.environ.get('TS_INGEST_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'threatstack-to-s3', 'ingest'))
+TS_INGEST_WORKERS = int(os.environ.get('TS_INGEST_WORKERS', 4))
+TS_INGEST_MAX_ATTEMPTS = int(os.environ.get('TS_INGEST_MAX_ATTEMPTS', 5))
+
+# Adaptive concurrency limits and circuit breakers per dependency, per
+# process.  *_MAX_IN_FLIGHT caps the limit, 0 for no limit, and calls
+# slower than *_LATENCY_TARGET seconds shrink it.  Calls wait up to
+# TS_LIMIT_WAIT seconds for a slot.  A circuit opens after
+# TS_BREAKER_FAILURES failures in a row, 0 to never open, and is retried
+# after TS_BREAKER_RESET seconds.
+THREATSTACK_MAX_IN_FLIGHT = int(os.environ.get('THREATSTACK_MAX_IN_FLIGHT', 20))
+THREATSTACK_LATENCY_TARGET = float(os.environ.get('THREATSTACK_LATENCY_TARGET', 5))
+TS_S3_MAX_IN_FLIGHT = int(os.environ.get('TS_S3_MAX_IN_FLIGHT', 100))
+TS_S3_LATENCY_TARGET = float(os.environ.get('TS_S3_LATENCY_TARGET', 2))
+TS_LIMIT_WAIT = float(os.environ.get('TS_LIMIT_WAIT', 10))
+TS_BREAKER_FAILURES = int(os.environ.get('TS_BREAKER_FAILURES', 5))
+TS_BREAKER_RESET = float(os.environ.get('TS_BREAKER_RESET', 30))
+
+# Archive just the webhook data of alerts when Threat Stack is unavailable,
+# rather than fail the webhook so it is redelivered.  Their details are
+# fetched later by the enrichment workers and reconciler.
+TS_WEBHOOK_ONLY_FALLBACK = _get_bool('TS_WEBHOOK_ONLY_FALLBACK', False)
+
+# Alert details are fetched from Threat Stack while the webhook is archived
+# ('inline'), or after it has been stored ('deferred'): in batches of up to
+# TS_ENRICHMENT_BATCH_SIZE gathered for TS_ENRICHMENT_BATCH_WAIT seconds,
+# on first read, and by a reconciler that checks the last
+# TS_ENRICHMENT_RECONCILE_WINDOW seconds of alerts every
+# TS_ENRICHMENT_RECONCILE_INTERVAL seconds, 0 to disable.  One process per
+# host reconciles, holding TS_ENRICHMENT_LOCK_FILE.
+TS_ENRICHMENT = os.environ.get('TS_ENRICHMENT', 'inline')
+TS_ENRICHMENT_BATCH_SIZE = int(os.environ.get('TS_ENRICHMENT_BATCH_SIZE', 50))
+TS_ENRICHMENT_BATCH_WAIT = float(os.environ.get('TS_ENRICHMENT_BATCH_WAIT', 1))
+TS_ENRICHMENT_CONCURRENCY = int(os.environ.get('TS_ENRICHMENT_CONCURRENCY', 10))
+TS_ENRICHMENT_QUEUE_SIZE = int(os.environ.get('TS_ENRICHMENT_QUEUE_SIZE', 10000))
+TS_ENRICHMENT_RECONCILE_INTERVAL = float(os.environ.get('TS_ENRICHMENT_RECONCILE_INTERVAL', 300))
+TS_ENRICHMENT_RECONCILE_WINDOW = float(os.environ.get('TS_ENRICHMENT_RECONCILE_WINDOW', 3600))
+TS_ENRICHMENT_LOCK_FILE = os.environ.get('TS_ENRICHMENT_LOCK_FILE', os.path.join(tempfile.gettempdir(), 'threatstack-to-s3', 'reconcile.lock'))
+
+# /status serves dependency health checked in the background every
+# TS_STATUS_INTERVAL seconds, 0 to only check when a request finds the last
+# result older than TS_STATUS_MAX_AGE seconds.  Background checks are off
+# by default on Lambda, which freezes the process between invocations.
+TS_STATUS_INTERVAL = float(os.environ.get('TS_STATUS_INTERVAL', 0 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 30))
+TS_STATUS_MAX_AGE = float(os.environ.get('TS_STATUS_MAX_AGE', 90))
+
+# JSON library for alerts: 'auto' uses orjson if it is installed, 'json'
+# the standard library.
+TS_JSON_BACKEND = os.environ.get('TS_JSON_BACKEND', 'auto')
+
+# Log S3 writes that fail to TS_WAL_DIR and replay them once S3 recovers,
+# instead of failing the webhook.  Segments are sealed at
+# TS_WAL_SEGMENT_BYTES and replayed up to TS_WAL_REPLAY_CONCURRENCY writes
+# at once.  Needs a disk that outlives the process, so not on Lambda.
+TS_WAL = _get_bool('TS_WAL')
+TS_WAL_DIR = os.environ.get('TS_WAL_DIR', os.path.join(tempfile.gettempdir(), 'threatstack-to-s3', 'wal'))
+TS_WAL_SEGMENT_BYTES = int(os.environ.get('TS_WAL_SEGMENT_BYTES', 16 * 1024 * 1024))
+TS_WAL_REPLAY_CONCURRENCY = int(os.environ.get('TS_WAL_REPLAY_CONCURRENCY', 20))
+
+# Maximum alerts from a single webhook archived at once.
+TS_ALERT_CONCURRENCY = int(os.environ.get('TS_ALERT_CONCURRENCY', 10))
+
+# Skip fetching and storing alerts already archived with the same webhook
+# data.  The memory backend remembers TS_DEDUP_MAX_ENTRIES alerts per process
+# for TS_DEDUP_TTL seconds; the s3 backend also checks the bucket for alerts
+# archived by other processes.  Off by default so every delivery is archived.
+TS_DEDUP = _get_bool('TS_DEDUP', False)
+TS_DEDUP_BACKEND = os.environ.get('TS_DEDUP_BACKEND', 'memory')
+TS_DEDUP_MAX_ENTRIES = int(os.environ.get('TS_DEDUP_MAX_ENTRIES', 100000))
+TS_DEDUP_TTL = float(os.environ.get('TS_DEDUP_TTL', 86400))
+
+# Maintain hourly index objects of webhooks and answer date-range queries
+# from them instead of listing webhook keys.  Backfill indexes with
+# threatstack-to-s3-rebuild-index.py before enabling reads.  Index entries
+# are gathered for up to TS_S3_INDEX_FLUSH_MAX_AGE seconds and written
+# together.
+TS_S3_INDEX_WRITES = _get_bool('TS_S3_INDEX_WRITES')
+TS_S3_INDEX_READS = _get_bool('TS_S3_INDEX_READS')
+TS_S3_INDEX_FLUSH_MAX_AGE = float(os.environ.get('TS_S3_INDEX_FLUSH_MAX_AGE', 1.0))
+
+# Archive alert details in batched, compressed NDJSON segments instead of one
+# object per alert.  A segment is written when it reaches
+# TS_S3_SEGMENT_MAX_BYTES or its oldest alert has waited TS_S3_SEGMENT_MAX_AGE
+# seconds.  TS_S3_SEGMENT_COMPRESSION is gzip or zstd (requires zstandard).
+TS_S3_SEGMENTS = _get_bool('TS_S3_SEGMENTS')
+TS_S3_SEGMENT_MAX_BYTES = int(os.environ.get('TS_S3_SEGMENT_MAX_BYTES', 8 * 1024 * 1024))
+TS_S3_SEGMENT_MAX_AGE = float(os.environ.get('TS_S3_SEGMENT_MAX_AGE', 1.0))
+TS_S3_SEGMENT_COMPRESSION = os.environ.get('TS_S3_SEGMENT_COMPRESSION', 'gzip')
+
+# In-process LRU cache of archived alert bodies.  Off by default so reads
+# always come from S3.
+TS_ALERT_CACHE = _get_bool('TS_ALERT_CACHE', False)
+TS_ALERT_CACHE_MAX_ENTRIES = int(os.environ.get('TS_ALERT_CACHE_MAX_ENTRIES', 10000))
+TS_ALERT_CACHE_MAX_BYTES = int(os.environ.get('TS_ALERT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+TS_ALERT_CACHE_TTL = float(os.environ.get('TS_ALERT_CACHE_TTL', 3600))
+
+# In-process cache of segment locator entries.  When the cached entries
+# don't list an alert its hour's locator shards are listed again if the hour
+# is recent or was last listed more than TS_S3_LOCATOR_CACHE_RECHECK seconds
+# ago.
+TS_S3_LOCATOR_CACHE_MAX_BYTES = int(os.environ.get('TS_S3_LOCATOR_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+TS_S3_LOCATOR_CACHE_RECHECK = float(os.environ.get('TS_S3_LOCATOR_CACHE_RECHECK', 300))
+
+# JSON file mapping Threat Stack organization IDs to their own bucket,
+# prefix, API key and limits.  See app/tenants.py.  TS_TENANT_MAX_IN_FLIGHT
+# is the default maximum alerts per tenant archived at once per process, 0
+# for no limit.
+TS_TENANTS_FILE = os.environ.get('TS_TENANTS_FILE')
+TS_TENANT_MAX_IN_FLIGHT = int(os.environ.get('TS_TENANT_MAX_IN_FLIGHT', 0))
+
+# Push filters and projections down to S3 Select where possible.  Queries
+# are evaluated locally if S3 Select is unavailable.
+TS_S3_SELECT = _get_bool('TS_S3_SELECT')
+
+# Directory where each process saves its metrics for /metrics to add up,
+# required when running several gunicorn workers.  Snapshots are written
+# every TS_METRICS_INTERVAL seconds.
+TS_METRICS_DIR = os.environ.get('TS_METRICS_DIR')
+TS_METRICS_INTERVAL = float(os.environ.get('TS_METRICS_INTERVAL', 5))
+
+# Trace every request, or requests sent with the TS_TRACE_HEADER header set.
+# Set TS_TRACE_HEADER empty to ignore the header.
+TS_TRACING = _get_bool('TS_TRACING')
+TS_TRACE_HEADER = os.environ.get('TS_TRACE_HEADER', 'X-Trace')
 
+# Sample stacks every TS_PROFILE_INTERVAL seconds into TS_PROFILE_DIR from
+# startup.  SIGUSR2 starts and stops the profiler at runtime.
+TS_PROFILE = _get_bool('TS_PROFILE')
+TS_PROFILE_DIR = os.environ.get('TS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'threatstack-to-s3', 'profile'))
+TS_PROFILE_INTERVAL = float(os.environ.get('TS_PROFILE_INTERVAL', 0.01))
@@ -1,5 +1,7 @@
 import os
+import shutil
 import sys
+import tempfile
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
@@ -9,3 +11,13 @@ timeout = 120
 graceful_timeout = 60
 worker_class = 'gevent'
 worker_connections = 10
+
+# Workers save metrics here so a scrape of any worker reports them all.
+os.environ.setdefault('TS_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'threatstack-to-s3', 'metrics'))
+
+def on_starting(server):
+    '''
+    Start with no metrics from an earlier run.
+    '''
+    shutil.rmtree(os.environ['TS_METRICS_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['TS_METRICS_DIR'])
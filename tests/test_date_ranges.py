@@ -0,0 +1,177 @@
+'''
+Tests that date-range queries list only the webhook key prefixes in the
+range and still find every webhook a full listing would.
+'''
+import datetime
+import os
+import unittest
+import uuid
+
+from iso8601 import UTC, parse_date
+
+from app import clients, tenants
+import app.models.s3 as s3_model
+from bench import s3server
+
+def _utc(*args):
+    return datetime.datetime(*args, tzinfo=UTC)
+
+def _get_minutes(first, last):
+    '''
+    Return every minute from first to last.
+    '''
+    minutes = []
+    while first <= last:
+        minutes.append(first)
+        first += datetime.timedelta(minutes=1)
+
+    return minutes
+
+# A webhook every minute across the end of a year, and so of a day, month
+# and hour, and across the end of a month, with two in one minute.
+WEBHOOK_MINUTES = (
+    _get_minutes(_utc(2016, 12, 30, 22, 0), _utc(2017, 1, 2, 2, 0)) +
+    _get_minutes(_utc(2017, 1, 31, 22, 0), _utc(2017, 2, 1, 2, 0)) +
+    [_utc(2017, 1, 1, 0, 0)]
+)
+
+# Ranges starting and ending mid-minute and on a minute, crossing each kind
+# of boundary, and shorter than a minute.
+RANGES = [
+    (_utc(2016, 12, 31, 23, 10, 30), _utc(2017, 1, 1, 0, 20, 45)),
+    (_utc(2016, 12, 31, 23, 10), _utc(2017, 1, 1, 0, 20)),
+    (_utc(2016, 12, 31, 23, 59, 59), _utc(2017, 1, 1, 0, 0, 1)),
+    (_utc(2016, 12, 31, 23, 59), _utc(2017, 1, 1, 0, 1)),
+    (_utc(2016, 12, 31, 0, 0), _utc(2017, 1, 1, 0, 0)),
+    (_utc(2016, 12, 30, 23, 59, 30), _utc(2017, 1, 2, 0, 0, 30)),
+    (_utc(2016, 12, 30, 22, 0), _utc(2017, 1, 2, 2, 0)),
+    (_utc(2017, 1, 1, 5, 0), _utc(2017, 1, 1, 6, 0)),
+    (_utc(2017, 1, 1, 5, 0, 1), _utc(2017, 1, 1, 5, 59, 59)),
+    (_utc(2017, 1, 31, 23, 30, 15), _utc(2017, 2, 1, 1, 45)),
+    (_utc(2017, 1, 31, 22, 0), _utc(2017, 2, 1, 0, 0)),
+    (_utc(2017, 1, 1, 12, 10, 10), _utc(2017, 1, 1, 12, 10, 50)),
+    (_utc(2017, 1, 1, 12, 10, 50), _utc(2017, 1, 1, 12, 11, 10)),
+    (_utc(2017, 1, 1, 12, 10), _utc(2017, 1, 1, 12, 11)),
+    (_utc(2017, 1, 1, 12, 9, 59), _utc(2017, 1, 1, 12, 11)),
+    (_utc(2017, 1, 1, 12, 11), _utc(2017, 1, 1, 12, 10)),
+    (parse_date('2017-01-01T04:30:30+05:00'), _utc(2017, 1, 1, 0, 15))
+]
+
+class PlanWebhookTimeRangesTest(unittest.TestCase):
+    '''
+    _plan_webhook_time_ranges() covers ranges with the fewest prefixes.
+    '''
+    def test_partial_hours_at_both_edges(self):
+        self.assertEqual(
+            s3_model._plan_webhook_time_ranges(_utc(2016, 12, 31, 23, 10, 30), _utc(2017, 1, 1, 0, 20, 45)),
+            [('2016/12/31/23', '2016/12/31/23/11', None),
+             ('2017/01/01/00', None, '2017/01/01/00/20')])
+
+    def test_whole_days_and_hours(self):
+        self.assertEqual(
+            s3_model._plan_webhook_time_ranges(_utc(2016, 12, 30, 23, 59, 30), _utc(2017, 1, 2, 1, 0, 30)),
+            [('2016/12/31', None, None),
+             ('2017/01/01', None, None),
+             ('2017/01/02/00', None, None),
+             ('2017/01/02/01', None, '2017/01/02/01/00')])
+
+    def test_ends_on_a_minute(self):
+        # Webhooks in the minutes the range starts and ends on don't match.
+        self.assertEqual(
+            s3_model._plan_webhook_time_ranges(_utc(2017, 1, 1, 0, 0), _utc(2017, 1, 1, 1, 0)),
+            [('2017/01/01/00', '2017/01/01/00/01', None)])
+
+    def test_shorter_than_a_minute(self):
+        self.assertEqual(
+            s3_model._plan_webhook_time_ranges(_utc(2017, 1, 1, 12, 10, 10), _utc(2017, 1, 1, 12, 10, 50)),
+            [])
+        self.assertEqual(
+            s3_model._plan_webhook_time_ranges(_utc(2017, 1, 1, 12, 10, 50), _utc(2017, 1, 1, 12, 11, 10)),
+            [('2017/01/01/12', '2017/01/01/12/11', '2017/01/01/12/11')])
+
+    def test_end_before_start(self):
+        self.assertEqual(
+            s3_model._plan_webhook_time_ranges(_utc(2017, 1, 1, 12, 11), _utc(2017, 1, 1, 12, 10)),
+            [])
+
+class WebhookRangeListingTest(unittest.TestCase):
+    '''
+    Listing the planned prefixes finds the same webhooks as listing every
+    webhook key and filtering by time.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.store = s3server.S3Store()
+        cls.server = s3server.start(cls.store)
+        cls.tenant = tenants.Tenant('test-' + uuid.uuid4().hex, 'bucket', prefix=uuid.uuid4().hex)
+
+        cls.webhooks = []
+        for number, minute in enumerate(WEBHOOK_MINUTES):
+            alert_id = '{:08x}{:016x}'.format(int((minute - _utc(1970, 1, 1)).total_seconds()), number)
+            key = '/'.join([cls.tenant.prefix, 'webhooks',
+                            minute.strftime(s3_model.WEBHOOK_TIME_PATH_FORMAT), alert_id])
+            cls.webhooks.append(key)
+        cls.store.add_synthetic_keys(sorted(cls.webhooks))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _patch(self, obj, name, value):
+        self._patched.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def setUp(self):
+        self._patched = []
+        self._environ = dict(os.environ)
+        os.environ.update(AWS_ACCESS_KEY_ID='test',
+                          AWS_SECRET_ACCESS_KEY='test',
+                          AWS_DEFAULT_REGION='us-east-1')
+
+        self._patch(clients, 'TS_AWS_S3_ENDPOINT_URL', self.server.url)
+        self._patch(s3_model, 'TS_S3_INDEX_READS', False)
+
+    def tearDown(self):
+        for obj, name, value in reversed(self._patched):
+            setattr(obj, name, value)
+        os.environ.clear()
+        os.environ.update(self._environ)
+
+    def _get_fully_listed_alert_ids(self, start, end):
+        '''
+        Return the IDs of webhooks between start and end found by listing
+        every webhook key.
+        '''
+        webhooks_prefix = '/'.join([self.tenant.prefix, 'webhooks'])
+        alert_ids = []
+        with tenants.using(self.tenant):
+            for obj in s3_model._iter_bucket_objects(webhooks_prefix + '/'):
+                minute_path, alert_id = obj.get('Key')[len(webhooks_prefix) + 1:].rsplit('/', 1)
+                minute = _utc(*[int(e) for e in minute_path.split('/')])
+                if start < minute < end:
+                    alert_ids.append(alert_id)
+
+        return alert_ids
+
+    def test_same_alerts_as_a_full_listing(self):
+        # Make sure the full listing sees every webhook.
+        self.assertEqual(len(self._get_fully_listed_alert_ids(_utc(2016, 1, 1), _utc(2018, 1, 1))),
+                         len(WEBHOOK_MINUTES))
+        for start, end in RANGES:
+            with tenants.using(self.tenant):
+                alert_ids = s3_model.get_alert_ids_by_date(start, end)
+            self.assertEqual(alert_ids, self._get_fully_listed_alert_ids(start, end), (start, end))
+
+    def test_lists_only_the_range(self):
+        start, end = _utc(2017, 1, 1, 12, 10, 30), _utc(2017, 1, 1, 12, 15, 30)
+        self.server.reset_stats()
+        with tenants.using(self.tenant):
+            alert_ids = s3_model.get_alert_ids_by_date(start, end)
+
+        self.assertEqual(len(alert_ids), 5)
+        # A full listing of these webhooks takes four pages.
+        self.assertEqual(self.server.requests.get('ListObjectsV2'), 1)
+
+if __name__ == '__main__':
+    unittest.main()
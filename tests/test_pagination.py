@@ -0,0 +1,215 @@
+'''
+Tests that paging through a date range with cursors returns every alert
+in it exactly once, and that bad cursors are refused.
+'''
+import datetime
+import json
+import os
+import random
+import unittest
+import uuid
+
+from iso8601 import UTC
+
+import app
+from app import clients, tenants
+import app.models.s3 as s3_model
+import app.views.s3 as s3_view
+from bench import s3server
+
+def _utc(*args):
+    return datetime.datetime(*args, tzinfo=UTC)
+
+# Minutes with webhooks, across the end of an hour and of a day, with
+# several webhooks in some minutes.
+WEBHOOK_MINUTES = [
+    _utc(2017, 1, 1, 22, 58),
+    _utc(2017, 1, 1, 22, 59),
+    _utc(2017, 1, 1, 22, 59),
+    _utc(2017, 1, 1, 23, 0),
+    _utc(2017, 1, 1, 23, 0),
+    _utc(2017, 1, 1, 23, 0),
+    _utc(2017, 1, 1, 23, 30),
+    _utc(2017, 1, 1, 23, 59),
+    _utc(2017, 1, 2, 0, 0),
+    _utc(2017, 1, 2, 0, 0),
+    _utc(2017, 1, 2, 0, 1),
+    _utc(2017, 1, 2, 1, 0),
+    _utc(2017, 1, 2, 1, 59),
+    _utc(2017, 1, 2, 1, 59),
+    _utc(2017, 1, 2, 3, 0)
+]
+
+START = _utc(2017, 1, 1, 22, 0)
+END = _utc(2017, 1, 2, 4, 0)
+
+# Small index shards so each hour's index is spread over several.
+INDEX_SHARD_MAX_ENTRIES = 2
+
+def _get_alert(number, minute):
+    created_at = int((minute - _utc(1970, 1, 1)).total_seconds()) * 1000
+    return {
+        'id': '{:08x}{:016x}'.format(created_at // 1000, number),
+        'created_at': created_at,
+        'severity': 1 + number % 3
+    }
+
+ALERTS = [_get_alert(number, minute) for number, minute in enumerate(WEBHOOK_MINUTES)]
+
+class CursorPaginationTest(unittest.TestCase):
+    '''
+    Pages of every size put together give the whole range once, whether
+    webhooks are found by listing or from index shards.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.server = s3server.start(s3server.S3Store())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _patch(self, obj, name, value):
+        self._patched.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def setUp(self):
+        self._patched = []
+        self._environ = dict(os.environ)
+        os.environ.update(AWS_ACCESS_KEY_ID='test',
+                          AWS_SECRET_ACCESS_KEY='test',
+                          AWS_DEFAULT_REGION='us-east-1')
+
+        self._patch(clients, 'TS_AWS_S3_ENDPOINT_URL', self.server.url)
+        self._patch(s3_model, 'TS_S3_SEGMENTS', False)
+        self._patch(s3_model, 'TS_S3_SELECT', False)
+        self._patch(s3_model, 'TS_S3_INDEX_READS', False)
+        self._patch(s3_model, 'TS_S3_INDEX_WRITES', True)
+        self._patch(s3_model, 'INDEX_SHARD_MAX_ENTRIES', INDEX_SHARD_MAX_ENTRIES)
+        # Write each index entry as it comes rather than batching them.
+        self._patch(s3_model, 'INDEX_FLUSH_MAX_ENTRIES', 1)
+
+        self.tenant = tenants.Tenant('test-' + uuid.uuid4().hex, 'bucket', prefix=uuid.uuid4().hex)
+        self._put_webhooks()
+
+    def tearDown(self):
+        for obj, name, value in reversed(self._patched):
+            setattr(obj, name, value)
+        os.environ.clear()
+        os.environ.update(self._environ)
+
+    def _put_webhooks(self):
+        '''
+        Archive webhooks out of order, so index shards interleave, and one
+        twice, so it is in two shards.
+        '''
+        alerts = ALERTS + [ALERTS[4]]
+        random.Random(0).shuffle(alerts)
+        with tenants.using(self.tenant):
+            for alert in alerts:
+                s3_model.put_webhook_data(alert)
+
+    def _get_pages(self, limit, filters=None):
+        '''
+        Return every page of the range, passing cursors as the API does.
+        '''
+        pages = []
+        cursor = None
+        while True:
+            after = s3_view._decode_cursor(cursor, START, END)
+            with tenants.using(self.tenant):
+                alert_ids, next_after = s3_model.get_alert_ids_page_by_date(START, END, limit, after, filters)
+            pages.append(alert_ids)
+            cursor = s3_view._encode_cursor(next_after)
+            if cursor is None:
+                return pages
+            self.assertLessEqual(len(pages), len(ALERTS))
+
+    def _check_pages(self, filters=None, expected=None):
+        if expected is None:
+            expected = [alert['id'] for alert in ALERTS]
+
+        with tenants.using(self.tenant):
+            self.assertEqual(s3_model.get_alert_ids_by_date(START, END) if filters is None else
+                             s3_model.get_alert_ids_page_by_date(START, END, filters=filters)[0],
+                             expected)
+
+        for limit in range(1, len(expected) + 2):
+            pages = self._get_pages(limit, filters)
+            alert_ids = [alert_id for page in pages for alert_id in page]
+            self.assertEqual(alert_ids, expected, limit)
+            self.assertTrue(all(len(page) == limit for page in pages[:-1]), limit)
+            self.assertTrue(0 < len(pages[-1]) <= limit or expected == [], limit)
+
+    def test_listing(self):
+        self._check_pages()
+
+    def test_index(self):
+        self._patch(s3_model, 'TS_S3_INDEX_READS', True)
+        with tenants.using(self.tenant):
+            shards = s3_model._list_index_objects('2017/01/01/23')
+        self.assertGreater(len(shards), 1)
+
+        self._check_pages()
+
+    def test_filtered(self):
+        filters = {'severity': set(['2'])}
+        expected = [alert['id'] for alert in ALERTS if alert['severity'] == 2]
+        self._check_pages(filters, expected)
+
+        self._patch(s3_model, 'TS_S3_INDEX_READS', True)
+        self._check_pages(filters, expected)
+
+class BadCursorTest(unittest.TestCase):
+    '''
+    Malformed cursors and cursors from other ranges are refused with a 400.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.client = app.create_app().test_client()
+
+    def _get_alerts(self, cursor, start='2017-01-01T22:00:00Z', end='2017-01-02T04:00:00Z'):
+        return self.client.get('/threatstack-to-s3/api/v1/s3/alert',
+                               query_string={'start': start,
+                                             'end': end,
+                                             'limit': 2,
+                                             'cursor': cursor})
+
+    def _check_refused(self, cursor, **kwargs):
+        response = self._get_alerts(cursor, **kwargs)
+        self.assertEqual(response.status_code, 400, cursor)
+        error = json.loads(response.get_data(as_text=True)).get('error')
+        self.assertEqual(error.get('type'), 'S3ViewQueryError', cursor)
+
+    def test_malformed(self):
+        for cursor in ['!!!',
+                       'not base64',
+                       s3_view._encode_cursor('2017/01/02/00/00'),
+                       s3_view._encode_cursor('2017/01/02/00/00/id/extra'),
+                       s3_view._encode_cursor('2017/13/02/00/00/id'),
+                       s3_view._encode_cursor('2017/01/02/24/00/id'),
+                       s3_view._encode_cursor('x017/01/02/00/00/id')]:
+            self._check_refused(cursor)
+
+    def test_other_range(self):
+        for webhook_ref in ['2017/01/01/21/59/id',
+                            '2017/01/02/04/00/id',
+                            '2016/01/02/00/00/id']:
+            self._check_refused(s3_view._encode_cursor(webhook_ref))
+
+        # A cursor from the first page of a day's range can't be used with
+        # the next day's.
+        self._check_refused(s3_view._encode_cursor('2017/01/02/00/00/id'),
+                            start='2017-01-02T04:00:00Z', end='2017-01-03T04:00:00Z')
+
+    def test_cursor_in_range_decodes(self):
+        start, end = _utc(2017, 1, 1, 22, 0), _utc(2017, 1, 2, 4, 0)
+        webhook_ref = '2017/01/02/00/00/id'
+        self.assertEqual(s3_view._decode_cursor(s3_view._encode_cursor(webhook_ref), start, end),
+                         webhook_ref)
+        self.assertIsNone(s3_view._decode_cursor(None, start, end))
+        self.assertIsNone(s3_view._decode_cursor('', start, end))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+Tests for alert filters and projections.
+'''
+import unittest
+
+from app.models.query import AlertQuery
+
+class AlertQueryMatchesTest(unittest.TestCase):
+    '''
+    AlertQuery.matches() compares values as S3 Select compares strings.
+    '''
+    def test_no_filters_match_everything(self):
+        self.assertTrue(AlertQuery().matches({}))
+        self.assertTrue(AlertQuery().matches({'severity': 1}))
+
+    def test_string_values(self):
+        query = AlertQuery(filters={'source': set(['host', 'agent'])})
+        self.assertTrue(query.matches({'source': 'host'}))
+        self.assertTrue(query.matches({'source': 'agent'}))
+        self.assertFalse(query.matches({'source': 'Host'}))
+
+    def test_numbers_compare_as_strings(self):
+        query = AlertQuery(filters={'severity': set(['1'])})
+        self.assertTrue(query.matches({'severity': 1}))
+        self.assertTrue(query.matches({'severity': 1.0}))
+        self.assertTrue(query.matches({'severity': '1'}))
+        self.assertFalse(query.matches({'severity': 1.5}))
+        self.assertFalse(query.matches({'severity': 2}))
+
+    def test_booleans_compare_as_true_and_false(self):
+        query = AlertQuery(filters={'dismissed': set(['true'])})
+        self.assertTrue(query.matches({'dismissed': True}))
+        self.assertFalse(query.matches({'dismissed': False}))
+        self.assertFalse(query.matches({'dismissed': 1}))
+
+    def test_missing_null_and_non_scalar_never_match(self):
+        query = AlertQuery(filters={'source': set(['None', '[]', '{}', ''])})
+        self.assertFalse(query.matches({}))
+        self.assertFalse(query.matches({'source': None}))
+        self.assertFalse(query.matches({'source': []}))
+        self.assertFalse(query.matches({'source': {}}))
+
+    def test_every_filter_must_match(self):
+        query = AlertQuery(filters={'severity': set(['1']), 'source': set(['host'])})
+        self.assertTrue(query.matches({'severity': 1, 'source': 'host'}))
+        self.assertFalse(query.matches({'severity': 1, 'source': 'agent'}))
+        self.assertFalse(query.matches({'severity': 1}))
+
+class AlertQueryProjectTest(unittest.TestCase):
+    '''
+    AlertQuery.project() keeps only the requested top level fields.
+    '''
+    def test_no_fields_returns_document(self):
+        document = {'id': 'a', 'severity': 1}
+        self.assertIs(AlertQuery().project(document), document)
+
+    def test_fields(self):
+        document = {'id': 'a', 'severity': 1, 'title': 't'}
+        query = AlertQuery(fields=['id', 'title'])
+        self.assertEqual(query.project(document), {'id': 'a', 'title': 't'})
+        # The document itself is left alone.
+        self.assertEqual(len(document), 3)
+
+    def test_missing_fields_are_left_out(self):
+        query = AlertQuery(fields=['id', 'missing'])
+        self.assertEqual(query.project({'id': 'a', 'severity': 1}), {'id': 'a'})
+
+class AlertQueryToSqlTest(unittest.TestCase):
+    '''
+    AlertQuery.to_sql() renders S3 Select expressions.
+    '''
+    def test_select_everything(self):
+        self.assertEqual(AlertQuery().to_sql(), 'SELECT * FROM S3Object s')
+
+    def test_fields(self):
+        self.assertEqual(AlertQuery(fields=['id', 'title']).to_sql(),
+                         'SELECT s."id", s."title" FROM S3Object s')
+
+    def test_fields_override(self):
+        query = AlertQuery(fields=['id', 'title'])
+        self.assertEqual(query.to_sql(fields=['id']), 'SELECT s."id" FROM S3Object s')
+        self.assertEqual(query.to_sql(fields=[]), 'SELECT * FROM S3Object s')
+
+    def test_filters_are_sorted(self):
+        query = AlertQuery(filters={'source': set(['host']), 'severity': set(['2', '1'])})
+        self.assertEqual(
+            query.to_sql(),
+            'SELECT * FROM S3Object s'
+            " WHERE CAST(s.\"severity\" AS STRING) IN ('1', '2')"
+            " AND CAST(s.\"source\" AS STRING) IN ('host')"
+        )
+
+    def test_quoting(self):
+        query = AlertQuery(filters={'a"b': set(["it's"])}, fields=['c"d'])
+        self.assertEqual(
+            query.to_sql(),
+            'SELECT s."c""d" FROM S3Object s'
+            " WHERE CAST(s.\"a\"\"b\" AS STRING) IN ('it''s')"
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+'''
+Tests that queries give the results S3 Select semantics call for, whether
+pushed down to S3 Select or evaluated locally.
+
+Runs the service's S3 code against the S3 stand-in from bench/, which
+evaluates the SQL the service generates.  The stand-in is not S3: it was
+written to the semantics the local evaluator follows, so results are
+checked against the expected alerts listed here rather than against each
+other.  Run the expectations against real S3 before relying on a change
+to CAST, number formatting or NULL handling.
+'''
+import datetime
+import os
+import unittest
+import uuid
+
+from iso8601 import UTC
+
+from app import clients, tenants
+import app.models.s3 as s3_model
+from bench import s3server
+
+# Values of each type the filtered fields may hold.  One alert is archived
+# per value, in field order, and numbered from 0; alerts for other fields
+# have severity 1.
+FIELD_VALUES = [
+    ('organization_id', ['org', 'other']),                  # 0-1
+    ('server_or_region', ['us-east-1', 'i-123', '']),       # 2-4
+    ('severity', [1, 2, 3, 1.0, 2.5, '1', True, None, [1], {'level': 1}]),  # 5-14
+    ('source', ['host', 'agent', 'Host', "it's", 1, False, None])           # 15-21
+]
+
+def _get_alert_id(number):
+    return '587c0159{:016x}'.format(number)
+
+# Filters and the numbers of the alerts they match.
+QUERIES = [
+    ({'severity': set(['1'])},
+     [0, 1, 2, 3, 4, 5, 8, 10] + list(range(15, 22))),
+    ({'severity': set(['1', '2.5'])},
+     [0, 1, 2, 3, 4, 5, 8, 9, 10] + list(range(15, 22))),
+    ({'severity': set(['true'])}, [11]),
+    ({'source': set(['host'])}, [15]),
+    ({'source': set(["it's", 'false'])}, [18, 20]),
+    ({'severity': set(['1', '2']), 'source': set(['host', 'agent'])}, [15, 16]),
+    ({'organization_id': set(['org'])}, [0]),
+    ({'server_or_region': set(['', 'i-123'])}, [3, 4])
+]
+
+START = datetime.datetime(2017, 1, 15, 23, 0, tzinfo=UTC)
+END = datetime.datetime(2017, 1, 16, 0, 0, tzinfo=UTC)
+
+class SelectPushdownTest(unittest.TestCase):
+    '''
+    Filters and projections give the expected results with and without
+    S3 Select.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.server = s3server.start(s3server.S3Store(), select=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _patch(self, obj, name, value):
+        self._patched.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def setUp(self):
+        self._patched = []
+        self._environ = dict(os.environ)
+        os.environ.update(AWS_ACCESS_KEY_ID='test',
+                          AWS_SECRET_ACCESS_KEY='test',
+                          AWS_DEFAULT_REGION='us-east-1')
+
+        self._patch(clients, 'TS_AWS_S3_ENDPOINT_URL', self.server.url)
+        self._patch(s3_model, 'TS_S3_SEGMENTS', False)
+        self._patch(s3_model, 'TS_S3_INDEX_READS', False)
+        self._patch(s3_model, 'TS_S3_INDEX_WRITES', False)
+        self._patch(s3_model, '_alert_cache', None)
+        self._patch(s3_model, '_select_supported', True)
+
+        # A tenant of our own gets a client for the stand-in and keeps its
+        # keys apart from other tests.
+        self.tenant = tenants.Tenant('test-' + uuid.uuid4().hex, 'bucket', prefix=uuid.uuid4().hex)
+        self._put_alerts()
+
+    def tearDown(self):
+        for obj, name, value in reversed(self._patched):
+            setattr(obj, name, value)
+        os.environ.clear()
+        os.environ.update(self._environ)
+
+    def _put_alerts(self):
+        '''
+        Archive an alert for every value of every filtered field.
+        '''
+        alerts = []
+        created_at = 1484521817000
+        for field, values in FIELD_VALUES:
+            for value in values:
+                alert = {
+                    'id': _get_alert_id(len(alerts)),
+                    'created_at': created_at + len(alerts) * 1000,
+                    'title': 'alert {}'.format(len(alerts)),
+                    field: value
+                }
+                if field != 'severity':
+                    alert['severity'] = 1
+                alerts.append(alert)
+
+        with tenants.using(self.tenant):
+            for alert in alerts:
+                s3_model.put_webhook_data(alert)
+                s3_model.put_alert_data(alert)
+
+        return alerts
+
+    def _select_requests(self):
+        return self.server.requests.get('SelectObjectContent', 0)
+
+    def _get_alert_ids(self, filters, select):
+        self._patch(s3_model, 'TS_S3_SELECT', select)
+        with tenants.using(self.tenant):
+            return s3_model.get_alert_ids_page_by_date(START, END, filters=filters)[0]
+
+    def test_filters(self):
+        for filters, numbers in QUERIES:
+            expected = [_get_alert_id(number) for number in numbers]
+
+            selects = self._select_requests()
+            self.assertEqual(self._get_alert_ids(filters, True), expected, filters)
+            self.assertGreater(self._select_requests(), selects)
+
+            selects = self._select_requests()
+            self.assertEqual(self._get_alert_ids(filters, False), expected, filters)
+            self.assertEqual(self._select_requests(), selects)
+
+    def test_null_and_non_scalar_never_match(self):
+        filters = {'severity': set(['None', '[1]', "{'level': 1}", ''])}
+        self.assertEqual(self._get_alert_ids(filters, True), [])
+        self.assertEqual(self._get_alert_ids(filters, False), [])
+
+    def test_projection(self):
+        alert_ids = [_get_alert_id(number) for number in (0, 5, 8, 12, 13, 15)]
+        expected = {
+            ('id',): [
+                {'id': _get_alert_id(0)},
+                {'id': _get_alert_id(5)},
+                {'id': _get_alert_id(8)},
+                {'id': _get_alert_id(12)},
+                {'id': _get_alert_id(13)},
+                {'id': _get_alert_id(15)}
+            ],
+            ('id', 'severity', 'missing'): [
+                {'id': _get_alert_id(0), 'severity': 1},
+                {'id': _get_alert_id(5), 'severity': 1},
+                {'id': _get_alert_id(8), 'severity': 1.0},
+                {'id': _get_alert_id(12), 'severity': None},
+                {'id': _get_alert_id(13), 'severity': [1]},
+                {'id': _get_alert_id(15), 'severity': 1}
+            ],
+            ('title', 'source'): [
+                {'title': 'alert 0'},
+                {'title': 'alert 5'},
+                {'title': 'alert 8'},
+                {'title': 'alert 12'},
+                {'title': 'alert 13'},
+                {'title': 'alert 15', 'source': 'host'}
+            ]
+        }
+        for fields, alerts in sorted(expected.items()):
+            self._patch(s3_model, 'TS_S3_SELECT', True)
+            selects = self._select_requests()
+            with tenants.using(self.tenant):
+                self.assertEqual(list(s3_model.iter_alerts_by_id(alert_ids, list(fields))), alerts, fields)
+            self.assertEqual(self._select_requests() - selects, len(alert_ids))
+
+            self._patch(s3_model, 'TS_S3_SELECT', False)
+            with tenants.using(self.tenant):
+                self.assertEqual(list(s3_model.iter_alerts_by_id(alert_ids, list(fields))), alerts, fields)
+
+if __name__ == '__main__':
+    unittest.main()
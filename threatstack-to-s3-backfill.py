@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''
+Archive historical alerts from the Threat Stack API to S3.
+
+Alerts already in S3 are skipped.  Progress is saved to the checkpoint file
+after every page; rerun with the same arguments to resume.
+'''
+from app import backfill
+import app.models.threatstack as threatstack_model
+import argparse
+import config
+import iso8601
+import logging
+from logging.config import fileConfig
+import os
+import sys
+
+dirname = os.path.dirname(__file__)
+logging_conf = os.path.join(dirname, 'logging.conf')
+fileConfig(logging_conf, disable_existing_loggers=False)
+if os.environ.get('TS_DEBUG'):
+    logging.root.setLevel(level=logging.DEBUG)
+_logger = logging.getLogger(__name__)
+
+def _parse_args():
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--start', required=True, type=iso8601.parse_date,
+                        help='Archive alerts created after this iso8601 time.')
+    parser.add_argument('--end', required=True, type=iso8601.parse_date,
+                        help='Archive alerts created before this iso8601 time.')
+    parser.add_argument('--organization-id',
+                        help='Threat Stack organization whose tenant to backfill (default: the default tenant).')
+    parser.add_argument('--checkpoint', default='threatstack-to-s3-backfill.json',
+                        help='Checkpoint file to resume from and save progress to.')
+    parser.add_argument('--workers', type=int, default=config.TS_ALERT_CONCURRENCY,
+                        help='Alerts archived at once.')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='Alerts requested from Threat Stack per page.')
+    parser.add_argument('--rate', type=float, default=config.THREATSTACK_RATE_LIMIT or 5,
+                        help='Maximum Threat Stack API requests per second.')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _parse_args()
+    threatstack_model.set_rate_limit(args.rate)
+    checkpoint = backfill.backfill(args.start,
+                                   args.end,
+                                   checkpoint_path=args.checkpoint,
+                                   workers=args.workers,
+                                   page_size=args.page_size,
+                                   organization_id=args.organization_id)
+
+    _logger.info('Archived {} alerts, skipped {} already archived'.format(
+        checkpoint['archived'], checkpoint['skipped']))
+    if checkpoint['failed']:
+        _logger.error('Failed to archive {} alerts: {}'.format(
+            len(checkpoint['failed']), ' '.join(checkpoint['failed'])))
+        sys.exit(1)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+'''
+Backfill hourly webhook indexes from webhooks already stored in S3.
+
+Run this over the existing archive before enabling TS_S3_INDEX_READS, and
+over hours with many index shards to compact them.
+'''
+from app import tenants
+import app.models.s3 as s3_model
+import argparse
+import iso8601
+import logging
+from logging.config import fileConfig
+import os
+
+dirname = os.path.dirname(__file__)
+logging_conf = os.path.join(dirname, 'logging.conf')
+fileConfig(logging_conf, disable_existing_loggers=False)
+if os.environ.get('TS_DEBUG'):
+    logging.root.setLevel(level=logging.DEBUG)
+_logger = logging.getLogger(__name__)
+
+def _parse_args():
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--start', required=True, type=iso8601.parse_date,
+                        help='Index webhooks after this iso8601 time.')
+    parser.add_argument('--end', required=True, type=iso8601.parse_date,
+                        help='Index webhooks before this iso8601 time.')
+    parser.add_argument('--organization-id',
+                        help='Threat Stack organization whose tenant to index (default: the default tenant).')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _parse_args()
+    with tenants.using(tenants.get_tenant(args.organization_id)):
+        count = s3_model.rebuild_index(args.start, args.end)
+    _logger.info('Indexed {} webhooks'.format(count))
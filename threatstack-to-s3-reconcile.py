@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+'''
+Fetch and store the details of archived alerts that only have webhook data.
+
+Alerts ingested with deferred enrichment, or archived with only their
+webhook data while Threat Stack was unavailable, are completed by this.
+'''
+from app import enrichment, tenants
+import argparse
+import iso8601
+import logging
+from logging.config import fileConfig
+import os
+
+dirname = os.path.dirname(__file__)
+logging_conf = os.path.join(dirname, 'logging.conf')
+fileConfig(logging_conf, disable_existing_loggers=False)
+if os.environ.get('TS_DEBUG'):
+    logging.root.setLevel(level=logging.DEBUG)
+_logger = logging.getLogger(__name__)
+
+def _parse_args():
+    '''
+    Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--start', required=True, type=iso8601.parse_date,
+                        help='Check alerts after this iso8601 time.')
+    parser.add_argument('--end', required=True, type=iso8601.parse_date,
+                        help='Check alerts before this iso8601 time.')
+    parser.add_argument('--organization-id',
+                        help='Threat Stack organization whose tenant to check (default: the default tenant).')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _parse_args()
+    with tenants.using(tenants.get_tenant(args.organization_id)):
+        result = enrichment.reconcile(args.start, args.end)
+    _logger.info('Checked {checked} alerts, {missing} lacked details, enriched {enriched}'.format(**result))
+    if result['enriched'] < result['missing']:
+        raise SystemExit(1)